@@ -107,6 +107,82 @@ def get_wb_gdp_data(datadir = datadir):
 
     return gdp
 
+
+gdp_drivers = ['growth', 'linear', 'observed', 'endogenous']
+
+def resolve_gdp(gdp, years, linear_gdp = None):
+    """
+    GDP driver as a dict with key "type" (see gdp_drivers):
+        - growth: Y grows with params['growth'] (default, also if gdp is None);
+        - linear: Y grows by gdp['slope'] every year (default if linear_gdp is given);
+        - observed: Y follows gdp['series'] (a DataArray along year, e.g. get_wb_gdp_data()), normalized to Y_ini at the first year. After the last year of the series, Y grows with params['growth'] (project = 'growth', default) or with the mean growth of the last trend_years years (project = 'trend');
+        - endogenous: Y = l*(a*Kg + b*Kf), tied to energy capacity (default l: Y_ini over the initial capacity).
+
+    A DataArray or a string can be given instead of the dict. For observed series, the ratios to the first year are aligned to the years of the run (years plus the year after the last one).
+    """
+    if gdp is None:
+        gdp = 'growth' if linear_gdp is None else {'type': 'linear', 'slope': linear_gdp}
+    if isinstance(gdp, xr.core.dataarray.DataArray):
+        gdp = {'type': 'observed', 'series': gdp}
+    if isinstance(gdp, str):
+        gdp = {'type': gdp}
+    gdp = dict(gdp)
+
+    if gdp['type'] not in gdp_drivers: raise ValueError(f'Unknown gdp driver {gdp["type"]}. Allowed: {gdp_drivers}')
+
+    if gdp['type'] == 'observed' and 'ratio' not in gdp:
+        series = gdp['series'].dropna('year')
+        if years is None: raise ValueError('years are needed to align an observed GDP series')
+        if years[0] < series.year.min(): raise ValueError(f'GDP series starts after {years[0]}')
+        ratio = (series/series.sel(year = years[0])).reindex(year = np.arange(years[0], years[-1] + 2)).values
+        if gdp.get('project', 'growth') == 'trend':
+            n_trend = gdp.get('trend_years', 10)
+            last = series.isel(year = slice(-n_trend - 1, None)).values
+            trend = (last[-1]/last[0])**(1/n_trend)
+            for i in np.where(np.isnan(ratio))[0]:
+                ratio[i] = ratio[i-1]*trend
+        gdp['ratio'] = ratio
+
+    return gdp
+
+
+def gdp_path(gdp, Y_ini, growth, n_iter):
+    """
+    Values of Y for the n_iter + 1 years of a run (axis 0), for exogenous drivers (gdp resolved with resolve_gdp). growth is a scalar or an array along years (and members); after the end of an observed series Y grows with growth. Returns None for endogenous Y.
+
+    Same operations as GDP, done once in cumulative form: the result equals stepping with GDP.
+    """
+    if gdp['type'] == 'endogenous':
+        return None
+
+    Y_ini = np.asarray(Y_ini, dtype = float)
+    growth = np.asarray(growth, dtype = float)
+    shape = (n_iter,) + np.broadcast_shapes(Y_ini.shape, growth.shape[1:] if growth.ndim > 0 else ())
+    Y_0 = np.broadcast_to(Y_ini, (1,) + shape[1:])
+
+    if gdp['type'] == 'linear':
+        steps = np.broadcast_to(np.asarray(gdp['slope'], dtype = float), shape)
+        return np.cumsum(np.concatenate([Y_0, steps]), axis = 0)
+
+    factors = np.broadcast_to(1 + growth, shape).copy()
+    if gdp['type'] == 'observed':
+        ratio = gdp['ratio']
+        ok = ~np.isnan(ratio[1:])
+        factors[ok] = (ratio[1:]/ratio[:-1])[ok].reshape((-1,) + (1,)*(len(shape) - 1))
+
+    return np.cumprod(np.concatenate([Y_0, factors]), axis = 0)
+
+
+def gdp_capacity_factor(gdp, inicond, params):
+    """
+    Factor l of the endogenous driver, Y = l*(a*Kg + b*Kf).
+    """
+    if gdp.get('l', None) is not None:
+        return gdp['l']
+
+    return inicond['Y_ini']/(params['a'] * inicond['Kg_ini'] + params['b'] * inicond['Kf_ini'])
+
+
 ########################### parameters ###########################################################################
 
 default_params = dict()
@@ -235,6 +311,96 @@ def prof_ratio(Pg, Pf, Kg, Kf):
     return (Pg/Kg - Pf/Kf)/(Pg/Kg+Pf/Kf)
     #return (Pg/Kg - Pf/Kf)/((Pg+Pf)/(Kg+Kf))
 
+def partition_energy(rule, E, Eg_max, Ef_max, Y, Kg, Kf, params):
+    """
+    Splits the energy demand E between green and fossil following rule (see partition_rules). Works on scalars and arrays.
+
+    rule can also be an array of rule names, one per member.
+    """
+    if isinstance(rule, str):
+        if rule not in partition_rules: raise ValueError(f'Unknown rule {rule}. Allowed: {list(partition_rules)}')
+        return partition_rules[rule](E, Eg_max, Ef_max, Y, Kg, Kf, params)
+
+    rule = np.asarray(rule)
+    shape = np.broadcast(E, Eg_max, Ef_max, rule).shape
+    Eg = np.empty(shape)
+    Ef = np.empty(shape)
+    for ru in np.unique(rule):
+        mask = np.broadcast_to(rule == ru, shape)
+        Eg_ru, Ef_ru = partition_energy(str(ru), E, Eg_max, Ef_max, Y, Kg, Kf, params)
+        Eg[mask] = np.broadcast_to(Eg_ru, shape)[mask]
+        Ef[mask] = np.broadcast_to(Ef_ru, shape)[mask]
+
+    return Eg, Ef
+
+
+partition_rules = dict()
+
+def register_rule(name, registry = partition_rules):
+    """
+    Decorator adding a rule for energy partition to partition_rules. 
+    
+    The rule is called as rule(E, Eg_max, Ef_max, Y, Kg, Kf, params) and returns (Eg, Ef). It should work on arrays.
+
+    Rules for the technology-vector model go to registry = tech_partition_rules (see forward_step_tech).
+    """
+    def decorator(func):
+        registry[name] = func
+        return func
+
+    return decorator
+
+
+@register_rule('maxgreen')
+def rule_maxgreen(E, Eg_max, Ef_max, Y, Kg, Kf, params):
+    """
+    All green capacity is used, fossil covers the rest.
+    """
+    Eg = np.minimum(Eg_max, E)
+    Ef = np.where(Eg_max > E, 0., E - Eg_max)
+    return Eg, Ef
+
+
+@register_rule('proportional')
+def rule_proportional(E, Eg_max, Ef_max, Y, Kg, Kf, params):
+    """
+    Demand split proportionally to capital.
+    """
+    Eg = Kg/(Kg+Kf) * E
+    Ef = Kf/(Kg+Kf) * E
+    return Eg, Ef
+
+
+@register_rule('fair')
+def rule_fair(E, Eg_max, Ef_max, Y, Kg, Kf, params):
+    """
+    Fossil covers half of the demand (or all its capacity, if smaller).
+    """
+    Ef = np.where(Ef_max >= E/2., E/2., Ef_max)
+    Eg = E - Ef
+    return Eg, Ef
+
+
+@register_rule('whole_capacity')
+def rule_whole_capacity(E, Eg_max, Ef_max, Y, Kg, Kf, params):
+    """
+    All capacity is used. This makes Y useless
+    """
+    return Eg_max, Ef_max
+
+
+@register_rule('fossil_constraint')
+def rule_fossil_constraint(E, Eg_max, Ef_max, Y, Kg, Kf, params):
+    """
+    Military and heavy industry keep using fossil (a fraction f_heavy of Y), green capacity covers the rest.
+    """
+    Ef_min = params['f_heavy'] * Y
+    heavy = E-Ef_min < Eg_max
+    Ef = np.where(heavy, Ef_min, E-Eg_max)
+    Eg = np.where(heavy, E-Ef_min, Eg_max)
+    return Eg, Ef
+
+
 def forward_step(Y, Kg, Kf, params = default_params, rule = 'maxgreen', betafun_type = 'cdf', verbose = False, raise_bnd_err = False, linear_gdp = None):
     """
     A single iteration of the model.
@@ -274,32 +440,7 @@ def forward_step(Y, Kg, Kf, params = default_params, rule = 'maxgreen', betafun_
         if verbose: print(f'Energy scarcity! {Eg_max} {Ef_max} {E}')
         # raise ValueError(f'Energy scarcity! {Eg_max} {Ef_max} {E}')
 
-    if rule == 'maxgreen':
-        Eg = Eg_max
-        Ef = E-Eg
-        if Eg > E:
-            Eg = E
-            Ef = 0.
-    elif rule == 'proportional':
-        Eg = Kg/(Kg+Kf) * E
-        Ef = Kf/(Kg+Kf) * E
-    elif rule == 'fair':
-        if Ef_max >= E/2.:
-            Ef = E/2.
-        else:
-            Ef = Ef_max
-        Eg = E - Ef
-    elif rule == 'whole_capacity': # This makes Y useless
-        Eg = Eg_max
-        Ef = Ef_max
-    elif rule == 'fossil_constraint': # military and heavy industry keep using fossil
-        Ef_min = f_heavy * Y
-        if E-Ef_min < Eg_max:
-            Ef = Ef_min
-            Eg = E-Ef_min
-        else:
-            Eg = Eg_max
-            Ef = E-Eg
+    Eg, Ef = partition_energy(rule, E, Eg_max, Ef_max, Y, Kg, Kf, params)
     
     if E == Eg: 
         if verbose: print('Transition completed!')
@@ -340,7 +481,10 @@ def forward_step(Y, Kg, Kf, params = default_params, rule = 'maxgreen', betafun_
     return Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, success
 
 
-def define_Eg(E, Kg, Kf, a, b, f_heavy, rule = 'maxgreen', verbose = False):
+def define_Eg(E, Kg, Kf, a, b, f_heavy, rule = 'maxgreen', verbose = False, Y = None):
+    """
+    Energy partition for given capital (see partition_rules). Y is only needed for rule fossil_constraint.
+    """
     # Energy and infrastructure
     Eg_max = a * Kg # a = 1
     Ef_max = b * Kf # b time dependent, exog. should decrease to 0
@@ -350,26 +494,10 @@ def define_Eg(E, Kg, Kf, a, b, f_heavy, rule = 'maxgreen', verbose = False):
         if verbose: print(f'Energy scarcity! {Eg_max} {Ef_max} {E}')
         # raise ValueError(f'Energy scarcity! {Eg_max} {Ef_max} {E}')
 
-    if rule == 'maxgreen':
-        Eg = Eg_max
-        Ef = E-Eg
-        if Eg > E:
-            Eg = E
-            Ef = 0.
-    elif rule == 'proportional':
-        Eg = Kg/(Kg+Kf) * E
-        Ef = Kf/(Kg+Kf) * E
-    elif rule == 'whole_capacity': # This makes Y useless
-        Eg = Kg
-        Ef = Kf
-    elif rule == 'fossil_constraint': # military and heavy industry keep using fossil
-        Ef_min = f_heavy * Y
-        if E-Ef_min < Eg_max:
-            Ef = Ef_min
-            Eg = E-Ef_min
-        else:
-            Eg = Eg_max
-            Ef = E-Eg
+    if Y is None and rule == 'fossil_constraint':
+        raise ValueError('Y is needed for rule fossil_constraint')
+
+    Eg, Ef = partition_energy(rule, E, Eg_max, Ef_max, Y, Kg, Kf, {'f_heavy': f_heavy})
     
     return Eg, Ef
 
@@ -413,7 +541,7 @@ def backward_step(Y, Kg, Kf, params = default_params, rule = 'maxgreen', betafun
     cond = True
     while cond and ii < max_iter:
         if verbose: print('ITeration:', ii)
-        Eg, Ef = define_Eg(E, Kgit, Kfit, a, b, f_heavy, rule = rule)
+        Eg, Ef = define_Eg(E, Kgit, Kfit, a, b, f_heavy, rule = rule, Y = Y)
 
         ## Profit of energy production of previous step
         Pg = gamma_g * (Eg - eta_g * Eg**h_g)
@@ -522,18 +650,24 @@ def set_params(params, years, verbose = False):
     return okpar, allow_param_scenario
 
 
-def run_model(inicond = default_inicond, params = default_params, n_iter = 100, rule = 'maxgreen', betafun_type = 'cdf', verbose = True, run_backwards = False, raise_bnd_err = False, year_ini = None, extend_constant = False, linear_gdp = None):
+resu_vars = ['Y', 'Kg', 'Kf', 'E', 'Eg', 'Ef', 'Ig', 'If', 'Pg', 'Pf'] # model outputs, in the order of forward_step
+
+def run_model(inicond = default_inicond, params = default_params, n_iter = 100, rule = 'maxgreen', betafun_type = 'cdf', verbose = True, run_backwards = False, raise_bnd_err = False, year_ini = None, extend_constant = False, linear_gdp = None, gdp = None):
     """
 
-    Runs the model. Returns list of lists of outputs: [Y, Kg, Kf, E, Eg, Ef]  (can be improved!)
+    Runs the model. Returns a ModelResult with the trajectories of [Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf] (to_dataset() converts it to a Dataset).
 
     Rules are for energy partition when potential production exceeds demand (see forward_step function).
 
     allow_param_scenario removed. if parameters are arrays or dataarrays, this flag is automatically activated.
 
+    gdp selects a GDP driver (see resolve_gdp): observed/projected series, growth, linear or endogenous Y. By default, Y grows with params['growth'] (or linear_gdp) at each step.
+
     """
     if year_ini is None:
         raise ValueError(f'{year_ini} not set!')
+    if gdp is not None and run_backwards:
+        raise ValueError('gdp drivers are not available for backward runs')
 
     Y = inicond['Y_ini']
     Kg = inicond['Kg_ini']
@@ -543,7 +677,13 @@ def run_model(inicond = default_inicond, params = default_params, n_iter = 100,
     params_ok, allow_param_scenario = set_params(params, years)
     okpar = params.copy()
 
-    resu = []
+    Y_path = None
+    if gdp is not None:
+        gdp = resolve_gdp(gdp, years, linear_gdp = linear_gdp)
+        Y_path = gdp_path(gdp, Y, _param_array(params_ok['growth'], years, []), n_iter)
+        if Y_path is None: l_cap = gdp_capacity_factor(gdp, inicond, params_ok)
+
+    out = np.empty((len(resu_vars), n_iter))
     for i in range(n_iter):
         if allow_param_scenario is not None:
             for par in allow_param_scenario:
@@ -561,10 +701,12 @@ def run_model(inicond = default_inicond, params = default_params, n_iter = 100,
 
         if not run_backwards:
             Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, success = forward_step(Y, Kg, Kf, params = okpar, verbose = verbose, rule = rule, betafun_type = betafun_type, raise_bnd_err= raise_bnd_err, linear_gdp = linear_gdp)
+            if gdp is not None:
+                Y = Y_path[i+1] if Y_path is not None else l_cap * (okpar['a'] * Kg + okpar['b'] * Kf)
         else:
             Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, success = backward_step(Y, Kg, Kf, params = okpar, verbose = verbose, rule = rule, betafun_type = betafun_type, raise_bnd_err=raise_bnd_err)
 
-        resu.append([Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf])
+        out[:, i] = Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf
         if success == 0: 
             continue
         elif success == 1:
@@ -574,39 +716,120 @@ def run_model(inicond = default_inicond, params = default_params, n_iter = 100,
             if verbose: print(f'Energy scarcity at time: {i}!')
             break
     
+    n_done = i + 1
     if extend_constant:
-        if len(resu) < n_iter:
+        if n_done < n_iter:
             print(f'Too short! extending up to {year_ini + n_iter}')
-            resu = np.stack(resu)
-            last_row = resu[-1, :]        
-            repeated = np.repeat(last_row[np.newaxis, :], n_iter - resu.shape[0], axis = 0)
-            resu = np.concatenate([resu, repeated], axis = 0)
+            out[:, n_done:] = out[:, n_done-1:n_done]
+            n_done = n_iter
 
-    resu = rebuild_resu(resu, run_backwards = run_backwards)
+    resu = ModelResult(out[:, :n_done], year_ini = year_ini, run_backwards = run_backwards)
     
     if not run_backwards:
         if success == 1: 
-            resu['success'] = True
-            resu['year_zero'] = i
-            resu['year_peak'] = np.argmax(resu['Ef'])
-
-            for ye in range(resu['year_peak'], len(resu['Ef'])):
-                if resu['Ef'][ye] <= resu['Ef'][resu['year_peak']]/2.: break
-            resu['year_halved'] = ye
-            if verbose: print('Peak fossil: {}'.format(resu['year_peak']))
-            if verbose: print('Halved fossil: {}'.format(resu['year_halved']))
+            Ef = resu.get('Ef')
+            year_peak = np.argmax(Ef)
+            for ye in range(year_peak, len(Ef)):
+                if Ef[ye] <= Ef[year_peak]/2.: break
+
+            resu.attrs['success'] = True
+            resu.attrs['year_zero'] = year_ini + i
+            resu.attrs['year_peak'] = year_ini + year_peak
+            resu.attrs['year_halved'] = year_ini + ye
+            if verbose: print('Peak fossil: {}'.format(year_peak))
+            if verbose: print('Halved fossil: {}'.format(ye))
         else:
-            resu['success'] = False
-            resu['year_zero'] = np.nan
-            resu['year_peak'] = np.nan
-            resu['year_halved'] = np.nan
-    
-    if year_ini is not None:
-        resu = build_resu_ds(resu, year_ini = year_ini)
+            resu.attrs['success'] = False
+            resu.attrs['year_zero'] = np.nan
+            resu.attrs['year_peak'] = np.nan
+            resu.attrs['year_halved'] = np.nan
 
     return resu
 
 
+class ModelResult:
+    """
+    Output of run_model.
+
+    Trajectories are the rows of a single array (one per variable in resu_vars, reversed with a view for backward runs). Ig_ratio and Eg_ratio are computed when accessed. The conversion to Dataset is done only on request (to_dataset) or when a Dataset method is used (e.g. resu.sel(...), resu.to_netcdf(...)).
+
+    resu['Ef'] (or resu.Ef) gives a DataArray along year, as for a Dataset, while resu.get('Ef') gives the underlying numpy array. The scalars success, year_zero, year_peak and year_halved are in attrs and available as attributes.
+    """
+    derived_vars = ['Ig_ratio', 'Eg_ratio']
+
+    def __init__(self, data, year_ini, run_backwards = False, attrs = None):
+        if run_backwards: data = data[:, ::-1]
+        self.data = data
+        self.year_ini = year_ini
+        self.attrs = dict() if attrs is None else attrs
+        self._ds = None
+
+    @property
+    def years(self):
+        return np.arange(self.year_ini, self.year_ini + self.data.shape[1])
+
+    def get(self, var):
+        """
+        Numpy array of var (no copy for model variables).
+        """
+        if var in resu_vars:
+            return self.data[resu_vars.index(var)]
+        elif var == 'Ig_ratio':
+            Ig = self.get('Ig')
+            return Ig/(Ig + self.get('If'))
+        elif var == 'Eg_ratio':
+            return self.get('Eg')/self.get('E')
+        elif var in self.attrs:
+            return self.attrs[var]
+        else:
+            raise KeyError(var)
+
+    def keys(self):
+        return resu_vars + self.derived_vars
+
+    def align(self, var, obs):
+        """
+        Model and observed values of var on the common years. obs is a DataArray along year.
+        """
+        years_obs = obs.year.values
+        _, i_mod, i_obs = np.intersect1d(self.years, years_obs, assume_unique = True, return_indices = True)
+
+        return self.get(var)[i_mod], obs.values[i_obs]
+
+    def to_dataset(self):
+        """
+        Dataset with all variables along year (built once, sharing memory with the result).
+        """
+        if self._ds is None:
+            data_vars = {var: (['year'], self.get(var)) for var in self.keys()}
+            self._ds = xr.Dataset(data_vars = data_vars, coords = {'year': self.years}, attrs = self.attrs)
+
+        return self._ds
+
+    def __getitem__(self, var):
+        if var in self.attrs:
+            return self.attrs[var]
+        return xr.DataArray(self.get(var), dims = ['year'], coords = {'year': self.years}, name = var)
+
+    def __contains__(self, var):
+        return var in self.keys()
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self.attrs:
+            return self.attrs[name]
+        if name in self.keys():
+            return self[name]
+        return getattr(self.to_dataset(), name)
+
+    def __repr__(self):
+        return 'ModelResult\n' + repr(self.to_dataset())
+
+
 def rebuild_resu(resu, run_backwards = False):
     if isinstance(resu, list):
         resu = np.stack(resu)
@@ -661,20 +884,15 @@ def build_resu_ds(resu, year_ini):
     return ds
 
 
-def cost_function(parset, parnames = ['beta_0', 'gamma_g', 'growth', 'delta_sig'], params = default_params.copy(), year_ini = 2015, inicond = inicond_2015, verbose = False, all_green = False, I_weight = 1., obs = None, linear_gdp = None):
+def fit_params(parset, parnames, params, year_ini = 2015, year_end = 2025):
     """
-    Fit model to (year_ini - 2025) obs.
+    Sets the values of parset to params (in place), as in cost_function. 
+    
+    Pairs of parameters ending with _intercept and _slope define a linear scenario from year_ini to year_end (excluded). gamma_f is set equal to gamma_g.
     """
-
-    if verbose:
-        print(all_green, I_weight, obs, linear_gdp)
-        
-    n_iter = 2025 - year_ini
-    years = np.arange(year_ini, 2025)
+    years = np.arange(year_ini, year_end)
 
     pardict = {par: val for par, val in zip(parnames, parset)}
-    print('---------------------')
-    print(pardict)
 
     for par in pardict:
         if 'intercept' in par:
@@ -690,30 +908,63 @@ def cost_function(parset, parnames = ['beta_0', 'gamma_g', 'growth', 'delta_sig'
         else:
             params[par] = pardict[par]        
 
-    # for parval, pnam in zip(ok_parset, ok_names):
-    #         params[pnam] = parval
-    
     params['gamma_f'] = params['gamma_g']
-    #print('----')
-    #print(params)
-    #print('---------------------')
-    resu = run_model(inicond = inicond, params = params, n_iter = n_iter, year_ini = year_ini, verbose = verbose, rule = 'maxgreen', extend_constant = True, linear_gdp = linear_gdp)
+
+    return params
+
+
+def fit_obs(all_green = False):
+    """
+    Observations used by cost_function: share of green investment and of green energy.
+    """
+    obs = dict()
+    if all_green:
+        obs['Ig_ratio'] = Ig_obs_all/(Ig_obs_all+If_obs)
+    else:
+        obs['Ig_ratio'] = Ig_obs/(Ig_obs+If_obs)
+    obs['Eg_ratio'] = Eg_ratio
+
+    return obs
+
+
+def cost_function(parset, parnames = ['beta_0', 'gamma_g', 'growth', 'delta_sig'], params = default_params.copy(), year_ini = 2015, inicond = inicond_2015, verbose = False, all_green = False, I_weight = 1., obs = None, linear_gdp = None, year_end = 2025, components = False, gdp = None, year_weights = None):
+    """
+    Fit model to (year_ini - year_end) obs.
+
+    year_weights is an optional dict of DataArrays along year, weighting the years of each variable in obs (see bootstrap).
+
+    With components = True, returns a dict with the unweighted cost of each variable in obs.
+    """
+
+    if verbose:
+        print(all_green, I_weight, obs, linear_gdp)
+        
+    n_iter = year_end - year_ini
+
+    if verbose:
+        print('---------------------')
+        print({par: val for par, val in zip(parnames, parset)})
+
+    params = fit_params(parset, parnames, params, year_ini = year_ini, year_end = year_end)
+
+    resu = run_model(inicond = inicond, params = params, n_iter = n_iter, year_ini = year_ini, verbose = verbose, rule = 'maxgreen', extend_constant = True, linear_gdp = linear_gdp, gdp = gdp)
     #print(len(resu['Eg']))
 
     # What to fit on
     if obs is None:
-        obs = dict()
-        if all_green:
-            obs['Ig_ratio'] = Ig_obs_all/(Ig_obs_all+If_obs)
-        else:
-            obs['Ig_ratio'] = Ig_obs/(Ig_obs+If_obs)
-        obs['Eg_ratio'] = Eg_ratio
+        obs = fit_obs(all_green = all_green)
+
+    if components:
+        return {var: costfun(resu, {var: obs[var]}, weights = year_weights) for var in obs}
     
     if I_weight < 1.:
         weights = {'Ig_ratio': I_weight, 'Eg_ratio': 1.-I_weight}
     else:
         weights = None
 
+    if year_weights is not None:
+        weights = {var: (1. if weights is None else weights.get(var, 1.)) * year_weights.get(var, 1.) for var in obs}
+
     cost = costfun(resu, obs, weights = weights)
 
     #cost = costfun_1524(resu, year_ini = year_ini, I_weight = I_weight, all_green = all_green)
@@ -722,131 +973,171 @@ def cost_function(parset, parnames = ['beta_0', 'gamma_g', 'growth', 'delta_sig'
     return cost
 
 
-def calc_sens_param(param_name, frac_pert = 0.5, var_range = None, inicond = default_inicond, params = default_params, n_iter = 100, n_pert = 5):
+def _cost_kw(parset, parnames, cost_kw):
+    return cost_function(parset, parnames = parnames, **cost_kw)
+
+
+def _fit_task(x0, parnames, bounds, cost_kw, method, tol):
+    """
+    A single minimization of cost_function. Top level, so that it can be sent to worker processes.
+    """
+    # cost_function modifies params in place: each fit needs its own copy
+    cost_kw = dict(cost_kw)
+    cost_kw['params'] = cost_kw.get('params', default_params).copy()
+
+    result = scipy.optimize.minimize(_cost_kw, x0, args = (parnames, cost_kw), bounds = bounds, method = method, tol = tol)
+    result['params'] = fit_params(result.x, parnames, cost_kw['params'].copy(), year_ini = cost_kw.get('year_ini', 2015), year_end = cost_kw.get('year_end', 2025))
+
+    return result
+
+
+def calibrate(parnames, initial_guess, bounds, n_starts = 1, seed = None, backend = 'serial', n_workers = None, method = None, tol = 1e-10, **cost_kw):
+    """
+    Fits parnames minimizing cost_function (cost_kw are passed to it: params, year_ini, inicond, I_weight, obs, ...).
+
+    With n_starts > 1, additional fits start from random points uniformly drawn within bounds, and are run in parallel with the chosen backend (see map_tasks).
+
+    Returns the best result (a scipy OptimizeResult, result.params has the full set of parameters) and the list of all results.
+    """
+    rng = np.random.default_rng(seed)
+    lower, upper = np.array(bounds, dtype = float).T
+    starts = [np.array(initial_guess, dtype = float)] + [rng.uniform(lower, upper) for i in range(n_starts - 1)]
+
+    tasks = [(x0, parnames, bounds, cost_kw, method, tol) for x0 in starts]
+    results = map_tasks(_fit_task, tasks, backend = backend, n_workers = n_workers)
+
+    best = results[np.argmin([res.fun for res in results])]
+
+    return best, results
+
+
+def calc_sens_param(param_name, frac_pert = 0.5, var_range = None, inicond = default_inicond, params = default_params, n_iter = 100, n_pert = 5, year_ini = 2015, backend = 'serial', n_workers = None):
     """
     Calculates sensitivity to a single parameter. Computes multiple times the model and returns the trajectories.
+
+    The perturbed runs are done as a single ensemble (see run_ensemble), with the chosen backend.
     """
     if frac_pert < 0 or frac_pert > 1: raise ValueError('var_range should be between 0 and 1')
 
     if var_range is None: var_range = [default_params[param_name]*(1-frac_pert), default_params[param_name]*(1+frac_pert)]
 
-    nominal = run_model(inicond = inicond, params = params, n_iter = n_iter, verbose = False)
+    nominal = run_model(inicond = inicond, params = params, n_iter = n_iter, verbose = False, year_ini = year_ini)
     
     vals = np.linspace(var_range[0], var_range[1], n_pert)
     
-    all_resu = []
     var_params = params.copy()
-    for val in vals:
-        var_params[param_name] = val
-        resu = run_model(inicond = inicond, params = var_params, n_iter = n_iter, verbose = False)
+    var_params[param_name] = xr.DataArray(vals, dims = ['member'])
+    ens = run_ensemble(inicond = inicond, params = var_params, n_iter = n_iter, year_ini = year_ini, backend = backend, n_workers = n_workers)
 
-        all_resu.append(resu)
+    all_resu = [ens.isel(member = i) for i in range(n_pert)]
 
     #plot_resu(resu)
     return vals, nominal, all_resu
 
 
 def get_colors_from_colormap(n_col, colormap_name='RdBu_r'):
-    cmap = cm.get_cmap(colormap_name)
+    cmap = plt.get_cmap(colormap_name)
     colors = np.array([cmap(i/(n_col-1)) for i in range(n_col)])
     #print(colors)
     return colors
 
 
-def plot_sens_param(vals, nominal, all_resu, plot_type = 'tuning'):
+def _add_lines(ax, xs, ys, colors = 'black', **kwargs):
+    """
+    Draws many lines (lists of x and y arrays, possibly of different lengths) as a single LineCollection.
+    """
+    from matplotlib.collections import LineCollection
+
+    segments = [np.column_stack([np.asarray(xx, dtype = float), np.asarray(yy, dtype = float)]) for xx, yy in zip(xs, ys)]
+    coll = LineCollection(segments, colors = colors, **kwargs)
+    ax.add_collection(coll)
+    ax.autoscale_view()
+
+    return coll
+
+
+def plot_sens_param(vals, nominal, all_resu, plot_type = 'tuning', axes = None):
     """
-    Plots output of calc_sens_param.
+    Plots output of calc_sens_param. Perturbed runs are drawn as line collections.
+
+    axes is an optional list of three axes to draw on (new figures are created otherwise).
     """
+    colors = get_colors_from_colormap(len(all_resu))
+    if axes is None:
+        axes = [plt.figure().add_subplot() for i in range(3)]
+    ax, ax2, ax3 = axes
 
     if plot_type == 'dynamics':
-        fig = plt.figure()
         resu = nominal
-        plt.plot(resu['Kf'] + resu['Kg'], label = 'Total', color = 'violet')
-        plt.plot(resu['Kf'], label = 'Fossil', color = 'black')
-        plt.plot(resu['Kg'], label = 'Green', color = 'green')
+        ax.plot(resu['Kf'].values + resu['Kg'].values, label = 'Total', color = 'violet')
+        ax.plot(resu['Kf'].values, label = 'Fossil', color = 'black')
+        ax.plot(resu['Kg'].values, label = 'Green', color = 'green')
 
-        for resu in all_resu:
-            plt.plot(resu['Kf'] + resu['Kg'], color = 'violet', ls = ':', lw = 0.5)
-            plt.plot(resu['Kf'], color = 'black', ls = ':', lw = 0.5)
-            plt.plot(resu['Kg'], color = 'green', ls = ':', lw = 0.5)
+        for var, col in zip([['Kf', 'Kg'], ['Kf'], ['Kg']], ['violet', 'black', 'green']):
+            ys = [sum(resu[va].values for va in var) for resu in all_resu]
+            _add_lines(ax, [np.arange(len(yy)) for yy in ys], ys, colors = col, linestyles = ':', linewidths = 0.5)
 
-        plt.xlabel('time')
-        plt.ylabel('Energy infrastructure')
-        plt.legend()
+        ax.set_xlabel('time')
+        ax.set_ylabel('Energy infrastructure')
+        ax.legend()
 
-        fig2 = plt.figure()
         resu = nominal
-        plt.plot(resu['E'], label = 'Total', color = 'violet')
-        plt.plot(resu['Ef'], label = 'Fossil', color = 'black')
-        plt.plot(resu['Eg'], label = 'Green', color = 'green')
-        for resu in all_resu:
-            plt.plot(resu['E'], label = 'Total', color = 'violet', ls = ':', lw = 0.5)
-            plt.plot(resu['Ef'], label = 'Fossil', color = 'black', ls = ':', lw = 0.5)
-            plt.plot(resu['Eg'], label = 'Green', color = 'green', ls = ':', lw = 0.5)
-
-        plt.xlabel('time')
-        plt.ylabel('Energy production')
-        plt.legend()
+        ax2.plot(resu['E'].values, label = 'Total', color = 'violet')
+        ax2.plot(resu['Ef'].values, label = 'Fossil', color = 'black')
+        ax2.plot(resu['Eg'].values, label = 'Green', color = 'green')
+        for var, col in zip(['E', 'Ef', 'Eg'], ['violet', 'black', 'green']):
+            ys = [resu[var].values for resu in all_resu]
+            _add_lines(ax2, [np.arange(len(yy)) for yy in ys], ys, colors = col, linestyles = ':', linewidths = 0.5)
+
+        ax2.set_xlabel('time')
+        ax2.set_ylabel('Energy production')
+        ax2.legend()
     
     elif plot_type == 'tuning':
-        fig = plt.figure()
         resu = nominal
-        # Ig = np.diff(resu['Kg'])
-        # If = np.diff(resu['Kf'])
-        Ig = resu['Ig']
-        If = resu['If']
-
-        plt.plot((Ig/(Ig+If))[:20], label = 'model', color = 'black')
-        plt.plot(Ig_obs/(Ig_obs+If_obs), label = 'obs', color = 'orange')
-
-        colors = get_colors_from_colormap(len(all_resu))
+        Ig = resu['Ig'].values
+        If = resu['If'].values
 
-        for resu, col in zip(all_resu, colors):
-            # Ig = np.diff(resu['Kg'])
-            # If = np.diff(resu['Kf'])
-            Ig = resu['Ig']
-            If = resu['If']
-            plt.plot((Ig/(Ig+If))[:20], color = col, ls = '--', lw = 1)
+        ax.plot((Ig/(Ig+If))[:20], label = 'model', color = 'black')
+        ax.plot((Ig_obs/(Ig_obs+If_obs)).values, label = 'obs', color = 'orange')
 
-            # plt.annotate(f'({x_annotate}, {y_annotate:.2f})', xy=(x_annotate, y_annotate), xytext=(x_annotate + 1, y_annotate - 0.5), arrowprops=dict(facecolor='black', shrink=0.05))
+        ys = [(resu['Ig'].values/(resu['Ig'].values+resu['If'].values))[:20] for resu in all_resu]
+        _add_lines(ax, [np.arange(len(yy)) for yy in ys], ys, colors = colors, linestyles = '--', linewidths = 1)
 
-        plt.xlabel('time')
-        plt.ylabel('Green share of energy investment (beta)')
-        plt.legend()
+        ax.set_xlabel('time')
+        ax.set_ylabel('Green share of energy investment (beta)')
+        ax.legend()
 
-        fig2 = plt.figure()
         resu = nominal
-        plt.plot((resu['Eg']/resu['E'])[:20], label = 'model', color = 'black')
-        plt.plot(Eg_ratio.sel(year = slice(2015, 2024)).values, label = 'obs', color = 'orange')
+        ax2.plot((resu['Eg'].values/resu['E'].values)[:20], label = 'model', color = 'black')
+        ax2.plot(Eg_ratio.sel(year = slice(2015, 2024)).values, label = 'obs', color = 'orange')
         
-        for resu, col in zip(all_resu, colors):
-            plt.plot((resu['Eg']/resu['E'])[:20], color = col, ls = '--', lw = 1)
+        ys = [(resu['Eg'].values/resu['E'].values)[:20] for resu in all_resu]
+        _add_lines(ax2, [np.arange(len(yy)) for yy in ys], ys, colors = colors, linestyles = '--', linewidths = 1)
 
-        plt.xlabel('time')
-        plt.ylabel('Share of renewable energy')
-        plt.legend()
+        ax2.set_xlabel('time')
+        ax2.set_ylabel('Share of renewable energy')
+        ax2.legend()
 
-    fig3 = plt.figure()
     year_zeros = [resu['year_zero'] for resu in all_resu]
     year_peaks = [resu['year_peak'] for resu in all_resu]
     year_halveds = [resu['year_halved'] for resu in all_resu]
-    for val, yze, ype, yha, col in zip(vals, year_zeros, year_peaks, year_halveds, colors):
-        plt.scatter(val, yze, color = col, marker = 'o')
-        plt.scatter(val, ype, color = col, marker = '>')
-        plt.scatter(val, yha, color = col, marker = 'x')
+    ax3.scatter(vals, year_zeros, color = colors, marker = 'o', label = 'zero')
+    ax3.scatter(vals, year_peaks, color = colors, marker = '>', label = 'peak')
+    ax3.scatter(vals, year_halveds, color = colors, marker = 'x', label = 'halved')
     
-    plt.xlabel('value')
-    plt.ylabel('years')
-    plt.legend()
+    ax3.set_xlabel('value')
+    ax3.set_ylabel('years')
+    ax3.legend()
 
-    return fig, fig2, fig3
+    return ax.figure, ax2.figure, ax3.figure
 
 
 def costfun(resu, obs, weights = None, verbose = False):
     """
-    Generic cost function for whatever is inside obs. Resu is a dataset and obs is a dict of dataarrays with 'year' axis.
+    Generic cost function for whatever is inside obs. Resu is a dataset (or a ModelResult) and obs is a dict of dataarrays with 'year' axis.
 
-    If given, weights should be a dictionary with weights for all variables in obs.
+    If given, weights should be a dictionary with weights for all variables in obs. A weight can also be a DataArray along year (e.g. multiplicities of resampled years), missing years have zero weight.
     """
 
     cost = []
@@ -866,7 +1157,13 @@ def costfun(resu, obs, weights = None, verbose = False):
             else:
                 wvar = 1.
         
-        cc = wvar*((resu[var]-obs[var])**2).sum().values
+        if isinstance(resu, ModelResult):
+            mod, ob = resu.align(var, obs[var])
+            if isinstance(wvar, xr.core.dataarray.DataArray):
+                _, wvar = resu.align(var, wvar.reindex(year = obs[var].year).fillna(0.))
+            cc = np.nansum(wvar*(mod - ob)**2)
+        else:
+            cc = (wvar*(resu[var]-obs[var])**2).sum().values
         cost.append(cc)
 
     return np.sum(cost)
@@ -879,6 +1176,9 @@ def costfun_1524(resu, year_ini = 2015, I_weight = 1., all_green = False):
     year_ini indicates first year of model sim
     I_weight is the weight to give to the "investment part" of the cost function relative to the energy share part
     """
+    if isinstance(resu, ModelResult):
+        resu = resu.to_dataset()
+
     Ig = resu['Ig']
     If = resu['If']
 
@@ -967,6 +1267,9 @@ def plot_resuvsobs(resu, year_ini = 2000, year_fin = 2100, maxlen = None, all_gr
     Plots outputs vs observed green investment and green energy share.
     """
 
+    if isinstance(resu, ModelResult):
+        resu = resu.to_dataset()
+
     if maxlen is not None:
         year_ini = resu.year[0]
         year_fin = resu.year[0] + maxlen
@@ -1049,7 +1352,13 @@ def plot_hist(resu, year_ini = 1950, maxlen = 50):
     return fig, fig2
 
 
-def plot_resu(resu, year_ini = None, title = None):
+def plot_resu(resu, year_ini = None, title = None, axes = None):
+    """
+    Plots capital and energy production of a run. axes is an optional pair of axes to draw on (new figures are created otherwise).
+    """
+    if isinstance(resu, ModelResult):
+        resu = resu.to_dataset()
+
     if not isinstance(resu, xr.core.dataset.Dataset):
         if year_ini is not None:
             resu = build_resu_ds(resu, year_ini)
@@ -1059,23 +1368,28 @@ def plot_resu(resu, year_ini = None, title = None):
     else:
         xax = resu.year
 
-    fig, ax = plt.subplots()
-    plt.plot(xax, resu['Kf'] + resu['Kg'], label = 'Total')
-    plt.plot(xax, resu['Kf'], label = 'Fossil')
-    plt.plot(xax, resu['Kg'], label = 'Green')
+    if axes is None:
+        fig, ax = plt.subplots()
+        fig2, ax2 = plt.subplots()
+    else:
+        ax, ax2 = axes
+        fig, fig2 = ax.figure, ax2.figure
+
+    ax.plot(xax, resu['Kf'] + resu['Kg'], label = 'Total')
+    ax.plot(xax, resu['Kf'], label = 'Fossil')
+    ax.plot(xax, resu['Kg'], label = 'Green')
     if year_ini is not None:
-        plt.xlabel('year')
+        ax.set_xlabel('year')
     else:
-        plt.xlabel('time')
-    plt.ylabel('Energy infrastructure')
-    plt.legend()
+        ax.set_xlabel('time')
+    ax.set_ylabel('Energy infrastructure')
+    ax.legend()
     if title is not None:
-        plt.title(title)
+        ax.set_title(title)
 
-    fig2, ax2 = plt.subplots()
-    plt.plot(xax, resu['E'], label = 'Total')
-    plt.plot(xax, resu['Ef'], label = 'Fossil')
-    plt.plot(xax, resu['Eg'], label = 'Green')
+    ax2.plot(xax, resu['E'], label = 'Total')
+    ax2.plot(xax, resu['Ef'], label = 'Fossil')
+    ax2.plot(xax, resu['Eg'], label = 'Green')
 
     if not np.isnan(resu.year_peak):
         ax2.axvline(resu.year_peak, color = 'indianred', lw = 0.5, ls = ':')
@@ -1085,13 +1399,2816 @@ def plot_resu(resu, year_ini = None, title = None):
         ax2.axvline(resu.year_zero, color = 'forestgreen', lw = 0.5, ls = ':')
 
     if year_ini is not None:
-        plt.xlabel('year')
+        ax2.set_xlabel('year')
     else:
-        plt.xlabel('time')
-    plt.ylabel('Energy production')
-    plt.legend()
+        ax2.set_xlabel('time')
+    ax2.set_ylabel('Energy production')
+    ax2.legend()
     
     if title is not None:
-        plt.title(title)
+        ax2.set_title(title)
+
+    return fig, fig2
+
+
+################################################################################################################
+######################################## Ensembles and stochastic mode
+
+ensemble_vars = resu_vars + ['Ig_ratio', 'Eg_ratio']
+
+# Parameters perturbed in stochastic mode. 'beta' shifts the mean of the investment distribution (same units as beta_0), prices are perturbed multiplicatively (lognormal), growth additively.
+noise_vars = ['beta', 'gamma_g', 'gamma_f', 'growth']
+default_noise = {'beta': 0.1, 'gamma_g': 0.05, 'gamma_f': 0.05, 'growth': 0.005} # standard deviation of each perturbation
+
+
+def forward_step_batch(Y, Kg, Kf, params = default_params, rule = 'maxgreen', betafun_type = 'cdf', linear_gdp = None, coupling = None, Y_next = None):
+    """
+    Vectorized version of forward_step. State and parameters are arrays over ensemble members (or anything that broadcasts). rule can be an array of rules, one per member.
+
+    coupling is used by the multi-region model (see run_model_regions): state arrays have regions on the first axis, and energy production and/or investment are redistributed between regions.
+
+    If given, Y_next is the value of Y for the next step (from a resolved GDP driver, see gdp_path), instead of growing Y.
+
+    Returns the same outputs as forward_step, success being an integer array (0: running, 1: transition completed, 2: energy scarcity).
+    """
+    growth = params['growth']
+    eps = params['eps']
+    a = params['a']
+    b = params['b']
+    gamma_g = params['gamma_g']
+    gamma_f = params['gamma_f']
+    eta_g = params['eta_g']
+    eta_f = params['eta_f']
+    h_g = params['h_g']
+    h_f = params['h_f']
+    r_inv = params['r_inv']
+    beta_0 = params['beta_0']
+    delta_sig = params['delta_sig']
+    delta_g = params['delta_g']
+    delta_f = params['delta_f']
+    f_heavy = params['f_heavy']
+
+    Eg_max = a * Kg
+    Ef_max = b * Kf
+    E = eps * Y
+    if coupling is not None and 'energy' in coupling:
+        E = transfer(coupling['energy'], E)
+
+    success = np.where(Eg_max + Ef_max < E, 2, 0)
+
+    Eg, Ef = partition_energy(rule, E, Eg_max, Ef_max, Y, Kg, Kf, params)
+
+    success = np.where(E == Eg, 1, success)
+
+    ## Profit of energy production
+    Pg = gamma_g * (Eg - eta_g * Eg**h_g)
+    Pf = gamma_f * (Ef - eta_f * Ef**h_f)
+    Pf = np.where(Pf < 0., gamma_f * (1 - eta_f) * Ef, Pf)
+    Pg = np.where(Pg < 0., gamma_g * (1 - eta_g) * Eg, Pg)
+
+    ## Investment in energy production
+    pr = prof_ratio(Pg, Pf, Kg, Kf)
+    beta = beta_fun(beta_0, pr, delta_sig = delta_sig, ftype = betafun_type)
+
+    Ig = beta * r_inv * (Pg + Pf)
+    If = (1-beta) * r_inv * (Pg + Pf)
+    if coupling is not None and 'capital' in coupling:
+        Ig = transfer(coupling['capital'], Ig)
+        If = transfer(coupling['capital'], If)
+
+    Kg = Ig + Kg * (1-delta_g)
+    Kf = If + Kf * (1-delta_f)
+    if Y_next is not None:
+        Y = Y_next
+    elif linear_gdp is None:
+        Y = Y * (1+growth)
+    else:
+        Y = Y + linear_gdp
+
+    Kg, Kf, Eg, Ef, beta, E, Y = check_bounds_batch(Kg, Kf, Eg, Ef, beta, E, Y)
+
+    return Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, success
+
+
+def check_bounds_batch(Kg, Kf, Eg, Ef, beta, E, Y):
+    """
+    Same as check_bounds, but silently clips arrays of members.
+    """
+    Kg = np.maximum(Kg, 0.)
+    Kf = np.maximum(Kf, 0.)
+    E = np.maximum(E, 0.)
+    Eg = np.clip(Eg, 0., E)
+    Ef = np.clip(Ef, 0., E)
+    beta = np.clip(beta, 0., 1.)
+    Y = np.maximum(Y, 0.)
 
-    return fig, fig2
\ No newline at end of file
+    return Kg, Kf, Eg, Ef, beta, E, Y
+
+
+def member_seeds(seed, members):
+    """
+    Independent random streams for the ensemble members. 
+    
+    The stream of member m only depends on (seed, m), so the same member gets the same noise whatever the chunking of the ensemble across workers. Equivalent to np.random.SeedSequence(seed).spawn(n)[m].
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        seed = seed.entropy
+    return [np.random.SeedSequence(seed, spawn_key = (int(mem),)) for mem in members]
+
+
+def gen_noise(noise, n_iter, members, seed = None, autocorr = 0.):
+    """
+    Generates AR(1) perturbations for the stochastic mode.
+
+    noise is a dict with the standard deviation of the perturbation of each of noise_vars, autocorr is the lag-1 autocorrelation (a float or a dict with the same keys). The marginal standard deviation does not depend on autocorr.
+
+    Returns a dict of arrays of shape (n_iter, n_members).
+    """
+    for var in noise:
+        if var not in noise_vars: raise ValueError(f'Cannot add noise to {var}. Allowed: {noise_vars}')
+
+    # all variables are drawn in any case, so switching one on does not change the others
+    zz = np.stack([np.random.default_rng(ss).standard_normal((len(noise_vars), n_iter)) for ss in member_seeds(seed, members)], axis = -1)
+
+    phi = np.array([autocorr.get(var, 0.) if isinstance(autocorr, dict) else autocorr for var in noise_vars])[:, np.newaxis]
+    if np.any(np.abs(phi) >= 1): raise ValueError('autocorr should be between -1 and 1')
+
+    for i in range(1, n_iter):
+        zz[:, i] = phi * zz[:, i-1] + np.sqrt(1 - phi**2) * zz[:, i]
+
+    return {var: noise[var] * zz[noise_vars.index(var)] for var in noise}
+
+
+def apply_noise(params, noise_paths):
+    """
+    Perturbs resolved parameters (see resolve_params) with noise paths from gen_noise.
+    """
+    params = params.copy()
+    for var, zz in noise_paths.items():
+        if var == 'beta':
+            params['beta_0'] = params['beta_0'] + zz
+        elif var == 'growth':
+            params['growth'] = params['growth'] + zz
+        else:
+            params[var] = params[var] * np.exp(zz)
+
+    return params
+
+
+def resolve_params(params, years, members = None):
+    """
+    Converts params to arrays for a batched run. 
+    
+    Scalars are left as they are, DataArrays with a "member" dimension give an array over members, scenarios (DataArrays with a "year" dimension or arrays, as in run_model) give arrays of shape (n_iter, n_members) or (n_iter, 1). Scenarios are held constant after their last year.
+
+    members selects a subset of the member dimension (positional indices).
+    """
+    okpar = dict()
+    for par in default_params:
+        val = params[par]
+        if isinstance(val, xr.core.dataarray.DataArray) and 'member' in val.dims and members is not None:
+            val = val.isel(member = members)
+        okpar[par] = _param_array(val, years, ['member'])
+
+    return okpar
+
+
+def _param_array(val, years, dims):
+    """
+    Array of a parameter with axes (year, *dims), year only for scenarios. Dimensions missing in val have size 1, scalars are left as they are.
+    """
+    if isinstance(val, xr.core.dataarray.DataArray):
+        if 'year' in val.dims:
+            val = val.sel(year = np.minimum(years, val.year.max().values))
+        for dim in dims:
+            if dim not in val.dims: val = val.expand_dims(dim)
+        val = val.transpose(*((['year'] if 'year' in val.dims else []) + dims)).values
+    elif isinstance(val, np.ndarray) and val.ndim > 0:
+        val = val[:len(years)].reshape((-1,) + (1,)*len(dims))
+
+    return np.asarray(val, dtype = float)
+
+
+def _member_values(val, members):
+    if isinstance(val, xr.core.dataarray.DataArray):
+        if 'member' in val.dims: val = val.isel(member = members)
+        val = val.values
+    return np.asarray(val, dtype = float)
+
+
+def ensemble_size(params, inicond = None):
+    """
+    Number of members implied by the "member" dimension of params and inicond (None if there is none).
+    """
+    sizes = [val.sizes['member'] for val in list(params.values()) + list((inicond or {}).values()) if isinstance(val, xr.core.dataarray.DataArray) and 'member' in val.dims]
+    if len(set(sizes)) > 1: raise ValueError(f'Inconsistent member dimensions: {sizes}')
+
+    return sizes[0] if len(sizes) > 0 else None
+
+
+def run_batch(inicond, params, n_iter, n_members, rule = 'maxgreen', betafun_type = 'cdf', linear_gdp = None, out = None, gdp = None):
+    """
+    Runs the model for all members at once. params should be resolved (see resolve_params).
+
+    Returns an array of shape (len(ensemble_vars), n_members, n_iter) with the trajectories (only resu_vars are filled, see finalize_batch), the index of the last valid step and the success flag of each member. Members are stepped until the end, the steps after the last valid one are to be discarded (see run_model for the stopping conditions).
+
+    If given, out is filled in place. gdp is the GDP driver (see resolve_gdp, observed series should be already resolved): exogenous GDP is computed for all steps before running.
+    """
+    Y = np.broadcast_to(inicond['Y_ini'], (n_members,)).astype(float)
+    Kg = np.broadcast_to(inicond['Kg_ini'], (n_members,)).astype(float)
+    Kf = np.broadcast_to(inicond['Kf_ini'], (n_members,)).astype(float)
+
+    varying = [par for par in params if params[par].ndim == 2]
+    okpar = params.copy()
+
+    gdp = resolve_gdp(gdp, None, linear_gdp = linear_gdp)
+    Y_path = gdp_path(gdp, Y, params['growth'], n_iter)
+    if Y_path is None:
+        l_cap = gdp_capacity_factor(gdp, {'Y_ini': Y, 'Kg_ini': Kg, 'Kf_ini': Kf}, {par: params[par][0] if params[par].ndim == 2 else params[par] for par in ['a', 'b']})
+
+    if out is None:
+        out = np.empty((len(ensemble_vars), n_members, n_iter))
+    i_stop = np.full(n_members, n_iter - 1)
+    success = np.zeros(n_members, dtype = int)
+    running = np.ones(n_members, dtype = bool)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        for i in range(n_iter):
+            for par in varying:
+                okpar[par] = params[par][i]
+
+            Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, succ = forward_step_batch(Y, Kg, Kf, params = okpar, rule = rule, betafun_type = betafun_type, Y_next = None if Y_path is None else Y_path[i+1])
+            if Y_path is None:
+                Y = l_cap * (okpar['a'] * Kg + okpar['b'] * Kf)
+            for j, var in enumerate([Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf]):
+                out[j, :, i] = var
+
+            stop = running & (succ > 0)
+            i_stop[stop] = i
+            success[stop] = succ[stop]
+            running &= ~stop
+
+    return out, i_stop, success
+
+
+def finalize_batch(out, i_stop, extend_constant = False):
+    """
+    Masks the steps after the last valid one (nan, or repeating the last valid step if extend_constant) and computes Ig_ratio and Eg_ratio. Works in place on the output of run_batch.
+    """
+    n_iter = out.shape[2]
+    invalid = np.arange(n_iter)[np.newaxis, :] > i_stop[:, np.newaxis]
+    nvar = len(resu_vars)
+    if extend_constant:
+        last = np.take_along_axis(out[:nvar], i_stop[np.newaxis, :, np.newaxis], axis = 2)
+        np.copyto(out[:nvar], last, where = invalid[np.newaxis])
+    else:
+        out[:nvar, invalid] = np.nan
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        np.divide(out[6], out[6] + out[7], out = out[nvar])
+        np.divide(out[4], out[3], out = out[nvar + 1])
+
+    return out
+
+
+def event_years(Ef, i_stop, success):
+    """
+    Peak, halving and zero of fossil energy for each member, as in run_model (indices, nan if the transition is not completed).
+    """
+    n_members, n_iter = Ef.shape
+    steps = np.arange(n_iter)
+    valid = steps[np.newaxis, :] <= i_stop[:, np.newaxis]
+
+    i_peak = np.argmax(np.where(valid, Ef, -np.inf), axis = 1)
+    Ef_peak = Ef[np.arange(n_members), i_peak]
+    halved = valid & (steps[np.newaxis, :] >= i_peak[:, np.newaxis]) & (Ef <= Ef_peak[:, np.newaxis]/2.)
+    i_halved = np.where(halved.any(axis = 1), np.argmax(halved, axis = 1), i_stop)
+
+    ok = success == 1
+    year_zero = np.where(ok, i_stop, np.nan)
+    year_peak = np.where(ok, i_peak, np.nan)
+    year_halved = np.where(ok, i_halved, np.nan)
+
+    return year_zero, year_peak, year_halved
+
+
+def _ensemble_chunk(members, out, inicond, params, years, rule, betafun_type, linear_gdp, noise, autocorr, seed, extend_constant, gdp = None, noise_members = None):
+    """
+    Runs a chunk of consecutive members (positional indices) and writes it to out, which is either the whole output array or the (name, shape) of a shared memory block (see shared_array). Top level, so that it can be sent to worker processes.
+    """
+    n_members = len(members)
+    okpar = resolve_params(params, years, members = members)
+    if noise is not None:
+        streams = members if noise_members is None else np.asarray(noise_members)[members]
+        okpar = apply_noise(okpar, gen_noise(noise, len(years), streams, seed = seed, autocorr = autocorr))
+
+    ini = {ke: _member_values(inicond[ke], members) for ke in ['Y_ini', 'Kg_ini', 'Kf_ini']}
+    if not isinstance(rule, str):
+        rule = np.asarray(rule)[members]
+
+    shm = None
+    if isinstance(out, tuple):
+        shm, out = attach_shared(*out)
+
+    chunk_out = out[:, members[0]:members[-1]+1]
+    chunk_out, i_stop, success = run_batch(ini, okpar, len(years), n_members, rule = rule, betafun_type = betafun_type, linear_gdp = linear_gdp, out = chunk_out, gdp = gdp)
+    finalize_batch(chunk_out, i_stop, extend_constant = extend_constant)
+
+    if shm is not None:
+        del out, chunk_out
+        shm.close()
+
+    return i_stop, success
+
+
+def run_ensemble(inicond = default_inicond, params = default_params, n_iter = 100, n_members = None, rule = 'maxgreen', betafun_type = 'cdf', year_ini = None, noise = None, autocorr = 0., seed = None, backend = 'serial', n_workers = None, chunk_size = None, extend_constant = False, linear_gdp = None, verbose = False, gdp = None, noise_members = None, progress = None):
+    """
+    Runs an ensemble of model simulations, vectorized over members.
+
+    Members are defined by a "member" dimension in any of params or inicond (DataArrays), and/or by n_members. Parameter scenarios along "year" work as in run_model. rule can be a list with a rule for each member (see also run_rules).
+
+    Stochastic mode: noise is a dict with the standard deviation of the perturbations of beta, gamma_g, gamma_f and growth (see noise_vars and default_noise), autocorr their lag-1 autocorrelation (float or dict). Each member has its own random stream derived from seed (see member_seeds), so results are bitwise identical for any backend, n_workers and chunk_size. noise_members (one index per member) sets the stream of each member instead: members with the same index get the same noise (see run_rules).
+
+    Chunks of members are run with the chosen backend (see map_tasks). With the 'process' backend, workers write the trajectories directly to a shared memory block and the output Dataset is a view on it (no copies). If given, progress(n) is called with the number of members of each completed chunk.
+
+    Members stop as in run_model, after the transition is completed or at energy scarcity. Following steps are nan, or repeat the last valid step if extend_constant is set.
+
+    gdp selects the GDP driver (see resolve_gdp), default: growth with params['growth'] (or linear_gdp).
+
+    Returns a Dataset with "member" and "year" dimensions. year_zero, year_peak and year_halved are variables along "member".
+    """
+    if year_ini is None:
+        raise ValueError(f'{year_ini} not set!')
+
+    n_par = ensemble_size(params, inicond)
+    if n_members is None:
+        if n_par is None: raise ValueError('n_members not set and no member dimension in params/inicond!')
+        n_members = n_par
+    elif n_par is not None and n_par != n_members:
+        raise ValueError(f'n_members = {n_members}, but params/inicond have {n_par} members')
+
+    if noise is not None and seed is None:
+        # fixed here so that all workers share it
+        seed = np.random.SeedSequence().entropy
+
+    years = np.arange(year_ini, year_ini + n_iter)
+    gdp = resolve_gdp(gdp, years, linear_gdp = linear_gdp)
+    chunks = member_chunks(n_members, backend = backend, n_workers = n_workers, chunk_size = chunk_size)
+
+    shape = (len(ensemble_vars), n_members, n_iter)
+    if backend == 'process':
+        out, shm_name = shared_array(shape)
+        out_spec = (shm_name, shape)
+    else:
+        out = np.empty(shape)
+        out_spec = out
+
+    if verbose: print(f'Running {n_members} members in {len(chunks)} chunks ({backend})')
+
+    if noise_members is not None and len(noise_members) != n_members:
+        raise ValueError(f'noise_members has {len(noise_members)} elements for {n_members} members')
+
+    tasks = [(chunk, out_spec, inicond, params, years, rule, betafun_type, linear_gdp, noise, autocorr, seed, extend_constant, gdp, noise_members) for chunk in chunks]
+    flags = map_tasks(_ensemble_chunk, tasks, backend = backend, n_workers = n_workers, progress = None if progress is None else lambda i: progress(len(chunks[i])))
+
+    i_stop = np.concatenate([fl[0] for fl in flags])
+    success = np.concatenate([fl[1] for fl in flags])
+
+    return build_ensemble_ds(out, i_stop, success, years)
+
+
+def build_ensemble_ds(out, i_stop, success, years, members = None):
+    """
+    Wraps the (finalized) output of run_batch in a Dataset, without copying it.
+    """
+    n_members = out.shape[1]
+
+    data_vars = {vnam: (['member', 'year'], out[j]) for j, vnam in enumerate(ensemble_vars)}
+
+    year_zero, year_peak, year_halved = event_years(out[5], i_stop, success)
+    data_vars['success'] = (['member'], success == 1)
+    data_vars['year_zero'] = (['member'], year_zero + years[0])
+    data_vars['year_peak'] = (['member'], year_peak + years[0])
+    data_vars['year_halved'] = (['member'], year_halved + years[0])
+
+    if members is None: members = np.arange(n_members)
+
+    return xr.Dataset(data_vars = data_vars, coords = {'member': members, 'year': years})
+
+
+def run_rules(rules = None, inicond = default_inicond, params = default_params, n_iter = 100, year_ini = None, n_members = None, **kwargs):
+    """
+    Runs the same scenario (or ensemble) with several rules for energy partition (default: all rules in partition_rules) in a single batched run.
+
+    kwargs are passed to run_ensemble. In stochastic mode, member m gets the same noise for all rules, so that rules are compared on paired runs.
+
+    Returns a Dataset with a "rule" dimension (and "member", if params or inicond have one or n_members is set).
+    """
+    if rules is None: rules = list(partition_rules)
+
+    n_par = ensemble_size(params, inicond)
+    n_mem = n_par if n_par is not None else (n_members if n_members is not None else 1)
+
+    # members are ordered as (rule, member)
+    tile = lambda val: xr.concat([val]*len(rules), dim = 'member') if isinstance(val, xr.core.dataarray.DataArray) and 'member' in val.dims else val
+    params_all = {par: tile(val) for par, val in params.items()}
+    inicond_all = {ke: tile(val) for ke, val in inicond.items()}
+    rule_all = np.repeat(rules, n_mem)
+
+    ens = run_ensemble(inicond = inicond_all, params = params_all, n_iter = n_iter, year_ini = year_ini, n_members = len(rules)*n_mem, rule = rule_all, noise_members = np.tile(np.arange(n_mem), len(rules)), **kwargs)
+
+    ds = xr.concat([ens.isel(member = slice(i*n_mem, (i+1)*n_mem)).assign_coords(member = np.arange(n_mem)) for i in range(len(rules))], dim = 'rule')
+    ds = ds.assign_coords(rule = rules)
+    if n_par is None and n_members is None:
+        ds = ds.isel(member = 0, drop = True)
+
+    return ds
+
+
+################################################################################################################
+######################################## Execution backends
+
+backends = ['serial', 'thread', 'process']
+
+
+def map_tasks(func, tasks, backend = 'serial', n_workers = None, progress = None):
+    """
+    Applies func to each task (a tuple of arguments) with the chosen backend:
+        - 'serial': in a loop;
+        - 'thread': in a thread pool (numpy releases the GIL on large arrays);
+        - 'process': in a process pool. func must be defined at module level.
+
+    If given, progress(i) is called with the index of each task when it is completed.
+
+    Returns the list of results, in the order of tasks.
+    """
+    if backend not in backends:
+        raise ValueError(f'Unknown backend {backend}. Allowed: {backends}')
+
+    if backend == 'serial' or len(tasks) <= 1:
+        results = []
+        for i, task in enumerate(tasks):
+            results.append(func(*task))
+            if progress is not None: progress(i)
+        return results
+
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+    executor = ThreadPoolExecutor if backend == 'thread' else ProcessPoolExecutor
+    with executor(max_workers = n_workers) as pool:
+        futures = {pool.submit(func, *task): i for i, task in enumerate(tasks)}
+        if progress is not None:
+            for fut in as_completed(futures):
+                progress(futures[fut])
+        return [fut.result() for fut in futures]
+
+
+def member_chunks(n_members, backend = 'serial', n_workers = None, chunk_size = None):
+    """
+    Splits members in chunks of consecutive indices, one per worker by default.
+    """
+    if chunk_size is None:
+        if backend == 'serial':
+            n_workers = 1
+        elif n_workers is None:
+            n_workers = os.cpu_count()
+        chunk_size = int(np.ceil(n_members/n_workers))
+
+    return [np.arange(i, min(i + chunk_size, n_members)) for i in range(0, n_members, chunk_size)]
+
+
+def shared_array(shape, dtype = float):
+    """
+    Allocates an array in a multiprocessing.shared_memory block. Returns the array and the name of the block, that workers can open with attach_shared.
+
+    The block is released when the array and all its views (e.g. Datasets built on it) are deleted.
+    """
+    from multiprocessing import shared_memory
+    import weakref
+
+    nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    shm = shared_memory.SharedMemory(create = True, size = nbytes)
+    arr = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+    weakref.finalize(arr, _release_shared, shm)
+
+    return arr, shm.name
+
+
+def attach_shared(name, shape, dtype = float):
+    """
+    Opens a block allocated by shared_array. Returns the SharedMemory object (to be closed after deleting the array) and the array.
+    """
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name = name)
+    arr = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+    return shm, arr
+
+
+def _release_shared(shm):
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+################################################################################################################
+######################################## Scenario specs and server
+
+param_sets = {'default_params': default_params, 'best_params': best_params, 'best_params_old': best_params_old, 'best_params_old_Iw1': best_params_old_Iw1}
+betafun_types = ['cdf', 'sigmoid']
+
+
+def scenario_curve(curve, years = None):
+    """
+    Converts a dict {year: value} to a DataArray scenario with annual values, linearly interpolated between the given years (and held constant outside them).
+    """
+    yrs = np.array([int(ye) for ye in curve.keys()])
+    vals = np.array([float(va) for va in curve.values()])
+    order = np.argsort(yrs)
+    yrs, vals = yrs[order], vals[order]
+    if years is None:
+        years = np.arange(yrs[0], yrs[-1] + 1)
+
+    return xr.DataArray(np.interp(years, yrs, vals), dims = ['year'], coords = {'year': years})
+
+
+def scenario_from_spec(spec):
+    """
+    Reads a scenario spec (a dict, as in a json or yaml file):
+        - base: name of the starting parameter set (see param_sets), default 'best_params';
+        - params: values changed from base. A value can be a dict {year: value} for a scenario (see scenario_curve);
+        - inicond: initial conditions, default inicond_yr(year_ini);
+        - year_ini (default 2015), n_iter (100), rule ('maxgreen', see partition_rules), betafun_type ('cdf', see betafun_types);
+        - vars: output variables (see ensemble_vars), used by ScenarioServer.
+
+    Returns the inicond, the params and a dict with the other arguments of run_model. Raises ValueError on bad specs.
+    """
+    unknown = set(spec) - {'name', 'base', 'params', 'inicond', 'year_ini', 'n_iter', 'rule', 'betafun_type', 'vars'}
+    if len(unknown) > 0: raise ValueError(f'Unknown keys in scenario: {unknown}')
+
+    base = spec.get('base', 'best_params')
+    if base not in param_sets: raise ValueError(f'Unknown base {base}. Allowed: {list(param_sets)}')
+    params = param_sets[base].copy()
+
+    for par, val in spec.get('params', {}).items():
+        if par not in default_params: raise ValueError(f'Unknown param {par}')
+        params[par] = scenario_curve(val) if isinstance(val, dict) else float(val)
+
+    run_kw = {'year_ini': int(spec.get('year_ini', 2015)), 'n_iter': int(spec.get('n_iter', 100)), 'rule': spec.get('rule', 'maxgreen'), 'betafun_type': spec.get('betafun_type', 'cdf')}
+    if run_kw['rule'] not in partition_rules: raise ValueError(f'Unknown rule {run_kw["rule"]}. Allowed: {list(partition_rules)}')
+    if run_kw['betafun_type'] not in betafun_types: raise ValueError(f'Unknown betafun_type {run_kw["betafun_type"]}. Allowed: {betafun_types}')
+    if run_kw['n_iter'] < 1: raise ValueError('n_iter should be positive')
+
+    unknown = set(spec.get('vars', None) or []) - set(ensemble_vars)
+    if len(unknown) > 0: raise ValueError(f'Unknown vars {unknown}. Allowed: {ensemble_vars}')
+
+    inicond = spec.get('inicond', None)
+    if inicond is None:
+        inicond = inicond_yr(run_kw['year_ini'])
+    elif set(inicond) != {'Y_ini', 'Kg_ini', 'Kf_ini'}:
+        raise ValueError(f'inicond should have keys Y_ini, Kg_ini and Kf_ini, got {list(inicond)}')
+    else:
+        inicond = {ke: float(va) for ke, va in inicond.items()}
+
+    return inicond, params, run_kw
+
+
+def stack_members(params_list, years):
+    """
+    Merges a list of params (or iniconds) in a single one with a "member" dimension. Values equal for all members are left as they are, scenarios are aligned on years.
+    """
+    stacked = dict()
+    for par in params_list[0]:
+        vals = [pars[par] for pars in params_list]
+        if any(isinstance(va, xr.core.dataarray.DataArray) for va in vals):
+            vals = [va.sel(year = np.clip(years, va.year.min().values, va.year.max().values)).assign_coords(year = years) if isinstance(va, xr.core.dataarray.DataArray) else xr.DataArray(np.full(len(years), float(va)), dims = ['year'], coords = {'year': years}) for va in vals]
+            stacked[par] = xr.concat(vals, dim = 'member').transpose('member', 'year')
+        elif all(np.all(va == vals[0]) for va in vals):
+            stacked[par] = vals[0]
+        else:
+            stacked[par] = xr.DataArray(np.array(vals, dtype = float), dims = ['member'])
+
+    return stacked
+
+
+def run_scenarios(specs, backend = 'serial', n_workers = None, chunk_size = None, progress = None):
+    """
+    Runs a list of scenario specs (see scenario_from_spec). Scenarios sharing year_ini, n_iter and betafun_type are run together as a single ensemble (rules can differ), in chunks of chunk_size scenarios (see run_ensemble). If given, progress(n) is called with the number of scenarios of each completed chunk.
+
+    Returns a list of Datasets, one per spec.
+    """
+    groups = dict()
+    for i, spec in enumerate(specs):
+        inicond, params, run_kw = scenario_from_spec(spec)
+        rule = run_kw.pop('rule')
+        key = tuple(run_kw.items())
+        groups.setdefault(key, []).append((i, inicond, params, rule))
+
+    results = [None]*len(specs)
+    for key, members in groups.items():
+        run_kw = dict(key)
+        years = np.arange(run_kw['year_ini'], run_kw['year_ini'] + run_kw['n_iter'])
+        inicond = stack_members([mem[1] for mem in members], years)
+        params = stack_members([mem[2] for mem in members], years)
+        rules = [mem[3] for mem in members]
+        ens = run_ensemble(inicond = inicond, params = params, n_members = len(members), rule = rules, backend = backend, n_workers = n_workers, chunk_size = chunk_size, progress = progress, **run_kw)
+        for j, mem in enumerate(members):
+            results[mem[0]] = ens.isel(member = j)
+
+    return results
+
+
+def _resu_to_json(resu, var_names = None):
+    if var_names is None: var_names = ensemble_vars
+    nonan = lambda x: None if np.isnan(x) else float(x)
+
+    out = {'year': resu.year.values.tolist()}
+    for var in var_names:
+        out[var] = [nonan(x) for x in resu[var].values]
+    for var in ['year_zero', 'year_peak', 'year_halved']:
+        out[var] = nonan(resu[var].values)
+    out['success'] = bool(resu['success'].values)
+
+    return out
+
+
+class ScenarioServer:
+    """
+    Local server for many small scenario requests (e.g. from dashboards or interactive widgets).
+
+    Requests arriving within window seconds from each other are coalesced in a single batched model run (see run_scenarios). Results are kept in a LRU cache of cache_size entries, and identical requests in flight are only computed once.
+
+    Protocol: HTTP on host:port, or on a Unix socket if path is given.
+        - POST /run with a json scenario spec (see scenario_from_spec, plus an optional "vars" list of output variables), or a list of specs (each failed spec gives {"error": ...} in the list);
+        - GET /stats for the number of requests, cache hits, batch sizes and latency percentiles.
+    """
+
+    def __init__(self, window = 0.02, max_batch = 4096, cache_size = 10000, backend = 'serial', n_workers = None, max_latencies = 10000):
+        from collections import OrderedDict, deque
+
+        self.window = window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.backend = backend
+        self.n_workers = n_workers
+
+        self.cache = OrderedDict()
+        self.pending = dict()
+        self.inflight = dict()
+        self.flush_handle = None
+        self.tasks = set() # running batches, referenced until they are done
+        self.latencies = deque(maxlen = max_latencies)
+        self.n_requests = 0
+        self.n_cached = 0
+        self.batch_sizes = []
+
+    async def submit(self, spec):
+        """
+        Returns the result of a single scenario spec. Bad specs raise here, before joining a batch. Latency is recorded for failed requests too.
+        """
+        import asyncio, json, time
+
+        t0 = time.perf_counter()
+        self.n_requests += 1
+
+        try:
+            scenario_from_spec(spec)
+            spec = dict(spec)
+            var_names = spec.pop('vars', None)
+            key = json.dumps(spec, sort_keys = True)
+
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.n_cached += 1
+                resu = self.cache[key]
+            else:
+                if key not in self.inflight:
+                    self.inflight[key] = asyncio.get_running_loop().create_future()
+                    self.pending[key] = spec
+                    if len(self.pending) >= self.max_batch:
+                        self._flush()
+                    elif self.flush_handle is None:
+                        self.flush_handle = asyncio.get_running_loop().call_later(self.window, self._flush)
+                resu = await asyncio.shield(self.inflight[key])
+
+            return _resu_to_json(resu, var_names)
+        finally:
+            self.latencies.append(time.perf_counter() - t0)
+
+    def _flush(self):
+        import asyncio
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if len(self.pending) == 0: return
+
+        batch = self.pending
+        self.pending = dict()
+        self.batch_sizes.append(len(batch))
+        task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_batch(self, batch):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        keys = list(batch)
+        try:
+            results = await loop.run_in_executor(None, run_scenarios, list(batch.values()), self.backend, self.n_workers)
+        except Exception:
+            # one bad scenario should not fail the others: they are run one by one
+            results = []
+            for ke in keys:
+                try:
+                    results.append((await loop.run_in_executor(None, run_scenarios, [batch[ke]], self.backend, self.n_workers))[0])
+                except Exception as exc:
+                    results.append(exc)
+
+        for ke, resu in zip(keys, results):
+            if isinstance(resu, Exception):
+                self.inflight.pop(ke).set_exception(resu)
+                continue
+            resu = resu.copy(deep = True)
+            self.cache[ke] = resu
+            self.inflight.pop(ke).set_result(resu)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+
+    def stats(self):
+        """
+        Number of requests, cache hits, batches and latency percentiles (ms).
+        """
+        lat = 1000*np.array(self.latencies)
+        stats = {'requests': self.n_requests, 'cache_hits': self.n_cached, 'batches': len(self.batch_sizes), 'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0., 'cache_size': len(self.cache)}
+        for perc in [50, 90, 99]:
+            stats[f'latency_p{perc}_ms'] = float(np.percentile(lat, perc)) if len(lat) > 0 else None
+
+        return stats
+
+    async def handle(self, reader, writer):
+        """
+        Minimal HTTP/1.1 handler (one request per connection).
+        """
+        import asyncio, json
+
+        status = '200 OK'
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = dict()
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if line == '': break
+                ke, va = line.split(':', 1)
+                headers[ke.strip().lower()] = va.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            method, route = request_line[:2]
+            if method == 'GET' and route == '/stats':
+                out = self.stats()
+            elif method == 'POST' and route == '/run':
+                specs = json.loads(body)
+                if isinstance(specs, list):
+                    # errors are returned for the failed specs only
+                    out = await asyncio.gather(*[self.submit(spec) for spec in specs], return_exceptions = True)
+                    out = [{'error': repr(res)} if isinstance(res, Exception) else res for res in out]
+                else:
+                    out = await self.submit(specs)
+            else:
+                status = '404 Not Found'
+                out = {'error': f'Unknown route {method} {route}'}
+        except Exception as exc:
+            status = '400 Bad Request'
+            out = {'error': repr(exc)}
+
+        payload = json.dumps(out).encode()
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def start(self, host = '127.0.0.1', port = 8765, path = None):
+        import asyncio
+
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path = path)
+        else:
+            return await asyncio.start_server(self.handle, host = host, port = port)
+
+
+def serve(host = '127.0.0.1', port = 8765, path = None, **kwargs):
+    """
+    Runs a ScenarioServer until interrupted. kwargs are passed to ScenarioServer.
+    """
+    import asyncio
+
+    async def main():
+        server = await ScenarioServer(**kwargs).start(host = host, port = port, path = path)
+        print(f'Serving scenarios on {path if path is not None else f"http://{host}:{port}"}')
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+################################################################################################################
+######################################## Technology-vector model
+
+# Placeholder values (same as default_params) for a split of the energy sector in technologies, to be calibrated. "green" technologies have priority with rule maxgreen (nuclear counts as low-carbon here).
+default_techs = {'tech': ['coal', 'gas', 'oil', 'solar', 'wind', 'nuclear'],
+                 'green': [False, False, False, True, True, True],
+                 'a': [1., 1., 1., 1., 1., 1.], # Energy production per unit of capital
+                 'gamma': [0.5, 0.5, 0.5, 0.5, 0.5, 0.5], # Energy price
+                 'eta': [0.2, 0.2, 0.2, 0.2, 0.2, 0.2], # eta*gamma : Costs of energy production
+                 'h': [0.5, 0.5, 0.5, 0.5, 0.5, 0.5], # Exponent for cost scaling with energy
+                 'delta': [0.01, 0.01, 0.01, 0.01, 0.01, 0.01], # Depreciation of capital
+                 'beta_0': [0., 0., 0., 0., 0., 0.], # Preference for each technology (e.g. subsidies). Only differences between technologies matter
+                 }
+
+
+def techs_from_params(params = default_params):
+    """
+    The two-sector model (green, fossil) written as technologies. run_model_tech with these gives the same results as run_model, for all rules but whole_capacity (where run_model clips production to demand).
+    """
+    techs = {'tech': ['green', 'fossil'], 'green': [True, False]}
+    techs['a'] = [params['a'], params['b']]
+    for tpar in ['gamma', 'eta', 'h', 'delta']:
+        techs[tpar] = [params[f'{tpar}_g'], params[f'{tpar}_f']]
+    techs['beta_0'] = [params['beta_0'], 0.]
+
+    return techs
+
+
+def _tech_arrays(techs):
+    techs = {ke: np.asarray(va) for ke, va in techs.items()}
+    techs['green'] = techs['green'].astype(bool)
+    return techs
+
+
+tech_partition_rules = dict()
+
+def _split_groups(E_max, green, Eg, Ef):
+    """
+    Splits the energy of the green (Eg) and fossil (Ef) groups between their technologies, proportionally to capacity.
+    """
+    Eg_max = np.sum(np.where(green, E_max, 0.), axis = -1, keepdims = True)
+    Ef_max = np.sum(np.where(green, 0., E_max), axis = -1, keepdims = True)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        En = np.where(green, np.nan_to_num(E_max/Eg_max) * Eg, np.nan_to_num(E_max/Ef_max) * Ef)
+    return En
+
+
+def partition_groups(rule, E, E_max, K, green, Y, params):
+    """
+    Applies a rule of partition_rules (two-sector model) to the totals of the green and fossil technologies, then splits each group proportionally to capacity. Used by forward_step_tech for rules that are not in tech_partition_rules.
+    """
+    expand = lambda val: np.asarray(val)[..., np.newaxis] if np.ndim(val) > 0 else val
+    Eg_max = np.sum(np.where(green, E_max, 0.), axis = -1, keepdims = True)
+    Ef_max = np.sum(np.where(green, 0., E_max), axis = -1, keepdims = True)
+    Kg = np.sum(np.where(green, K, 0.), axis = -1, keepdims = True)
+    Kf = np.sum(np.where(green, 0., K), axis = -1, keepdims = True)
+    Eg, Ef = partition_rules[rule](E, Eg_max, Ef_max, expand(Y), Kg, Kf, {par: expand(val) for par, val in params.items()})
+
+    return _split_groups(E_max, green, Eg, Ef)
+
+
+@register_rule('maxgreen', registry = tech_partition_rules)
+def tech_rule_maxgreen(E, E_max, K, green):
+    """
+    Green technologies produce at full capacity (scaled down proportionally if they exceed demand), fossil ones cover the rest proportionally to their capacity.
+    """
+    Eg_max = np.sum(np.where(green, E_max, 0.), axis = -1, keepdims = True)
+    Eg = np.minimum(Eg_max, E)
+    Ef = np.where(Eg_max > E, 0., E - Eg_max)
+    return _split_groups(E_max, green, Eg, Ef)
+
+
+@register_rule('proportional', registry = tech_partition_rules)
+def tech_rule_proportional(E, E_max, K, green):
+    """
+    Demand split proportionally to capital.
+    """
+    return K/np.sum(K, axis = -1, keepdims = True) * E
+
+
+@register_rule('whole_capacity', registry = tech_partition_rules)
+def tech_rule_whole_capacity(E, E_max, K, green):
+    """
+    All capacity is used.
+    """
+    return E_max
+
+
+def beta_tech(beta_0, prof_ratios, delta_sig = 1.):
+    """
+    Multinomial generalization of beta_fun: share of investment going to each technology (last axis).
+
+    Each technology competes with the rest of the sector ("one vs rest"): its weight is the cdf of beta_fun, with displacement given by its preference relative to the mean of the other technologies plus its profit ratio (see prof_ratio_tech). Weights are then normalized to 1. With two technologies this is exactly beta_fun.
+    """
+    n_tech = np.shape(prof_ratios)[-1]
+    beta_0 = np.broadcast_to(beta_0, np.shape(prof_ratios))
+    shift = beta_0 - (np.sum(beta_0, axis = -1, keepdims = True) - beta_0)/(n_tech - 1)
+    weights = cdf(0., mu = -(shift + prof_ratios), sigma = np.asarray(delta_sig)[..., np.newaxis])
+
+    return weights/np.sum(weights, axis = -1, keepdims = True)
+
+
+def prof_ratio_tech(P, K):
+    """
+    Generalizes prof_ratio: profit per unit capital of each technology compared to that of the rest of the sector.
+    """
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        p_tech = np.where(K > 0, P/K, 0.)
+        p_rest = (np.sum(P, axis = -1, keepdims = True) - P)/(np.sum(K, axis = -1, keepdims = True) - K)
+        p_rest = np.where(np.isfinite(p_rest), p_rest, 0.)
+        pr = np.where(p_tech + p_rest > 0, (p_tech - p_rest)/(p_tech + p_rest), 0.)
+
+    return pr
+
+
+def forward_step_tech(Y, K, techs, params = default_params, rule = 'maxgreen'):
+    """
+    A single iteration of the technology-vector model. K has technologies on the last axis, leading axes (e.g. members) broadcast with Y and with the parameters.
+
+    techs is a dict of arrays over technologies (see default_techs), params gives the global parameters (eps, r_inv, delta_sig, growth, and those of the rule).
+
+    rule is taken from tech_partition_rules, or else from partition_rules, applied to the green and fossil groups (see partition_groups).
+
+    Returns Y, K, E, En, I, P, success (En, I, P are energy, investment and profit of each technology).
+    """
+    eps = np.asarray(params['eps'])
+    r_inv = np.asarray(params['r_inv'])
+    growth = params['growth']
+    green = techs['green']
+
+    E_max = techs['a'] * K
+    E = (eps * Y)[..., np.newaxis]
+
+    success = np.where(np.sum(E_max, axis = -1) < E[..., 0], 2, 0)
+
+    if rule in tech_partition_rules:
+        En = tech_partition_rules[rule](E, E_max, K, green)
+    elif rule in partition_rules:
+        En = partition_groups(rule, E, E_max, K, green, Y, params)
+    else:
+        raise ValueError(f'Unknown rule {rule}. Allowed: {list(tech_partition_rules) + [ru for ru in partition_rules if ru not in tech_partition_rules]}')
+
+    success = np.where(np.sum(np.where(green, 0., En), axis = -1) == 0., 1, success)
+
+    ## Profit of energy production
+    P = techs['gamma'] * (En - techs['eta'] * En**techs['h'])
+    P = np.where(P < 0., techs['gamma'] * (1 - techs['eta']) * En, P)
+
+    ## Investment in energy production
+    beta = beta_tech(techs['beta_0'], prof_ratio_tech(P, K), delta_sig = params['delta_sig'])
+    I = beta * (r_inv * np.sum(P, axis = -1))[..., np.newaxis]
+
+    K = np.maximum(I + K * (1 - techs['delta']), 0.)
+    Y = Y * (1 + growth)
+
+    return Y, K, E[..., 0], En, I, P, success
+
+
+def run_model_tech(inicond, techs = default_techs, params = default_params, n_iter = 100, rule = 'maxgreen', year_ini = None, n_members = None):
+    """
+    Runs the technology-vector model. inicond has Y_ini and K_ini (capital of each technology).
+
+    Members (n_members) are set by arrays with a leading member axis in inicond, techs or params. Members stop as in run_model (following steps are nan).
+
+    Returns a Dataset with "year" and "tech" dimensions (and "member"). Eg_ratio is the share of green technologies.
+    """
+    if year_ini is None:
+        raise ValueError(f'{year_ini} not set!')
+
+    techs = _tech_arrays(techs)
+    n_tech = len(techs['tech'])
+    shape = (n_tech,) if n_members is None else (n_members, n_tech)
+
+    Y = np.broadcast_to(np.asarray(inicond['Y_ini'], dtype = float), shape[:-1]).copy()
+    K = np.broadcast_to(np.asarray(inicond['K_ini'], dtype = float), shape).copy()
+
+    out_tech = {var: np.empty(shape[:-1] + (n_iter, n_tech)) for var in ['K', 'En', 'I', 'P']}
+    out = {var: np.empty(shape[:-1] + (n_iter,)) for var in ['Y', 'E']}
+    i_stop = np.full(shape[:-1], n_iter - 1)
+    success = np.zeros(shape[:-1], dtype = int)
+    running = np.ones(shape[:-1], dtype = bool)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        for i in range(n_iter):
+            Y, K, E, En, I, P, succ = forward_step_tech(Y, K, techs, params = params, rule = rule)
+            for var, val in zip(['K', 'En', 'I', 'P'], [K, En, I, P]):
+                out_tech[var][..., i, :] = val
+            out['Y'][..., i] = Y
+            out['E'][..., i] = E
+
+            stop = running & (succ > 0)
+            i_stop = np.where(stop, i, i_stop)
+            success = np.where(stop, succ, success)
+            running = running & ~stop
+
+    invalid = np.arange(n_iter) > i_stop[..., np.newaxis]
+    for var in out: out[var][invalid] = np.nan
+    for var in out_tech: out_tech[var][invalid] = np.nan
+
+    Eg = np.sum(np.where(techs['green'], out_tech['En'], 0.), axis = -1)
+    Ef = np.sum(np.where(techs['green'], 0., out_tech['En']), axis = -1)
+
+    dims = ['year'] if n_members is None else ['member', 'year']
+    years = np.arange(year_ini, year_ini + n_iter)
+    data_vars = {var: (dims, out[var]) for var in out}
+    data_vars.update({var: (dims + ['tech'], out_tech[var]) for var in out_tech})
+    data_vars['Eg_ratio'] = (dims, Eg/out['E'])
+    data_vars['Ef'] = (dims, Ef)
+
+    year_zero, year_peak, year_halved = event_years(np.atleast_2d(Ef), np.atleast_1d(i_stop), np.atleast_1d(success))
+    for var, val in zip(['year_zero', 'year_peak', 'year_halved'], [year_zero, year_peak, year_halved]):
+        data_vars[var] = (dims[:-1], (val + year_ini).reshape(np.shape(i_stop)))
+    data_vars['success'] = (dims[:-1], success == 1)
+
+    return xr.Dataset(data_vars = data_vars, coords = {'year': years, 'tech': techs['tech'], 'green': ('tech', techs['green'])})
+
+
+################################################################################################################
+######################################## Multi-region model
+
+def coupling_matrix(flows, regions):
+    """
+    Sparse coupling matrix between regions from a dict {(from_region, to_region): fraction}: each year, fraction of the quantity of from_region is moved to to_region.
+
+    Element [i, j] of the matrix is the fraction moved from region j to region i (the diagonal is not used).
+    """
+    from scipy import sparse
+
+    regions = list(regions)
+    rows = [regions.index(to) for (fr, to) in flows]
+    cols = [regions.index(fr) for (fr, to) in flows]
+    mat = sparse.csr_matrix((np.array(list(flows.values()), dtype = float), (rows, cols)), shape = (len(regions), len(regions)))
+    mat.setdiag(0.)
+    mat.eliminate_zeros()
+
+    outflow = np.asarray(mat.sum(axis = 0)).ravel()
+    if np.any(outflow > 1): raise ValueError('Total fraction moved out of a region is larger than 1!')
+
+    return mat
+
+
+def transfer(mat, X):
+    """
+    Moves quantity X (regions on the first axis) between regions following coupling matrix mat (see coupling_matrix). The total over regions is conserved.
+    """
+    outflow = np.asarray(mat.sum(axis = 0)).reshape((-1,) + (1,)*(np.ndim(X) - 1))
+    return X - outflow * X + mat @ X
+
+
+def inicond_regions(Eg_ratio_ini, Y_ini = 1.):
+    """
+    Initial conditions for run_model_regions from the regional share of green energy (and GDP), as in inicond_yr.
+    """
+    return {'Y_ini': Y_ini, 'Kg_ini': Eg_ratio_ini * Y_ini, 'Kf_ini': (1 - Eg_ratio_ini) * Y_ini/fossil_capacity_util}
+
+
+def _align_regions(val, regions, name):
+    """
+    Selects the regions of a DataArray with a "region" dimension by label, in the order of regions. Raises if regions are missing or extra.
+    """
+    if not isinstance(val, xr.core.dataarray.DataArray) or 'region' not in val.dims:
+        return val
+
+    labels = val.region.values.tolist()
+    missing = [reg for reg in regions if reg not in labels]
+    extra = [reg for reg in labels if reg not in list(regions)]
+    if missing or extra:
+        raise ValueError(f'{name}: regions {missing} missing and {extra} not in regions')
+
+    return val.sel(region = list(regions))
+
+
+def run_model_regions(inicond, params = default_params, regions = None, n_iter = 100, year_ini = None, coupling = None, rule = 'maxgreen', betafun_type = 'cdf', n_members = None):
+    """
+    Runs the model for many regions at once.
+
+    Any parameter and initial condition (see inicond_regions) can be a DataArray with a "region" dimension, and also "member" (ensemble) and "year" (scenarios, as in run_model). They are aligned to regions by label (by default, the regions of the first one), and must have exactly the same regions.
+
+    coupling is a dict with sparse matrices (see coupling_matrix) for:
+        - 'energy': part of the energy demand of a region is produced in another one;
+        - 'capital': part of the investment in energy of a region goes to another one.
+
+    Since regions interact, they are not stopped at the end of their transition (year_zero is the first year with no fossil energy). A region that runs into energy scarcity is stopped as in run_model: its state is held at its last value (for the coupling with other regions) and its outputs are nan afterwards, with success False.
+
+    Returns a Dataset with "region" and "year" dimensions (and "member").
+    """
+    if year_ini is None:
+        raise ValueError(f'{year_ini} not set!')
+
+    if regions is None:
+        regions = [val.region.values for val in list(params.values()) + list(inicond.values()) if isinstance(val, xr.core.dataarray.DataArray) and 'region' in val.dims][0]
+    regions = list(regions)
+    n_region = len(regions)
+    params = {par: _align_regions(val, regions, par) for par, val in params.items()}
+    inicond = {var: _align_regions(val, regions, var) for var, val in inicond.items()}
+
+    if n_members is None:
+        n_members = ensemble_size(params, inicond)
+    dims = ['region', 'member']
+    shape = (n_region, 1 if n_members is None else n_members)
+
+    years = np.arange(year_ini, year_ini + n_iter)
+    okpar = {par: _param_array(params[par], years, dims) for par in default_params}
+    varying = [par for par in okpar if okpar[par].ndim == 3]
+    stepar = okpar.copy()
+
+    Y = np.broadcast_to(_param_array(inicond['Y_ini'], years, dims), shape).copy()
+    Kg = np.broadcast_to(_param_array(inicond['Kg_ini'], years, dims), shape).copy()
+    Kf = np.broadcast_to(_param_array(inicond['Kf_ini'], years, dims), shape).copy()
+
+    out = np.empty((len(ensemble_vars),) + shape + (n_iter,))
+    i_stop = np.full(shape, n_iter - 1)
+    success = np.zeros(shape, dtype = int)
+    running = np.ones(shape, dtype = bool)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        for i in range(n_iter):
+            for par in varying:
+                stepar[par] = okpar[par][i]
+
+            # regions stopped by energy scarcity keep their last state
+            scarce = success == 2
+            state = (Y, Kg, Kf)
+            Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, succ = forward_step_batch(Y, Kg, Kf, params = stepar, rule = rule, betafun_type = betafun_type, coupling = coupling)
+            for j, var in enumerate([Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf]):
+                out[j, ..., i] = var
+            Y, Kg, Kf = [np.where(scarce, old, new) for old, new in zip(state, (Y, Kg, Kf))]
+
+            stop = running & (succ > 0)
+            i_stop[stop] = i
+            success[stop] = succ[stop]
+            running &= ~stop
+
+        out[len(resu_vars)] = out[6]/(out[6] + out[7])
+        out[len(resu_vars) + 1] = out[4]/out[3]
+        out[:, (success == 2)[..., np.newaxis] & (np.arange(n_iter) > i_stop[..., np.newaxis])] = np.nan
+
+    # events as in run_model, on the trajectories up to completion
+    year_zero, year_peak, year_halved = [val.reshape(shape) + year_ini for val in event_years(out[5].reshape(-1, n_iter), i_stop.ravel(), success.ravel())]
+
+    data_vars = {vnam: (dims + ['year'], out[j]) for j, vnam in enumerate(ensemble_vars)}
+    data_vars['success'] = (dims, success == 1)
+    data_vars['year_zero'] = (dims, year_zero)
+    data_vars['year_peak'] = (dims, year_peak)
+    data_vars['year_halved'] = (dims, year_halved)
+
+    ds = xr.Dataset(data_vars = data_vars, coords = {'region': regions, 'year': years})
+    if n_members is None:
+        ds = ds.isel(member = 0, drop = True)
+
+    return ds
+
+
+################################################################################################################
+######################################## Ensemble plots
+
+def default_obs(var):
+    """
+    Observations to compare with model variable var (None if there are none).
+    """
+    if var == 'Eg_ratio':
+        return Eg_ratio
+    elif var == 'Ig_ratio':
+        return Ig_obs/(Ig_obs+If_obs)
+    else:
+        return None
+
+
+def ensemble_quantiles(ens, quantiles = [0.05, 0.25, 0.5, 0.75, 0.95], dim = 'member'):
+    """
+    Quantiles over members of a DataArray (nan are ignored, e.g. after the end of a run). Returns a DataArray with a "quantile" dimension.
+    """
+    axis = ens.dims.index(dim)
+    qq = np.nanquantile(ens.values, quantiles, axis = axis)
+    dims = ['quantile'] + [di for di in ens.dims if di != dim]
+
+    return xr.DataArray(qq, dims = dims, coords = {'quantile': quantiles, **{di: ens[di] for di in dims[1:] if di in ens.coords}})
+
+
+def ensemble_density(ens, bins = 100, value_range = None, dim = 'member'):
+    """
+    Density of members along "year": histogram of the values of each year, normalized to 1. Returns the density (year, bin) and the bin edges.
+    """
+    vals = ens.transpose('year', dim).values
+    if value_range is None:
+        value_range = (np.nanmin(vals), np.nanmax(vals))
+    edges = np.linspace(value_range[0], value_range[1], bins + 1)
+
+    n_year = vals.shape[0]
+    ibin = np.clip(np.searchsorted(edges, vals, side = 'right') - 1, 0, bins - 1)
+    ok = np.isfinite(vals)
+    idx = (np.arange(n_year)[:, np.newaxis] * bins + ibin)[ok]
+    counts = np.bincount(idx, minlength = n_year * bins).reshape(n_year, bins).astype(float)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        density = counts/counts.sum(axis = 1, keepdims = True)
+
+    return density, edges
+
+
+def plot_ensemble(ens, var = 'Eg_ratio', quantiles = [0.05, 0.25, 0.5, 0.75, 0.95], n_lines = 50, density = False, obs = None, ax = None, color = 'steelblue', label = 'model', obs_col = 'black', seed = 0, year_range = None):
+    """
+    Fan chart of an ensemble (see run_ensemble): bands between symmetric quantiles, the median and a random subsample of n_lines members (drawn as a single LineCollection). Cost does not depend on the number of members beyond the quantile computation.
+
+    If density is set, the density of members (see ensemble_density) is shaded below the bands.
+
+    obs are overlaid (default: observations for var, see default_obs; False to skip).
+
+    ens can be a Dataset (var is selected) or a DataArray with "member" and "year" dimensions. Members that stopped are ignored in the following years: run the ensemble with extend_constant = True to keep them in the quantiles. Draws on ax if given, otherwise on a new figure. Returns the axis.
+    """
+    if isinstance(ens, xr.core.dataset.Dataset):
+        ens = ens[var]
+    if year_range is not None:
+        ens = ens.sel(year = slice(*year_range))
+    if ax is None:
+        fig, ax = plt.subplots()
+
+    years = ens.year.values
+
+    if density:
+        dens, edges = ensemble_density(ens)
+        ax.pcolormesh(np.append(years - 0.5, years[-1] + 0.5), edges, dens.T, cmap = 'Greys', shading = 'flat', zorder = 0)
+
+    qq = ensemble_quantiles(ens, quantiles = quantiles).transpose('quantile', 'year').values
+    n_q = len(quantiles)
+    for i in range(n_q//2):
+        ax.fill_between(years, qq[i], qq[n_q - 1 - i], color = color, alpha = 0.2 + 0.6*i/max(n_q//2, 1), lw = 0, label = f'{int(100*quantiles[i])}-{int(100*quantiles[n_q-1-i])}%')
+    if n_q % 2 == 1:
+        ax.plot(years, qq[n_q//2], color = color, lw = 2, label = label)
+
+    if n_lines > 0:
+        n_members = ens.sizes['member']
+        sub = np.random.default_rng(seed).choice(n_members, size = min(n_lines, n_members), replace = False)
+        ys = ens.isel(member = np.sort(sub)).transpose('member', 'year').values
+        _add_lines(ax, [years]*len(ys), ys, colors = color, linewidths = 0.3, alpha = 0.5)
+
+    if obs is None:
+        obs = default_obs(var)
+    if obs is not None and obs is not False:
+        obs.sel(year = slice(years[0], years[-1])).plot(ax = ax, color = obs_col, label = 'obs')
+
+    ax.set_xlabel('year')
+    ax.set_ylabel(var)
+    ax.legend()
+
+    return ax
+
+
+def plot_ensemble_events(ens, ax = None, bins = 50):
+    """
+    Histograms of year_peak, year_halved and year_zero over the members of an ensemble.
+    """
+    if ax is None:
+        fig, ax = plt.subplots()
+
+    for var, col in zip(['year_peak', 'year_halved', 'year_zero'], ['indianred', 'grey', 'forestgreen']):
+        vals = ens[var].values
+        ax.hist(vals[np.isfinite(vals)], bins = bins, color = col, alpha = 0.5, label = var)
+
+    ax.set_xlabel('year')
+    ax.set_ylabel('members')
+    ax.legend()
+
+    return ax
+
+
+################################################################################################################
+######################################## Parameter identifiability
+
+def n_fit_obs(year_ini = 2015, obs = None, all_green = False, year_end = 2025):
+    """
+    Number of observations used by cost_function for a run from year_ini to year_end (excluded).
+    """
+    if obs is None:
+        obs = fit_obs(all_green = all_green)
+
+    return int(sum(obs[var].sel(year = slice(year_ini, year_end - 1)).count() for var in obs))
+
+
+def _cost_fixed(x_free, ifix, val, parnames, cost_kw):
+    return cost_function(np.insert(x_free, ifix, val), parnames = parnames, **cost_kw)
+
+
+def _profile_chain(values, x0, ifix, parnames, bounds, cost_kw, method, tol):
+    """
+    Profiles parnames[ifix] on values, in order: each point is optimized starting from the optimum of the previous one. Top level, so that it can be sent to worker processes.
+    """
+    cost_kw = dict(cost_kw)
+    cost_kw['params'] = cost_kw.get('params', default_params).copy()
+
+    free = [j for j in range(len(parnames)) if j != ifix]
+    x_free = np.array(x0, dtype = float)[free]
+    bounds_free = [bounds[j] for j in free]
+
+    costs = []
+    xs = []
+    for val in values:
+        res = scipy.optimize.minimize(_cost_fixed, x_free, args = (ifix, val, parnames, cost_kw), bounds = bounds_free, method = method, tol = tol)
+        x_free = res.x
+        costs.append(res.fun)
+        xs.append(np.insert(res.x, ifix, val))
+
+    return np.array(costs), np.array(xs)
+
+
+def warm_chains(grid, center, n_chains = 2):
+    """
+    Splits a grid in chains of consecutive values that move away from center (e.g. the best fit), to be run in parallel with warm starts. Chains are split between the two sides of center proportionally to the number of points; the points of each chain are ordered going away from center.
+    """
+    grid = np.sort(np.asarray(grid, dtype = float))
+    up = grid[grid >= center]
+    down = grid[grid < center][::-1]
+
+    n_up = int(np.clip(np.round(n_chains * len(up)/len(grid)), 1 if len(up) > 0 else 0, max(len(up), 1)))
+    n_down = int(np.clip(n_chains - n_up, 1 if len(down) > 0 else 0, max(len(down), 1)))
+
+    chains = []
+    if n_up > 0: chains += np.array_split(up, n_up)
+    if n_down > 0: chains += np.array_split(down, n_down)
+
+    return [ch for ch in chains if len(ch) > 0]
+
+
+def _profile_ci(values, deviance, best_value, threshold):
+    """
+    Interval where the profile deviance is below threshold, interpolating linearly on the grid. nan if the profile does not cross threshold within the grid.
+    """
+    bounds = []
+    for side in [values < best_value, values > best_value]:
+        vals = values[side]
+        devs = deviance[side]
+        order = np.argsort(np.abs(vals - best_value))
+        vals, devs = np.append(best_value, vals[order]), np.append(0., devs[order])
+        cross = np.where(devs > threshold)[0]
+        if len(cross) == 0:
+            bounds.append(np.nan)
+        else:
+            k = cross[0]
+            bounds.append(np.interp(threshold, [devs[k-1], devs[k]], [vals[k-1], vals[k]]))
+
+    return bounds
+
+
+def profile_likelihood(parnames, best_x, bounds, profile_pars = None, n_grid = 21, grids = None, level = 0.95, n_chains = 2, backend = 'serial', n_workers = None, method = None, tol = 1e-10, **cost_kw):
+    """
+    Profile likelihood of calibrated parameters.
+
+    Each parameter in profile_pars (default: all parnames) is fixed on a grid (default: n_grid points within its bounds, or grids[par]) and the others are re-optimized with cost_function (cost_kw are passed to it), starting from the best fit best_x and then from the optimum of the neighbouring grid point. Each grid is split in n_chains chains of consecutive points (see warm_chains); all chains of all parameters are run in parallel with the chosen backend.
+
+    The cost is taken as a sum of squared residuals with gaussian errors: the profile deviance is n_obs*log(cost/cost_min), and the confidence interval at level is where it stays below the chi2 (1 dof) quantile. With weighted costs (I_weight < 1) this is only indicative.
+
+    Returns a Dataset with, for each parameter: the grid ("value"), the profile cost and deviance, the re-optimized values of all parameters along the profile ("trace") and the confidence interval. The local correlation matrix of the parameters (see param_correlation) is added as "corr"; it is nan for parameters that are not locally identifiable.
+    """
+    best_x = np.array(best_x, dtype = float)
+    if profile_pars is None: profile_pars = list(parnames)
+    if grids is None: grids = dict()
+    grids = {par: np.sort(np.asarray(grids[par], dtype = float)) if par in grids else np.linspace(*bounds[parnames.index(par)], n_grid) for par in profile_pars}
+
+    cost_min = _cost_kw(best_x, parnames, dict(cost_kw, params = cost_kw.get('params', default_params).copy()))
+
+    tasks = []
+    task_par = []
+    for par in profile_pars:
+        ifix = parnames.index(par)
+        for chain in warm_chains(grids[par], best_x[ifix], n_chains = n_chains):
+            tasks.append((chain, best_x, ifix, parnames, bounds, cost_kw, method, tol))
+            task_par.append(par)
+
+    results = map_tasks(_profile_chain, tasks, backend = backend, n_workers = n_workers)
+
+    n_obs = n_fit_obs(year_ini = cost_kw.get('year_ini', 2015), obs = cost_kw.get('obs', None), all_green = cost_kw.get('all_green', False), year_end = cost_kw.get('year_end', 2025))
+    threshold = scipy.stats.chi2.ppf(level, 1)
+
+    n_point = max(len(gr) for gr in grids.values())
+    value = np.full((len(profile_pars), n_point), np.nan)
+    cost = np.full((len(profile_pars), n_point), np.nan)
+    trace = np.full((len(profile_pars), n_point, len(parnames)), np.nan)
+    ci = np.full((len(profile_pars), 2), np.nan)
+
+    for ip, par in enumerate(profile_pars):
+        chain_costs = np.concatenate([res[0] for res, tpar in zip(results, task_par) if tpar == par])
+        chain_xs = np.concatenate([res[1] for res, tpar in zip(results, task_par) if tpar == par])
+        order = np.argsort(chain_xs[:, parnames.index(par)])
+        n_gr = len(order)
+        value[ip, :n_gr] = chain_xs[order, parnames.index(par)]
+        cost[ip, :n_gr] = chain_costs[order]
+        trace[ip, :n_gr] = chain_xs[order]
+
+    cost_min = min(cost_min, np.nanmin(cost))
+    deviance = n_obs * np.log(cost/cost_min)
+    for ip, par in enumerate(profile_pars):
+        ok = np.isfinite(value[ip])
+        ci[ip] = _profile_ci(value[ip, ok], deviance[ip, ok], best_x[parnames.index(par)], threshold)
+
+    ds = xr.Dataset(data_vars = {'value': (['parameter', 'point'], value), 'cost': (['parameter', 'point'], cost), 'deviance': (['parameter', 'point'], deviance), 'trace': (['parameter', 'point', 'fit_parameter'], trace), 'ci_low': (['parameter'], ci[:, 0]), 'ci_high': (['parameter'], ci[:, 1]), 'best': (['parameter'], best_x[[parnames.index(par) for par in profile_pars]])}, coords = {'parameter': profile_pars, 'fit_parameter': list(parnames)}, attrs = {'level': level, 'threshold': threshold, 'cost_min': cost_min, 'n_obs': n_obs})
+
+    cov, corr = param_correlation(parnames, best_x, cost_min = cost_min, n_obs = n_obs, bounds = bounds, backend = backend, n_workers = n_workers, **cost_kw)
+    ds['corr'] = corr.rename({'parameter': 'fit_parameter', 'parameter2': 'fit_parameter2'}).assign_coords(fit_parameter2 = list(parnames))
+
+    return ds
+
+
+def param_correlation(parnames, best_x, rel_step = 1e-3, cost_min = None, n_obs = None, bounds = None, backend = 'serial', n_workers = None, **cost_kw):
+    """
+    Local covariance and correlation of the parameters at the best fit, from the finite-difference hessian H of cost_function: cov = 2 s2 H^-1, with s2 = cost_min/(n_obs - n_par). Strong correlations point to parameters that compensate each other.
+
+    If bounds are given, parameters closer to a bound than two finite-difference steps are held fixed (their rows are nan), and the hessian is computed for the others, with a stencil inside the bounds. A warning is given for them, and if some variances are not positive (the hessian is not positive definite, e.g. best_x is not a minimum).
+
+    The cost evaluations are run with the chosen backend. Returns the covariance and correlation as DataArrays.
+    """
+    import warnings
+
+    best_x = np.array(best_x, dtype = float)
+    n_par = len(parnames)
+    steps = rel_step * np.maximum(np.abs(best_x), 1e-2)
+
+    active = np.zeros(n_par, dtype = bool)
+    if bounds is not None:
+        lo, hi = np.array(bounds, dtype = float).T
+        # the stencil goes up to two steps away (diagonal terms)
+        active = (best_x - 2*steps < lo) | (best_x + 2*steps > hi)
+        if np.any(active):
+            warnings.warn(f'{[par for par, act in zip(parnames, active) if act]} at a bound, left out of the hessian')
+    free = np.where(~active)[0]
+
+    shifts = [(i, j, si, sj) for i in free for j in free if j >= i for si in [-1, 1] for sj in [-1, 1]]
+    parsets = []
+    for i, j, si, sj in shifts:
+        xx = best_x.copy()
+        xx[i] += si*steps[i]
+        xx[j] += sj*steps[j]
+        parsets.append(xx)
+
+    cost_kw = dict(cost_kw)
+    costs = map_tasks(_cost_kw, [(xx, parnames, dict(cost_kw, params = cost_kw.get('params', default_params).copy())) for xx in parsets], backend = backend, n_workers = n_workers)
+
+    hess = np.zeros((n_par, n_par))
+    for (i, j, si, sj), cc in zip(shifts, costs):
+        hess[i, j] += si*sj*cc/(4*steps[i]*steps[j])
+    hess = hess + np.triu(hess, 1).T
+
+    if cost_min is None:
+        cost_min = _cost_kw(best_x, parnames, dict(cost_kw, params = cost_kw.get('params', default_params).copy()))
+    if n_obs is None:
+        n_obs = n_fit_obs(year_ini = cost_kw.get('year_ini', 2015), obs = cost_kw.get('obs', None), all_green = cost_kw.get('all_green', False), year_end = cost_kw.get('year_end', 2025))
+
+    s2 = cost_min/max(n_obs - n_par, 1)
+    cov = np.full((n_par, n_par), np.nan)
+    cov[np.ix_(free, free)] = 2 * s2 * np.linalg.pinv(hess[np.ix_(free, free)])
+    # a non positive variance means the parameter is not locally identifiable
+    var = np.diag(cov).copy()
+    bad = ~active & ~(var > 0)
+    if np.any(bad):
+        warnings.warn(f'hessian not positive definite at best_x, no variance for {[par for par, ba in zip(parnames, bad) if ba]}')
+    var[~(var > 0)] = np.nan
+    sig = np.sqrt(var)
+    corr = cov/np.outer(sig, sig)
+
+    coords = {'parameter': list(parnames), 'parameter2': list(parnames)}
+    cov = xr.DataArray(cov, dims = ['parameter', 'parameter2'], coords = coords)
+    corr = xr.DataArray(corr, dims = ['parameter', 'parameter2'], coords = coords)
+
+    return cov, corr
+
+
+################################################################################################################
+######################################## Hindcast
+
+def _hindcast_chain(starts, x0, parnames, bounds, fit_years, horizon, var, cost_kw, method, tol):
+    """
+    Calibrates and forecasts for consecutive start years, each fit starting from the optimum of the previous one. Top level, so that it can be sent to worker processes.
+    """
+    cost_kw = dict(cost_kw)
+    params = cost_kw.pop('params', default_params)
+    obs = cost_kw['obs']
+
+    x = np.array(x0, dtype = float)
+    out = []
+    for year_ini in starts:
+        cutoff = year_ini + fit_years
+        kw = dict(cost_kw, params = params.copy(), year_ini = year_ini, year_end = cutoff, inicond = inicond_yr(year_ini))
+        res = scipy.optimize.minimize(_cost_kw, x, args = (parnames, kw), bounds = bounds, method = method, tol = tol)
+        x = res.x
+
+        n_iter = fit_years + horizon
+        fit_pars = fit_params(res.x, parnames, params.copy(), year_ini = year_ini, year_end = year_ini + n_iter)
+        resu = run_model(inicond = inicond_yr(year_ini), params = fit_pars, n_iter = n_iter, year_ini = year_ini, verbose = False, rule = 'maxgreen', extend_constant = True, linear_gdp = cost_kw.get('linear_gdp', None), gdp = cost_kw.get('gdp', None))
+
+        out.append((res.x, res.fun, resu.get(var)))
+
+    return out
+
+
+def hindcast(parnames, initial_guess, bounds, start_years = np.arange(1965, 2016), fit_years = 5, horizon = 10, var = 'Eg_ratio', obs = None, n_chains = None, backend = 'serial', n_workers = None, method = None, tol = 1e-10, **cost_kw):
+    """
+    Rolling-origin hindcast. For each start year, the model is calibrated on obs in [start, start + fit_years) (starting from inicond_yr(start)) and var is forecast for horizon more years. The forecast is scored against the held-out observations of var, and compared to persistence (last observed value in the fit period kept constant).
+
+    obs defaults to the observations of var (cost_kw are passed to cost_function). Start years are split in n_chains chains of consecutive years (default: one per worker), each fit is warm-started from the optimum of the previous year, and chains are run in parallel with the chosen backend.
+
+    Returns a skill table (pandas DataFrame, one row per start year) and a Dataset with fitted parameters, forecasts and scores along year_ini.
+    """
+    if obs is None:
+        obs = {var: fit_obs(all_green = cost_kw.get('all_green', False))[var]}
+    cost_kw = dict(cost_kw, obs = obs)
+    start_years = np.asarray(start_years)
+
+    if n_chains is None:
+        n_chains = 1 if backend == 'serial' else (n_workers or os.cpu_count())
+    chains = warm_chains(start_years, start_years.min(), n_chains = min(n_chains, len(start_years)))
+
+    tasks = [(chain.astype(int), initial_guess, parnames, bounds, fit_years, horizon, var, cost_kw, method, tol) for chain in chains]
+    results = sum(map_tasks(_hindcast_chain, tasks, backend = backend, n_workers = n_workers), [])
+
+    years = np.arange(start_years.min(), start_years.max() + fit_years + horizon)
+    n_start = len(start_years)
+    forecast = np.full((n_start, len(years)), np.nan)
+    lead = np.full((n_start, len(years)), np.nan)
+    rmse_fit = np.full(n_start, np.nan)
+    rmse_fc = np.full(n_start, np.nan)
+    rmse_pers = np.full(n_start, np.nan)
+    n_held = np.zeros(n_start, dtype = int)
+
+    ob = obs[var]
+    for i, (year_ini, (x, cost, series)) in enumerate(zip(np.concatenate(chains).astype(int), results)):
+        cutoff = year_ini + fit_years
+        i0 = year_ini - years[0]
+        forecast[i, i0:i0 + len(series)] = series
+        lead[i, i0:i0 + len(series)] = np.arange(len(series)) - fit_years + 1
+
+        fc = xr.DataArray(series, dims = ['year'], coords = {'year': np.arange(year_ini, year_ini + len(series))})
+        fit_err = (fc - ob).sel(year = slice(year_ini, cutoff - 1))
+        held_err = (fc - ob).sel(year = slice(cutoff, cutoff + horizon - 1))
+
+        rmse_fit[i] = np.sqrt(np.nanmean(fit_err**2)) if fit_err.count() > 0 else np.nan
+        n_held[i] = held_err.count()
+        if n_held[i] > 0 and ob.year.min() <= cutoff - 1:
+            rmse_fc[i] = np.sqrt(np.nanmean(held_err**2))
+            last_obs = ob.sel(year = slice(None, cutoff - 1)).dropna('year')[-1]
+            pers_err = ob.sel(year = held_err.year) - last_obs
+            rmse_pers[i] = np.sqrt(np.nanmean(pers_err**2))
+
+    order = np.argsort(np.concatenate(chains))
+    results = [results[i] for i in order]
+
+    ds = xr.Dataset(data_vars = {
+        'params': (['year_ini', 'parameter'], np.array([res[0] for res in results])),
+        'cost': (['year_ini'], np.array([res[1] for res in results])),
+        var: (['year_ini', 'year'], forecast[order]),
+        'lead': (['year_ini', 'year'], lead[order]),
+        'rmse_fit': (['year_ini'], rmse_fit[order]),
+        'rmse_forecast': (['year_ini'], rmse_fc[order]),
+        'rmse_persistence': (['year_ini'], rmse_pers[order]),
+        'n_heldout': (['year_ini'], n_held[order]),
+        }, coords = {'year_ini': np.sort(start_years), 'year': years, 'parameter': list(parnames)}, attrs = {'fit_years': fit_years, 'horizon': horizon, 'var': var})
+    ds['skill'] = 1 - ds['rmse_forecast']/ds['rmse_persistence']
+
+    table = ds[['cost', 'rmse_fit', 'rmse_forecast', 'rmse_persistence', 'skill', 'n_heldout']].to_dataframe()
+    for ip, par in enumerate(parnames):
+        table[par] = ds['params'].values[:, ip]
+
+    return table, ds
+
+
+################################################################################################################
+######################################## Multi-objective calibration
+
+def _objective_cost(parset, parnames, weights, cost_kw):
+    parts = cost_function(parset, parnames = parnames, components = True, **cost_kw)
+    return sum(ww*parts[var] for var, ww in weights.items())
+
+
+def _objective_constraint(parset, parnames, var, eps, cost_kw):
+    return eps - cost_function(parset, parnames = parnames, components = True, **cost_kw)[var]
+
+
+def _pareto_chain(sweep, x0, parnames, bounds, objectives, mode, cost_kw, method, tol):
+    """
+    Runs consecutive points of a weighted-sum (sweep of weights of the first objective) or epsilon-constraint (sweep of upper limits on the first objective) scan, each starting from the optimum of the previous one. Top level, so that it can be sent to worker processes.
+    """
+    cost_kw = dict(cost_kw)
+    cost_kw['params'] = cost_kw.get('params', default_params).copy()
+    obj_1, obj_2 = objectives
+
+    x = np.array(x0, dtype = float)
+    out = []
+    for val in sweep:
+        if mode == 'weighted':
+            res = scipy.optimize.minimize(_objective_cost, x, args = (parnames, {obj_1: val, obj_2: 1. - val}, cost_kw), bounds = bounds, method = method, tol = tol)
+        else:
+            cons = {'type': 'ineq', 'fun': _objective_constraint, 'args': (parnames, obj_1, val, cost_kw)}
+            res = scipy.optimize.minimize(_objective_cost, x, args = (parnames, {obj_2: 1.}, cost_kw), bounds = bounds, method = 'SLSQP', constraints = [cons], tol = tol)
+        x = res.x
+        parts = cost_function(res.x, parnames = parnames, components = True, **cost_kw)
+        out.append((res.x, parts[obj_1], parts[obj_2]))
+
+    return out
+
+
+def pareto_mask(costs):
+    """
+    True for the non-dominated rows of costs (n_points, n_objectives), all to be minimized.
+    """
+    costs = np.asarray(costs)
+    mask = np.ones(len(costs), dtype = bool)
+    for i, cc in enumerate(costs):
+        dominated = np.all(costs <= cc, axis = 1) & np.any(costs < cc, axis = 1)
+        mask[i] = not np.any(dominated)
+
+    return mask
+
+
+def pareto_front(parnames, initial_guess, bounds, objectives = ['Ig_ratio', 'Eg_ratio'], n_weights = 21, n_eps = 11, n_chains = None, backend = 'serial', n_workers = None, method = None, tol = 1e-10, **cost_kw):
+    """
+    Pareto front between the misfits of two observed variables (by default, share of green investment and of green energy), instead of blending them with a fixed I_weight.
+
+    The front is explored with a weighted-sum sweep (n_weights weights w, minimizing w*cost_1 + (1-w)*cost_2) and an epsilon-constraint sweep (n_eps limits on cost_1 between the ends of the weighted front, minimizing cost_2 with SLSQP), which also finds the non-convex parts of the front. Each sweep is split in n_chains chains of consecutive points (default: one per worker) with warm starts, run in parallel with the chosen backend. cost_kw are passed to cost_function.
+
+    Returns a Dataset along "point" with the two costs, the fitted parameters, the sweep they come from and a "pareto" mask of the non-dominated points. See pareto_select to pick a point for a given weight.
+    """
+    obj_1, obj_2 = objectives
+    if n_chains is None:
+        n_chains = 1 if backend == 'serial' else (n_workers or os.cpu_count())
+
+    def run_sweep(sweep, mode):
+        chains = warm_chains(sweep, sweep.min(), n_chains = min(n_chains, len(sweep)))
+        tasks = [(chain, initial_guess, parnames, bounds, objectives, mode, cost_kw, method, tol) for chain in chains]
+        results = sum(map_tasks(_pareto_chain, tasks, backend = backend, n_workers = n_workers), [])
+        return np.concatenate(chains), results
+
+    weights, res_w = run_sweep(np.linspace(0., 1., n_weights), 'weighted')
+
+    sweeps = [weights]
+    results = res_w
+    modes = ['weighted']*len(weights)
+    if n_eps > 0:
+        cost_1 = np.array([res[1] for res in res_w])
+        eps = np.linspace(cost_1.min(), cost_1.max(), n_eps + 2)[1:-1]
+        eps, res_e = run_sweep(eps, 'epsilon')
+        sweeps.append(eps)
+        results = results + res_e
+        modes += ['epsilon']*len(eps)
+
+    costs = np.array([[res[1], res[2]] for res in results])
+    order = np.argsort(costs[:, 0])
+
+    ds = xr.Dataset(data_vars = {
+        f'cost_{obj_1}': (['point'], costs[order, 0]),
+        f'cost_{obj_2}': (['point'], costs[order, 1]),
+        'params': (['point', 'parameter'], np.array([res[0] for res in results])[order]),
+        'sweep': (['point'], np.array(modes)[order]),
+        'sweep_value': (['point'], np.concatenate(sweeps)[order]),
+        'pareto': (['point'], pareto_mask(costs)[order]),
+        }, coords = {'point': np.arange(len(results)), 'parameter': list(parnames)}, attrs = {'objectives': list(objectives)})
+
+    return ds
+
+
+def pareto_select(front, weight = None, I_weight = None):
+    """
+    Point of the Pareto front that minimizes weight*cost_1 + (1-weight)*cost_2. Returns the fitted parameters as a dict and the index of the point.
+
+    Alternatively, I_weight selects the point that cost_function would give with the same I_weight (for the default objectives Ig_ratio and Eg_ratio): I_weight < 1 is weight = I_weight on Ig_ratio, I_weight >= 1 gives equal weights (weight = 0.5).
+    """
+    obj_1, obj_2 = front.attrs['objectives']
+    if (weight is None) == (I_weight is None):
+        raise ValueError('Set one of weight and I_weight')
+    if I_weight is not None:
+        if set([obj_1, obj_2]) != {'Ig_ratio', 'Eg_ratio'}: raise ValueError(f'I_weight needs objectives Ig_ratio and Eg_ratio, got {obj_1} and {obj_2}')
+        w_Ig = I_weight if I_weight < 1. else 0.5
+        weight = w_Ig if obj_1 == 'Ig_ratio' else 1. - w_Ig
+    pf = front.where(front.pareto, drop = True)
+    tot = weight*pf[f'cost_{obj_1}'] + (1. - weight)*pf[f'cost_{obj_2}']
+    best = pf.isel(point = int(np.argmin(tot.values)))
+
+    return {str(par): float(best.params.sel(parameter = par)) for par in front.parameter.values}, int(best.point)
+
+
+################################################################################################################
+######################################## Optimal policy paths
+
+control_vars = ['beta_0', 'gamma_g']
+
+
+def _gauss(z):
+    return np.exp(-z**2/2)/np.sqrt(2*np.pi)
+
+
+def _control_params(params, years):
+    """
+    Parameters as arrays along years (scenarios resolved as in run_ensemble).
+    """
+    okpar = resolve_params(params, years)
+    return {par: np.broadcast_to(val[:, 0] if val.ndim == 2 else val, (len(years),)) for par, val in okpar.items()}
+
+
+def control_rollout(u, inicond, params, years, control = 'beta_0', u_ref = None, linear_gdp = None):
+    """
+    Runs the model (rule maxgreen, betafun cdf) with the time path u of the control parameter, and keeps what is needed by control_adjoint. The run does not stop when the transition is completed.
+
+    Also computes the subsidy of each year with respect to the reference path u_ref: the extra green investment (beta - beta(u_ref))*r_inv*(Pg + Pf) for beta_0, the extra green profit Pg - Pg(u_ref) for gamma_g.
+    """
+    if control not in control_vars: raise ValueError(f'Unknown control {control}. Allowed: {control_vars}')
+    n_iter = len(years)
+    pp = _control_params(params, years)
+    if u_ref is None: u_ref = pp[control]
+    u_ref = np.broadcast_to(u_ref, (n_iter,))
+
+    tape = {var: np.zeros(n_iter) for var in ['Y', 'Kg', 'Kf', 'E', 'Eg', 'Ef', 'Pg', 'Pf', 'dEg', 'dqg', 'dPg', 'dPf', 'qg', 'x', 'y', 'pr', 'z', 'z_ref', 'beta', 'beta_ref', 'R', 'sub']}
+    Y = float(inicond['Y_ini'])
+    Kg = float(inicond['Kg_ini'])
+    Kf = float(inicond['Kf_ini'])
+
+    for t in range(n_iter):
+        beta_0 = u[t] if control == 'beta_0' else pp['beta_0'][t]
+        gamma_g = u[t] if control == 'gamma_g' else pp['gamma_g'][t]
+        a, eta_g, eta_f, h_g, h_f = pp['a'][t], pp['eta_g'][t], pp['eta_f'][t], pp['h_g'][t], pp['h_f'][t]
+
+        E = pp['eps'][t] * Y
+        if pp['a'][t] * Kg < E:
+            Eg, Ef, dEg = a * Kg, E - a * Kg, a
+        else:
+            Eg, Ef, dEg = E, 0., 0.
+
+        qg = Eg - eta_g * Eg**h_g
+        dqg = 1 - eta_g * h_g * Eg**(h_g - 1) if Eg > 0 else 0.
+        if qg < 0.: qg, dqg = (1 - eta_g) * Eg, 1 - eta_g
+        qf = Ef - eta_f * Ef**h_f
+        dqf = 1 - eta_f * h_f * Ef**(h_f - 1) if Ef > 0 else 0.
+        if qf < 0.: qf, dqf = (1 - eta_f) * Ef, 1 - eta_f
+        Pg = gamma_g * qg
+        Pf = pp['gamma_f'][t] * qf
+
+        x = Pg/Kg
+        y = Pf/Kf
+        pr = (x - y)/(x + y)
+        z = (beta_0 + pr)/pp['delta_sig'][t]
+        beta = cdf(z)
+        R = pp['r_inv'][t] * (Pg + Pf)
+
+        if control == 'beta_0':
+            z_ref = (u_ref[t] + pr)/pp['delta_sig'][t]
+            beta_ref = cdf(z_ref)
+            sub = (beta - beta_ref) * R
+        else:
+            z_ref = beta_ref = 0.
+            sub = (gamma_g - u_ref[t]) * qg
+
+        for var, val in zip(tape, [Y, Kg, Kf, E, Eg, Ef, Pg, Pf, dEg, dqg, gamma_g * dqg, pp['gamma_f'][t] * dqf, qg, x, y, pr, z, z_ref, beta, beta_ref, R, sub]):
+            tape[var][t] = val
+
+        Kg = beta * R + Kg * (1 - pp['delta_g'][t])
+        Kf = (1 - beta) * R + Kf * (1 - pp['delta_f'][t])
+        Y = GDP(Y, growth = pp['growth'][t], linear_gdp = linear_gdp)
+
+    tape['params'] = pp
+    tape['control'] = control
+
+    return tape
+
+
+def control_adjoint(tape, w_Ef, w_sub):
+    """
+    Gradient with respect to the control path of sum_t (w_Ef[t]*Ef[t] + w_sub[t]*sub[t]), by a reverse sweep over a tape from control_rollout.
+    """
+    pp = tape['params']
+    control = tape['control']
+    n_iter = len(tape['Kg'])
+    w_Ef = np.broadcast_to(w_Ef, (n_iter,))
+    w_sub = np.broadcast_to(w_sub, (n_iter,))
+
+    grad = np.zeros(n_iter)
+    lam_g = 0. # adjoint of Kg at the next step
+    lam_f = 0.
+    for t in range(n_iter - 1, -1, -1):
+        tp = {var: tape[var][t] for var in tape if var not in ['params', 'control']}
+        sigma = pp['delta_sig'][t]
+
+        Kg_bar = (1 - pp['delta_g'][t]) * lam_g
+        Kf_bar = (1 - pp['delta_f'][t]) * lam_f
+        beta_bar = tp['R'] * (lam_g - lam_f)
+        R_bar = tp['beta'] * lam_g + (1 - tp['beta']) * lam_f
+        pr_bar = 0.
+        Pg_bar = 0.
+        u_bar = 0.
+
+        if control == 'beta_0':
+            beta_bar += w_sub[t] * tp['R']
+            R_bar += w_sub[t] * (tp['beta'] - tp['beta_ref'])
+            pr_bar -= w_sub[t] * tp['R'] * _gauss(tp['z_ref'])/sigma
+        else:
+            # sub = (gamma_g - u_ref)*qg(Eg)
+            u_bar += w_sub[t] * tp['qg']
+
+        z_bar = beta_bar * _gauss(tp['z'])
+        pr_bar += z_bar/sigma
+        if control == 'beta_0': u_bar += z_bar/sigma
+
+        Pg_bar += pp['r_inv'][t] * R_bar
+        Pf_bar = pp['r_inv'][t] * R_bar
+
+        x, y = tp['x'], tp['y']
+        x_bar = pr_bar * 2*y/(x + y)**2
+        y_bar = -pr_bar * 2*x/(x + y)**2
+        Pg_bar += x_bar/tp['Kg']
+        Kg_bar -= x_bar * tp['Pg']/tp['Kg']**2
+        Pf_bar += y_bar/tp['Kf']
+        Kf_bar -= y_bar * tp['Pf']/tp['Kf']**2
+
+        Eg_bar = Pg_bar * tp['dPg']
+        Ef_bar = w_Ef[t] + Pf_bar * tp['dPf']
+        if control == 'gamma_g':
+            # Pg = gamma_g*qg(Eg)
+            u_bar += Pg_bar * tp['qg']
+            Eg_bar += w_sub[t] * (tp['sub']/tp['qg'] if tp['qg'] != 0 else 0.) * tp['dqg']
+
+        Kg_bar += tp['dEg'] * (Eg_bar - Ef_bar)
+
+        grad[t] = u_bar
+        lam_g, lam_f = Kg_bar, Kf_bar
+
+    return grad
+
+
+def _target_weights(tape, years, target, target_year, target_value):
+    """
+    Target constraint as target_value - sum_t w_Ef[t]*Ef[t] >= 0.
+    """
+    w_Ef = np.zeros(len(years))
+    if target == 'halve':
+        w_Ef[years == target_year] = 1.
+        bound = target_value * tape['Ef'][0]
+    elif target == 'budget':
+        w_Ef[years <= target_year] = 1.
+        bound = target_value
+    else:
+        raise ValueError(f'Unknown target {target}. Allowed: halve, budget')
+
+    return w_Ef, bound
+
+
+def optimal_policy(control = 'beta_0', target = 'halve', target_year = 2050, target_value = 0.5, inicond = inicond_2015, params = best_params, year_ini = 2015, n_iter = None, bounds = None, max_step = None, smooth = 0., cost = 'subsidy', discount = 0., u_ini = None, linear_gdp = None, tol = 1e-9, maxiter = 500, verbose = False):
+    """
+    Cheapest time path of a policy parameter (control: beta_0 or gamma_g) to reach a target:
+        - target = 'halve': Ef in target_year at most target_value times Ef in year_ini;
+        - target = 'budget': cumulative Ef up to target_year at most target_value.
+
+    The cost is the discounted sum of yearly subsidies (cost = 'subsidy', see control_rollout) or of squared deviations from the reference path in params (cost = 'quadratic'), plus smooth times the sum of squared year-to-year changes. The control is limited within bounds (default: from the reference path, so that subsidies are not negative, to the reference plus 2) and, if given, by max_step per year.
+
+    The problem is solved with SLSQP, with gradients of cost and target computed by a reverse (adjoint) sweep over the whole horizon (see control_adjoint). Runs use rule maxgreen and betafun cdf, and do not stop when the transition is completed.
+
+    Returns a Dataset with the optimal path (along year, can be put in params for run_model), Ef and the yearly subsidy, and the scipy OptimizeResult.
+    """
+    if n_iter is None: n_iter = target_year - year_ini + 1
+    years = np.arange(year_ini, year_ini + n_iter)
+    u_ref = _control_params(params, years)[control].copy()
+    disc = (1. + discount)**(-(years - year_ini))
+
+    def rollout(u):
+        return control_rollout(u, inicond, params, years, control = control, u_ref = u_ref, linear_gdp = linear_gdp)
+
+    cache = dict()
+    def get_tape(u):
+        key = u.tobytes()
+        if key not in cache:
+            cache.clear()
+            cache[key] = rollout(u)
+        return cache[key]
+
+    def objective(u):
+        tape = get_tape(u)
+        du = np.diff(u)
+        if cost == 'subsidy':
+            val = np.sum(disc * tape['sub'])
+            grad = control_adjoint(tape, 0., disc)
+        elif cost == 'quadratic':
+            val = np.sum(disc * (u - u_ref)**2)
+            grad = 2 * disc * (u - u_ref)
+        else:
+            raise ValueError(f'Unknown cost {cost}. Allowed: subsidy, quadratic')
+        val += smooth * np.sum(du**2)
+        grad[:-1] -= 2 * smooth * du
+        grad[1:] += 2 * smooth * du
+        return val, grad
+
+    def constraint(u):
+        tape = get_tape(u)
+        w_Ef, bound = _target_weights(tape, years, target, target_year, target_value)
+        return bound - np.sum(w_Ef * tape['Ef'])
+
+    def constraint_jac(u):
+        tape = get_tape(u)
+        w_Ef, bound = _target_weights(tape, years, target, target_year, target_value)
+        return -control_adjoint(tape, w_Ef, 0.)
+
+    constraints = [{'type': 'ineq', 'fun': constraint, 'jac': constraint_jac}]
+    if max_step is not None:
+        diff = np.diff(np.eye(n_iter), axis = 0)
+        constraints.append({'type': 'ineq', 'fun': lambda u: max_step - diff @ u, 'jac': lambda u: -diff})
+        constraints.append({'type': 'ineq', 'fun': lambda u: max_step + diff @ u, 'jac': lambda u: diff})
+
+    if bounds is None:
+        bounds = list(zip(u_ref, u_ref + 2.))
+    else:
+        bounds = [bounds]*n_iter
+    if u_ini is None: u_ini = np.clip(u_ref, *np.array(bounds).T)
+    result = scipy.optimize.minimize(objective, np.asarray(u_ini, dtype = float), jac = True, bounds = bounds, constraints = constraints, method = 'SLSQP', tol = tol, options = {'maxiter': maxiter, 'disp': verbose})
+
+    tape = rollout(result.x)
+    ds = xr.Dataset(data_vars = {control: ('year', result.x), f'{control}_ref': ('year', u_ref), 'Ef': ('year', tape['Ef']), 'Eg': ('year', tape['Eg']), 'subsidy': ('year', tape['sub'])}, coords = {'year': years}, attrs = {'target': target, 'target_year': target_year, 'target_value': target_value, 'cost': result.fun, 'success': int(result.success), 'constraint': constraint(result.x)})
+
+    return ds, result
+
+
+################################################################################################################
+######################################## Data assimilation
+
+def assim_obs():
+    """
+    Observations for EnsembleFilter: green energy share, green investment share and fossil profits.
+    """
+    obs = fit_obs()
+    obs['Pf_obs'] = Pf_obs
+
+    return obs
+
+
+default_assim_pars = ['beta_0', 'gamma_g', 'growth', 'delta_sig']
+default_assim_spread = {'beta_0': 0.2, 'gamma_g': 0.2, 'growth': 0.005, 'delta_sig': 0.2, 'Pf_scale': 1.} # prior std (of the log for positive_pars)
+default_obs_err = {'Eg_ratio': 0.003, 'Ig_ratio': 0.02, 'Pf_obs': 0.3} # std of observation errors
+positive_pars = ['gamma_g', 'gamma_f', 'delta_sig', 'r_inv', 'Pf_scale'] # updated as logarithms
+
+assim_hist_vars = ['Y', 'Kg', 'Kf', 'Eg_ratio', 'Ig_ratio', 'Pf', 'Ef'] # state at the start of each year and outputs of the year
+
+
+def enkf_update(X, HX, y, obs_std, rng):
+    """
+    Stochastic ensemble Kalman filter update (perturbed observations). X (n_state, n_members) is the ensemble of augmented states, HX (n_obs, n_members) the predicted observations, y and obs_std (n_obs) the observations and their errors. Returns the updated X.
+    """
+    n_members = X.shape[1]
+    Xa = X - X.mean(axis = 1, keepdims = True)
+    Ya = HX - HX.mean(axis = 1, keepdims = True)
+    C_xy = Xa @ Ya.T/(n_members - 1)
+    C_yy = Ya @ Ya.T/(n_members - 1) + np.diag(obs_std**2)
+
+    y_pert = y[:, None] + obs_std[:, None] * rng.standard_normal(HX.shape)
+
+    return X + C_xy @ np.linalg.solve(C_yy, y_pert - HX)
+
+
+class EnsembleFilter:
+    """
+    Ensemble Kalman filter (and fixed-lag smoother) for the state (Y, Kg, Kf) and the parameters fit_pars.
+
+    The ensemble of n_members is initialized from inicond and params, with gaussian perturbations of the parameters (std in spread, on the logarithm for positive_pars) and of the initial state (relative std state_spread). Each call of step() runs one year for all members at once (forward_step_batch), and updates state and parameters with the observations of that year, if any: Eg_ratio, Ig_ratio and Pf_obs. Model fossil profits are compared to Pf_obs through a scale factor Pf_scale, estimated with the other parameters.
+
+    With lag > 0, the states and outputs of the last lag years are updated as well (fixed-lag smoother). The cost of a year is the same at any point of the run, no refit from year_ini is needed when new data arrive. gamma_f is set equal to gamma_g, as in cost_function.
+
+    The history of the analysis is available with to_dataset().
+    """
+
+    def __init__(self, inicond = inicond_2015, params = best_params, year_ini = 2015, n_members = 100, fit_pars = default_assim_pars, spread = None, state_spread = 0.01, obs_err = None, lag = 0, inflation = 1., rule = 'maxgreen', betafun_type = 'cdf', seed = None):
+        self.rng = np.random.default_rng(seed)
+        self.year = year_ini
+        self.year_ini = year_ini
+        self.n_members = n_members
+        self.fit_pars = list(fit_pars) + ['Pf_scale']
+        self.spread = dict(default_assim_spread, **(spread or {}))
+        self.obs_err = dict(default_obs_err, **(obs_err or {}))
+        self.lag = lag
+        self.inflation = inflation
+        self.rule = rule
+        self.betafun_type = betafun_type
+
+        self.params = {par: params[par] for par in default_params}
+        center = {par: self.params.get(par, 1.) for par in self.fit_pars}
+        center['Pf_scale'] = params.get('Pf_scale', 1.)
+        self.theta = np.array([self._to_internal(par, center[par]) + self.spread[par] * self.rng.standard_normal(n_members) for par in self.fit_pars])
+
+        self.state = np.array([inicond[ke] * (1 + state_spread * self.rng.standard_normal(n_members)) for ke in ['Y_ini', 'Kg_ini', 'Kf_ini']], dtype = float)
+
+        self.history = [] # one array (len(assim_hist_vars) + len(fit_pars), n_members) per year
+        self.years = []
+        self.n_updates = 0
+
+    @staticmethod
+    def _to_internal(par, val):
+        return np.log(val) if par in positive_pars else val
+
+    @staticmethod
+    def _from_internal(par, val):
+        return np.exp(val) if par in positive_pars else val
+
+    def member_params(self):
+        """
+        Parameters of all members, as arrays for forward_step_batch.
+        """
+        okpar = dict(self.params)
+        for par, val in zip(self.fit_pars, self.theta):
+            if par in okpar: okpar[par] = self._from_internal(par, val)
+        okpar['gamma_f'] = okpar['gamma_g']
+
+        return okpar
+
+    def forecast(self):
+        """
+        Runs one year for all members. Returns the new state and the outputs of the year.
+        """
+        Y, Kg, Kf = self.state
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            Y_n, Kg_n, Kf_n, E, Eg, Ef, Ig, If, Pg, Pf, success = forward_step_batch(Y, Kg, Kf, params = self.member_params(), rule = self.rule, betafun_type = self.betafun_type)
+        outputs = {'Y': Y, 'Kg': Kg, 'Kf': Kf, 'Eg_ratio': Eg/E, 'Ig_ratio': Ig/(Ig + If), 'Pf': Pf, 'Ef': Ef}
+
+        return np.array([Y_n, Kg_n, Kf_n]), outputs
+
+    def predicted_obs(self, outputs):
+        """
+        Model equivalents of the observations.
+        """
+        Pf_scale = self._from_internal('Pf_scale', self.theta[self.fit_pars.index('Pf_scale')])
+
+        return {'Eg_ratio': outputs['Eg_ratio'], 'Ig_ratio': outputs['Ig_ratio'], 'Pf_obs': Pf_scale * outputs['Pf']}
+
+    def step(self, obs = None):
+        """
+        Forecast of one year and update with the observations of that year (dict with values for some of Eg_ratio, Ig_ratio, Pf_obs; nan or missing are skipped).
+        """
+        state_new, outputs = self.forecast()
+        self.history.append(np.concatenate([np.array([outputs[var] for var in assim_hist_vars]), self.theta]))
+        self.years.append(self.year)
+
+        obs = {var: val for var, val in (obs or {}).items() if var in self.obs_err and np.isfinite(val)}
+        if len(obs) > 0:
+            if self.inflation != 1.:
+                mean = self.theta.mean(axis = 1, keepdims = True)
+                self.theta = mean + self.inflation * (self.theta - mean)
+
+            pred = self.predicted_obs(outputs)
+            HX = np.array([pred[var] for var in obs])
+            y = np.array([obs[var] for var in obs], dtype = float)
+            obs_std = np.array([self.obs_err[var] for var in obs])
+
+            window = self.history[-(self.lag + 1):]
+            n_st = len(state_new)
+            n_th = len(self.theta)
+            X = np.concatenate([state_new, self.theta] + window)
+            ok = np.all(np.isfinite(HX), axis = 0)
+            X[:, ok] = enkf_update(X[:, ok], HX[:, ok], y, obs_std, self.rng)
+
+            state_new = X[:n_st]
+            self.theta = X[n_st:n_st + n_th]
+            n_hist = len(window[0])
+            for k in range(len(window)):
+                self.history[len(self.history) - len(window) + k] = X[n_st + n_th + k*n_hist:n_st + n_th + (k+1)*n_hist]
+            # the parameters of the current year are the updated ones
+            self.history[-1][len(assim_hist_vars):] = self.theta
+            self.n_updates += 1
+
+        self.state = np.maximum(state_new, 1e-10)
+        self.year += 1
+
+    def run(self, year_end = 2023, obs = None):
+        """
+        Steps up to year_end (included), assimilating obs (dict of DataArrays along year, default: assim_obs()). Returns to_dataset().
+        """
+        if obs is None: obs = assim_obs()
+        while self.year <= year_end:
+            obs_year = {var: float(obs[var].sel(year = self.year)) for var in obs if self.year in obs[var].year}
+            self.step(obs_year)
+
+        return self.to_dataset()
+
+    def to_dataset(self):
+        """
+        History of the analysis as a Dataset with "year" and "member" dimensions (smoothed for the last years if lag > 0). Parameters are in physical units.
+        """
+        hist = np.array(self.history)
+        data_vars = {var: (['year', 'member'], hist[:, i]) for i, var in enumerate(assim_hist_vars)}
+        for j, par in enumerate(self.fit_pars):
+            data_vars[par] = (['year', 'member'], self._from_internal(par, hist[:, len(assim_hist_vars) + j]))
+
+        return xr.Dataset(data_vars = data_vars, coords = {'year': self.years, 'member': np.arange(self.n_members)}, attrs = {'lag': self.lag, 'n_updates': self.n_updates})
+
+
+################################################################################################################
+######################################## Bootstrap
+
+def _block_indices(n_years, rng, block = 1):
+    """
+    Indices of a moving block bootstrap sample: contiguous blocks of block indices at random starts, concatenated in order and trimmed to n_years.
+    """
+    block = min(block, n_years)
+    starts = rng.integers(0, n_years - block + 1, size = int(np.ceil(n_years/block)))
+
+    return np.concatenate([np.arange(st, st + block) for st in starts])[:n_years]
+
+
+def _resample_years(years, rng, block = 1):
+    """
+    Multiplicity of each year in a (moving block) bootstrap sample of years.
+    """
+    n_years = len(years)
+    idx = _block_indices(n_years, rng, block = block)
+
+    return xr.DataArray(np.bincount(idx, minlength = n_years).astype(float), dims = ['year'], coords = {'year': years})
+
+
+def bootstrap_samples(parnames, best_x, n_boot = 100, method = 'years', block = 1, seed = None, **cost_kw):
+    """
+    Bootstrap replicates of the observations used by cost_function (cost_kw are passed to it), as a list of dicts of arguments for cost_function:
+        - method = 'years': years of each observed variable are resampled with replacement (in blocks of block years), giving year_weights;
+        - method = 'residuals': residuals of the fit best_x are resampled in blocks of block years (kept in order) and added to the fitted values, giving new obs;
+        - method = 'jackknife': each year with observations is left out in turn (n_boot is ignored).
+    """
+    rng = np.random.default_rng(seed)
+    year_ini = cost_kw.get('year_ini', 2015)
+    year_end = cost_kw.get('year_end', 2025)
+    obs = cost_kw.get('obs', None)
+    if obs is None: obs = fit_obs(all_green = cost_kw.get('all_green', False))
+    obs = {var: obs[var].sel(year = slice(year_ini, year_end - 1)).dropna('year') for var in obs}
+
+    samples = []
+    if method == 'years':
+        for _ in range(n_boot):
+            samples.append({'year_weights': {var: _resample_years(obs[var].year.values, rng, block = block) for var in obs}})
+    elif method == 'residuals':
+        kw = dict(cost_kw, params = cost_kw.get('params', default_params).copy())
+        params = fit_params(best_x, parnames, kw.pop('params'), year_ini = year_ini, year_end = year_end)
+        resu = run_model(inicond = kw.get('inicond', inicond_2015), params = params, n_iter = year_end - year_ini, year_ini = year_ini, verbose = False, rule = 'maxgreen', extend_constant = True, linear_gdp = kw.get('linear_gdp', None), gdp = kw.get('gdp', None))
+        fitted = {var: resu[var].sel(year = obs[var].year) for var in obs}
+        resid = {var: (obs[var] - fitted[var]).values for var in obs}
+        for _ in range(n_boot):
+            new_obs = dict()
+            for var in obs:
+                # blocks keep the autocorrelation of the residuals
+                new_obs[var] = fitted[var] + resid[var][_block_indices(len(resid[var]), rng, block = block)]
+            samples.append({'obs': new_obs})
+    elif method == 'jackknife':
+        all_years = np.unique(np.concatenate([obs[var].year.values for var in obs]))
+        for year in all_years:
+            samples.append({'year_weights': {var: xr.DataArray((obs[var].year.values != year).astype(float), dims = ['year'], coords = {'year': obs[var].year.values}) for var in obs}})
+    else:
+        raise ValueError(f'Unknown method {method}. Allowed: years, residuals, jackknife')
+
+    return samples
+
+
+def bootstrap(parnames, best_x, bounds, n_boot = 100, method = 'years', block = 1, seed = None, level = 0.9, backend = 'serial', n_workers = None, opt_method = None, tol = 1e-10, **cost_kw):
+    """
+    Bootstrap (or jackknife) uncertainty of calibrated parameters: cost_function is refit for each replicate of the observations (see bootstrap_samples), starting from the central fit best_x. Refits are run in parallel with the chosen backend.
+
+    Returns a Dataset with the parameters and cost of each replicate (along "replicate"), their standard deviation ("std", with the jackknife formula for method = 'jackknife') and the central interval at level ("ci_low", "ci_high"). See bootstrap_projection to propagate the replicates to the model projections.
+    """
+    samples = bootstrap_samples(parnames, best_x, n_boot = n_boot, method = method, block = block, seed = seed, **cost_kw)
+
+    tasks = [(np.array(best_x, dtype = float), parnames, bounds, dict(cost_kw, **sample), opt_method, tol) for sample in samples]
+    results = map_tasks(_fit_task, tasks, backend = backend, n_workers = n_workers)
+
+    pars = np.array([res.x for res in results])
+    n_rep = len(pars)
+    if method == 'jackknife':
+        std = np.sqrt((n_rep - 1)/n_rep * np.sum((pars - pars.mean(axis = 0))**2, axis = 0))
+    else:
+        std = pars.std(axis = 0, ddof = 1)
+
+    ds = xr.Dataset(data_vars = {
+        'params': (['replicate', 'parameter'], pars),
+        'cost': (['replicate'], np.array([res.fun for res in results])),
+        'success': (['replicate'], np.array([res.success for res in results])),
+        'best': (['parameter'], np.array(best_x, dtype = float)),
+        'std': (['parameter'], std),
+        'ci_low': (['parameter'], np.quantile(pars, (1 - level)/2, axis = 0)),
+        'ci_high': (['parameter'], np.quantile(pars, (1 + level)/2, axis = 0)),
+        }, coords = {'replicate': np.arange(n_rep), 'parameter': list(parnames)}, attrs = {'method': method, 'block': block, 'level': level})
+
+    return ds
+
+
+def bootstrap_projection(boot, params = default_params, inicond = inicond_2015, year_ini = 2015, n_iter = 100, year_fit = None, quantiles = [0.05, 0.5, 0.95], **kwargs):
+    """
+    Runs the model for all the bootstrap replicates in boot (output of bootstrap) at once, as an ensemble (kwargs are passed to run_ensemble). params are the fixed parameters, the fitted ones are set as in cost_function (scenarios start at year_fit, default year_ini).
+
+    Returns the ensemble Dataset (one member per replicate) and the quantiles of year_peak, year_zero and year_halved (over replicates where the transition is completed, with the fraction of those in "frac_success").
+    """
+    if year_fit is None: year_fit = year_ini
+    parnames = list(boot.parameter.values)
+    years = np.arange(year_ini, year_ini + n_iter)
+
+    params_list = [fit_params(xx, parnames, params.copy(), year_ini = year_fit, year_end = year_ini + n_iter) for xx in boot.params.values]
+    for pars in params_list:
+        for par in pars:
+            if isinstance(pars[par], np.ndarray) and pars[par].ndim > 0:
+                pars[par] = xr.DataArray(pars[par], dims = ['year'], coords = {'year': np.arange(year_fit, year_fit + len(pars[par]))})
+
+    ens = run_ensemble(inicond = inicond, params = stack_members(params_list, years), n_iter = n_iter, year_ini = year_ini, n_members = len(params_list), **kwargs)
+
+    ok = ens.success.values > 0
+    summary = xr.Dataset(data_vars = {var: (['quantile'], np.quantile(ens[var].values[ok], quantiles) if np.any(ok) else np.full(len(quantiles), np.nan)) for var in ['year_peak', 'year_zero', 'year_halved']}, coords = {'quantile': quantiles}, attrs = {'frac_success': ok.mean()})
+
+    return ens, summary
+
+
+################################################################################################################
+######################################## Time step
+
+def step_params(params, dt):
+    """
+    Parameters for a step of dt years: depreciation and growth rates are compounded ((1-delta)^dt, (1+growth)^dt), the reinvested fraction of profits (a flow per year) is multiplied by dt. With dt = 1, params are unchanged.
+    """
+    if dt == 1:
+        return params
+
+    okpar = dict(params)
+    okpar['delta_g'] = 1 - (1 - params['delta_g'])**dt
+    okpar['delta_f'] = 1 - (1 - params['delta_f'])**dt
+    okpar['growth'] = (1 + params['growth'])**dt - 1
+    okpar['r_inv'] = params['r_inv'] * dt
+
+    return okpar
+
+
+def _dt_step(state, t, dt, pp, year_ini, rule, betafun_type, linear_gdp):
+    """
+    One step of dt years from time t. Returns the new state and the outputs at t (investments per year).
+    """
+    i_year = min(int(np.floor(t - year_ini + 1e-9)), len(pp['growth']) - 1)
+    okpar = step_params({par: val[i_year] for par, val in pp.items()}, dt)
+    Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, success = forward_step_batch(*state, params = okpar, rule = rule, betafun_type = betafun_type, linear_gdp = None if linear_gdp is None else linear_gdp * dt)
+
+    return (float(Y), float(Kg), float(Kf)), [float(E), float(Eg), float(Ef), float(Ig)/dt, float(If)/dt, float(Pg), float(Pf)], int(success)
+
+
+def _dt_rates(state, okpar, rule, betafun_type, linear_gdp):
+    """
+    Time derivative of the state (Y, Kg, Kf) in the limit dt -> 0 of step_params, with the outputs of the year at this state.
+    """
+    Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, success = forward_step_batch(*state, params = okpar, rule = rule, betafun_type = betafun_type, linear_gdp = linear_gdp)
+    dY = state[0] * np.log(1 + okpar['growth']) if linear_gdp is None else linear_gdp
+    dKg = Ig + state[1] * np.log(1 - okpar['delta_g'])
+    dKf = If + state[2] * np.log(1 - okpar['delta_f'])
+
+    return np.array([dY, dKg, dKf], dtype = float), [float(E), float(Eg), float(Ef), float(Ig), float(If), float(Pg), float(Pf)], int(success)
+
+
+def _dt_Ef(state, okpar, rule):
+    Y, Kg, Kf = state
+    return float(partition_energy(rule, okpar['eps'] * Y, okpar['a'] * Kg, okpar['b'] * Kf, Y, Kg, Kf, okpar)[1])
+
+
+def _dt_dEf(state, rates, okpar, rule, eps = 1e-7):
+    """
+    Time derivative of Ef along the rates of the state (forward difference).
+    """
+    return (_dt_Ef(state + eps * rates, okpar, rule) - _dt_Ef(state, okpar, rule))/eps
+
+
+def _hermite(s0, f0, s1, f1, h, theta):
+    """
+    Cubic Hermite interpolation of the state (and of its derivative) at a fraction theta of a step of length h.
+    """
+    th2, th3 = theta**2, theta**3
+    state = (2*th3 - 3*th2 + 1) * s0 + (th3 - 2*th2 + theta) * h * f0 + (3*th2 - 2*th3) * s1 + (th3 - th2) * h * f1
+    rates = ((6*th2 - 6*theta) * s0 + (3*th2 - 4*theta + 1) * h * f0 + (6*theta - 6*th2) * s1 + (3*th2 - 2*theta) * h * f1)/h
+
+    return state, rates
+
+
+def _bisect_step(cond, n_bisect = 40):
+    """
+    Smallest fraction theta in (0, 1] of a step where cond(theta) is True (cond(1) is True, cond(0) is False).
+    """
+    lo, hi = 0., 1.
+    for _ in range(n_bisect):
+        mid = (lo + hi)/2
+        if cond(mid): 
+            hi = mid
+        else:
+            lo = mid
+
+    return hi
+
+
+# Dormand-Prince 5(4) pair
+_dp_c = np.array([0., 1/5, 3/10, 4/5, 8/9, 1., 1.])
+_dp_a = [[], [1/5], [3/40, 9/40], [44/45, -56/15, 32/9], [19372/6561, -25360/2187, 64448/6561, -212/729], [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656], [35/384, 0., 500/1113, 125/192, -2187/6784, 11/84]]
+_dp_b = np.array([35/384, 0., 500/1113, 125/192, -2187/6784, 11/84, 0.])
+_dp_err = _dp_b - np.array([5179/57600, 0., 7571/16695, 393/640, -92097/339200, 187/2100, 1/40])
+
+
+def _event_years(times, Ef, i_stop, success):
+    """
+    Years of peak fossil energy, its halving and transition completion from samples of Ef at times (up to index i_stop).
+    """
+    if success != 1:
+        return np.nan, np.nan, np.nan
+
+    times = np.asarray(times[:i_stop + 1])
+    Ef = np.asarray(Ef[:i_stop + 1])
+    i_peak = int(np.argmax(Ef))
+    i_half = len(Ef) - 1
+    for k in range(i_peak, len(Ef)):
+        if Ef[k] <= Ef[i_peak]/2.: 
+            i_half = k
+            break
+
+    return times[i_stop], times[i_peak], times[i_half]
+
+
+def _run_adaptive(state, pp, year_ini, n_iter, h, tol, dt_min, dt_max, rule, betafun_type, linear_gdp, verbose):
+    """
+    Adaptive integration of the continuous-time model for run_model_dt. Returns the states at the start of each year, the outputs of each year, success, the event times, the number of accepted steps and of evaluations of the rates, and the accepted steps (start time, length, state and rates at both ends) for the dense output.
+    """
+    states = [np.array(state, dtype = float)]
+    flows = []
+    steps = []
+    success = 0
+    n_steps, n_evals = 0, 0
+    t_peak, Ef_peak, t_half, t_zero = None, -np.inf, None, None
+
+    for i_year in range(n_iter):
+        okpar = {par: val[i_year] for par, val in pp.items()}
+        s = states[-1]
+        f, out, succ = _dt_rates(s, okpar, rule, betafun_type, linear_gdp)
+        n_evals += 1
+        flows.append(out)
+        if succ > 0 and success == 0:
+            success = succ
+            if verbose: print(f'{"Transition completed" if succ == 1 else "Energy scarcity"} at year: {year_ini + i_year}!')
+        if i_year == 0 and _dt_dEf(s, f, okpar, rule) <= 0:
+            t_peak, Ef_peak = float(year_ini), _dt_Ef(s, okpar, rule)
+
+        # steps up to the end of the year, parameters are constant within the year
+        t = 0.
+        while t < 1. - 1e-12:
+            h = min(h, dt_max, 1. - t)
+            ks = [f]
+            for j in range(1, 7):
+                ks.append(_dt_rates(s + h * sum(a_jk * k for a_jk, k in zip(_dp_a[j], ks)), okpar, rule, betafun_type, linear_gdp)[0])
+            n_evals += 6
+            s_new = s + h * sum(b_j * k for b_j, k in zip(_dp_b, ks))
+            err_vec = h * sum(e_j * k for e_j, k in zip(_dp_err, ks))
+            err = np.max(np.abs(err_vec)/(tol + tol * np.maximum(np.abs(s), np.abs(s_new))))
+
+            if err > 1. and h > dt_min:
+                h = max(h * max(0.2, 0.9 * err**-0.2), dt_min)
+                continue
+
+            f_new = ks[-1]
+            t0 = year_ini + i_year + t
+            interp = lambda theta: _hermite(s, f, s_new, f_new, h, theta)
+            Ef_0, Ef_1 = _dt_Ef(s, okpar, rule), _dt_Ef(s_new, okpar, rule)
+
+            if t_zero is None and Ef_0 > 0 and Ef_1 <= 0:
+                t_zero = t0 + h * _bisect_step(lambda th: _dt_Ef(interp(th)[0], okpar, rule) <= 0)
+            if t_zero is None:
+                if _dt_dEf(s, f, okpar, rule) > 0 and _dt_dEf(s_new, f_new, okpar, rule) <= 0:
+                    theta = _bisect_step(lambda th: _dt_dEf(*interp(th), okpar, rule) <= 0)
+                    Ef_max = _dt_Ef(interp(theta)[0], okpar, rule)
+                    if Ef_max > Ef_peak:
+                        t_peak, Ef_peak, t_half = t0 + h * theta, Ef_max, None
+                if t_peak is not None and t_half is None and Ef_1 <= Ef_peak/2:
+                    t_half = t0 + h * _bisect_step(lambda th: _dt_Ef(interp(th)[0], okpar, rule) <= Ef_peak/2)
+
+            steps.append((t0, h, s, f, s_new, f_new))
+            t += h
+            n_steps += 1
+            s, f = s_new, f_new
+            h = h * min(5., max(0.2, 0.9 * max(err, 1e-10)**-0.2))
+
+        states.append(s)
+        if success > 0:
+            break
+
+    return np.array(states), np.array(flows), success, (t_zero, t_peak, t_half), n_steps, n_evals, steps
+
+
+def _dense_states(steps, t_out):
+    """
+    State at times t_out from the steps of _run_adaptive, with the cubic interpolation within each step. nan outside the run.
+    """
+    t_starts = np.array([st[0] for st in steps])
+    t_end = steps[-1][0] + steps[-1][1]
+    out = np.full((3, len(t_out)), np.nan)
+    for j, t in enumerate(t_out):
+        if t < t_starts[0] or t > t_end + 1e-9: continue
+        t0, h, s0, f0, s1, f1 = steps[max(np.searchsorted(t_starts, t, side = 'right') - 1, 0)]
+        out[:, j] = _hermite(s0, f0, s1, f1, h, min((t - t0)/h, 1.))[0]
+
+    return out
+
+
+def run_model_dt(inicond = default_inicond, params = default_params, n_iter = 100, year_ini = None, dt = 1., adaptive = False, tol = 1e-6, dt_min = 1e-6, dt_max = 1., rule = 'maxgreen', betafun_type = 'cdf', linear_gdp = None, extend_constant = False, verbose = False, t_out = None):
+    """
+    Runs the model with a time step of dt years (rates are converted with step_params), or with an adaptive step (adaptive = True, dt is the first step).
+
+    In adaptive mode, the model is integrated in the limit dt -> 0 (dK/dt = I + log(1-delta) K, dY/dt = log(1+growth) Y) with an embedded Runge-Kutta 5(4) pair (Dormand-Prince): a step is accepted if the error estimate is below tol, relative to the state (absolute below 1), the next step is changed accordingly within dt_min and dt_max. Steps end at each year, where parameter scenarios change. The peak of fossil energy, its halving and the completion of the transition are located within steps by bisection on the cubic interpolation of the state.
+
+    Outputs are on the year grid as in run_model (flows of the year and state at its end), and the run stops in the same way. With dt = 1 (not adaptive), the result is the same as run_model. In adaptive mode, event years (year_zero, year_peak, year_halved in attrs) are fractional.
+
+    The uniform step converges to the same limit at first order in dt. With best_params from 2015 (or 2000), against the limit extrapolated from dt = 1/128 and 1/256, event years are 0.24 yr off with dt = 1/16 (1408 evaluations of the model) and 0.06 yr off with dt = 1/64 (5632 evaluations); the adaptive step is within 0.01 yr for tol from 1e-4 to 1e-8, with 620 to 820 evaluations (steps are at most one year).
+
+    Returns a ModelResult, with the number of steps and of evaluations of the model (n_steps, n_evals) in attrs. If t_out is given (times in fractional years, e.g. year_ini + 1 is the end of the first year), the state is also interpolated at t_out from the steps, with the cubic interpolation of the adaptive step or linearly between uniform steps (nan outside the run), and a Dataset with Y, Kg and Kf along "time" is returned as well: resu, dense = run_model_dt(..., t_out = t_out).
+    """
+    if year_ini is None:
+        raise ValueError(f'{year_ini} not set!')
+
+    years = np.arange(year_ini, year_ini + n_iter)
+    pp = _control_params(params, years)
+    if t_out is not None:
+        t_out = np.atleast_1d(np.asarray(t_out, dtype = float))
+    state = (float(inicond['Y_ini']), float(inicond['Kg_ini']), float(inicond['Kf_ini']))
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        if adaptive:
+            states, flows, success, (t_zero, t_peak, t_half), n_steps, n_evals, steps = _run_adaptive(state, pp, year_ini, n_iter, dt, tol, dt_min, dt_max, rule, betafun_type, linear_gdp, verbose)
+            if t_out is not None:
+                dense = _dense_states(steps, t_out)
+            n_out = len(flows)
+            out = np.concatenate([states[1:].T, flows.T])
+            if success == 1:
+                year_zero = year_ini + n_out - 1 if t_zero is None else t_zero
+                year_peak, year_halved = t_peak, (year_zero if t_half is None else t_half)
+            else:
+                year_zero, year_peak, year_halved = np.nan, np.nan, np.nan
+        else:
+            t_end = float(year_ini + n_iter)
+            t = float(year_ini)
+            times = [t] # times of the states
+            states = [state]
+            flow_times = [] # times of the outputs (start of each step)
+            flows = []
+            i_stop = None
+            success = 0
+
+            # after a stop, steps go on up to the end of the year (for the state at the end of the year)
+            while t < t_end - 1e-9 and (i_stop is None or t < np.floor(flow_times[i_stop] + 1e-9) + 1 - 1e-9):
+                h = min(dt, t_end - t)
+                new_state, out, succ = _dt_step(state, t, h, pp, year_ini, rule, betafun_type, linear_gdp)
+                flow_times.append(t)
+                flows.append(out)
+                times.append(t + h)
+                states.append(new_state)
+                if succ > 0 and i_stop is None:
+                    i_stop = len(flows) - 1
+                    success = succ
+                    if verbose: print(f'{"Transition completed" if succ == 1 else "Energy scarcity"} at time: {t}!')
+                t = times[-1]
+                state = states[-1]
+
+            flows = np.array(flows)
+            states = np.array(states)
+            if i_stop is None:
+                n_out = n_iter
+                i_last = len(flows) - 1
+            else:
+                n_out = int(np.floor(flow_times[i_stop] + 1e-9)) - year_ini + 1
+                i_last = i_stop
+
+            years_out = np.arange(year_ini, year_ini + n_out)
+            out = np.empty((len(resu_vars), n_out))
+            for k in range(3):
+                out[k] = np.interp(years_out + 1, times, states[:, k])
+            for k in range(7):
+                out[3 + k] = np.interp(years_out, flow_times, flows[:, k])
+
+            year_zero, year_peak, year_halved = _event_years(flow_times, flows[:, 2], i_last, success)
+            n_steps = n_evals = len(flows)
+            if t_out is not None:
+                dense = np.array([np.interp(t_out, times, states[:, k], left = np.nan, right = np.nan) for k in range(3)])
+
+    if extend_constant and n_out < n_iter:
+        out = np.concatenate([out, np.repeat(out[:, -1:], n_iter - n_out, axis = 1)], axis = 1)
+
+    attrs = {'success': success == 1, 'year_zero': year_zero, 'year_peak': year_peak, 'year_halved': year_halved, 'n_steps': n_steps, 'n_evals': n_evals}
+    resu = ModelResult(out, year_ini = year_ini, attrs = attrs)
+
+    if t_out is not None:
+        dense = xr.Dataset(data_vars = {var: (['time'], dense[k]) for k, var in enumerate(['Y', 'Kg', 'Kf'])}, coords = {'time': t_out})
+        return resu, dense
+
+    return resu
+
+
+################################################################################################################
+######################################## Stepper
+
+class ModelStepper:
+    """
+    The model as a resumable object, to be advanced year by year (e.g. when coupled with a climate or macro model).
+
+    Holds the state (Y, Kg, Kf) of one run or of an ensemble (members defined as in run_ensemble, or by n_members), stepped all at once with forward_step_batch. step(n, overrides) advances n years, optionally changing parameters or the state; diagnostics() gives the current state and the outputs of the last year. snapshot() and restore() save and reset the state cheaply, e.g. for the iterations of a coupled run.
+
+    Unlike run_model, members are not stopped when the transition is completed (flows are still computed), but the first completion or energy scarcity is recorded as in run_model. Parameter scenarios along year are resolved once for horizon years (held constant after). GDP grows with growth or linear_gdp, or is tied to energy capacity with gdp = 'endogenous' (see resolve_gdp); Y can also be set at each step with overrides.
+    """
+
+    def __init__(self, inicond = default_inicond, params = default_params, year_ini = 2015, n_members = None, rule = 'maxgreen', betafun_type = 'cdf', linear_gdp = None, gdp = None, horizon = 1000):
+        n_par = ensemble_size(params, inicond)
+        self.single = n_members is None and n_par is None
+        if n_members is None: n_members = 1 if n_par is None else n_par
+
+        self.n_members = n_members
+        self.year_ini = year_ini
+        self.rule = rule
+        self.betafun_type = betafun_type
+        self.linear_gdp = linear_gdp
+        self.gdp = resolve_gdp(gdp, None, linear_gdp = linear_gdp)
+        if self.gdp['type'] not in ['growth', 'linear', 'endogenous']: raise ValueError(f'gdp driver {self.gdp["type"]} not available for ModelStepper')
+
+        members = np.arange(n_members)
+        self.params = resolve_params(params, np.arange(year_ini, year_ini + horizon), members = None if n_par is None else members)
+        self.state = {ke: np.broadcast_to(_member_values(inicond[f'{ke}_ini'], members), (n_members,)).astype(float) for ke in ['Y', 'Kg', 'Kf']}
+        if self.gdp['type'] == 'endogenous':
+            self.l_cap = gdp_capacity_factor(self.gdp, {f'{ke}_ini': val for ke, val in self.state.items()}, self.params_at(0))
+
+        self.i_step = 0
+        self.success = np.zeros(n_members, dtype = int)
+        self.i_stop = np.full(n_members, -1)
+        self.history = []
+        self.last = None
+
+    @property
+    def year(self):
+        """
+        Year of the next step.
+        """
+        return self.year_ini + self.i_step
+
+    def params_at(self, i_step, overrides = None):
+        """
+        Parameters for step i_step, with overrides.
+        """
+        okpar = {par: val[min(i_step, len(val) - 1)] if val.ndim == 2 else val for par, val in self.params.items()}
+        for par, val in (overrides or {}).items():
+            if par in okpar: okpar[par] = np.asarray(val, dtype = float)
+
+        return okpar
+
+    def step(self, n = 1, overrides = None):
+        """
+        Advances n years. overrides is a dict of parameter values (scalars or arrays over members) used for these steps, and/or of new values of the state (Y, Kg, Kf), set before the first step. Returns diagnostics().
+        """
+        overrides = dict(overrides or {})
+        for ke in ['Y', 'Kg', 'Kf']:
+            if ke in overrides:
+                self.state[ke] = np.broadcast_to(np.asarray(overrides.pop(ke), dtype = float), (self.n_members,)).copy()
+        for par in overrides:
+            if par not in default_params: raise ValueError(f'Unknown override {par}')
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            for _ in range(n):
+                okpar = self.params_at(self.i_step, overrides)
+                Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf, succ = forward_step_batch(self.state['Y'], self.state['Kg'], self.state['Kf'], params = okpar, rule = self.rule, betafun_type = self.betafun_type, linear_gdp = self.linear_gdp)
+                if self.gdp['type'] == 'endogenous':
+                    Y = self.l_cap * (okpar['a'] * Kg + okpar['b'] * Kf)
+
+                self.state = {'Y': Y, 'Kg': Kg, 'Kf': Kf}
+                self.last = np.array([Y, Kg, Kf, E, Eg, Ef, Ig, If, Pg, Pf])
+                self.history.append(self.last)
+
+                stop = (self.success == 0) & (succ > 0)
+                self.success[stop] = succ[stop]
+                self.i_stop[stop] = self.i_step
+                self.i_step += 1
+
+        return self.diagnostics()
+
+    def steps(self, n, overrides = None):
+        """
+        Generator advancing n years, one at a time, yielding diagnostics() after each.
+        """
+        for _ in range(n):
+            yield self.step(1, overrides = overrides)
+
+    def diagnostics(self):
+        """
+        Current state and outputs of the last year (with Ig_ratio, Eg_ratio, success flag and completion year). Scalars for a single run, arrays over members for an ensemble.
+        """
+        diag = {'year': self.year - 1}
+        if self.last is not None:
+            diag.update({var: val for var, val in zip(resu_vars, self.last)})
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                diag['Ig_ratio'] = diag['Ig']/(diag['Ig'] + diag['If'])
+                diag['Eg_ratio'] = diag['Eg']/diag['E']
+        diag.update(self.state)
+        diag['success'] = self.success
+        diag['year_stop'] = np.where(self.i_stop >= 0, self.year_ini + self.i_stop, np.nan)
+
+        if self.single:
+            diag = {ke: val[0] if isinstance(val, np.ndarray) and val.ndim > 0 else val for ke, val in diag.items()}
+
+        return diag
+
+    def snapshot(self):
+        """
+        Copy of the current state, to be given to restore(). Past trajectories are not copied.
+        """
+        return {'state': {ke: val.copy() for ke, val in self.state.items()}, 'i_step': self.i_step, 'success': self.success.copy(), 'i_stop': self.i_stop.copy(), 'n_history': len(self.history), 'last': self.last}
+
+    def restore(self, snap):
+        """
+        Goes back to a snapshot (trajectories after it are discarded).
+        """
+        self.state = {ke: val.copy() for ke, val in snap['state'].items()}
+        self.i_step = snap['i_step']
+        self.success = snap['success'].copy()
+        self.i_stop = snap['i_stop'].copy()
+        del self.history[snap['n_history']:]
+        self.last = snap['last']
+
+    def to_dataset(self, stop = False):
+        """
+        Trajectories so far, as a Dataset along member and year (as run_ensemble; a ModelResult for a single run). With stop, steps after the completion of the transition (or energy scarcity) are nan, as in run_model.
+        """
+        n_steps = len(self.history)
+        out = np.empty((len(ensemble_vars), self.n_members, n_steps))
+        out[:len(resu_vars)] = np.moveaxis(np.array(self.history), 0, 2)
+        i_stop = np.where(self.i_stop >= 0, self.i_stop, n_steps - 1)
+        finalize_batch(out, i_stop if stop else np.full(self.n_members, n_steps - 1))
+
+        years = np.arange(self.year_ini, self.year_ini + n_steps)
+        ds = build_ensemble_ds(out, i_stop, self.success, years)
+        if self.single:
+            year_zero, year_peak, year_halved = [float(ds[var][0]) for var in ['year_zero', 'year_peak', 'year_halved']]
+            n_ok = i_stop[0] + 1 if stop else n_steps
+            return ModelResult(out[:len(resu_vars), 0, :n_ok], year_ini = self.year_ini, attrs = {'success': bool(ds.success[0]), 'year_zero': year_zero, 'year_peak': year_peak, 'year_halved': year_halved})
+
+        return ds
+
+
+################################################################################################################
+######################################## Command line
+
+def load_specs(path):
+    """
+    Reads scenario specs (see scenario_from_spec) from a yaml or json file: either a list of specs, or a dict with a "scenarios" list (or a {name: spec} dict) and optional "defaults" shared by all specs. Scenarios without a name are called scenario_<index>.
+    """
+    import json
+
+    with open(path) as fil:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('pyyaml is needed to read yaml files (or use a json file)')
+            conf = yaml.safe_load(fil)
+        else:
+            conf = json.load(fil)
+
+    defaults = dict()
+    scenarios = conf
+    if isinstance(conf, dict):
+        defaults = conf.get('defaults', {})
+        scenarios = conf.get('scenarios', [])
+    if isinstance(scenarios, dict):
+        scenarios = [dict(spec, name = name) for name, spec in scenarios.items()]
+
+    specs = []
+    for i, spec in enumerate(scenarios):
+        spec = dict(defaults, **spec)
+        if 'params' in defaults and 'params' in spec:
+            spec['params'] = dict(defaults['params'], **spec['params'])
+        spec.setdefault('name', f'scenario_{i}')
+        specs.append(spec)
+
+    names = [spec['name'] for spec in specs]
+    if len(set(names)) < len(names): raise ValueError('Duplicated scenario names')
+
+    return specs
+
+
+def _spec_key(spec):
+    import json
+    return json.dumps({ke: va for ke, va in spec.items() if ke != 'vars'}, sort_keys = True)
+
+
+def _spec_settings(spec):
+    """
+    Run settings of a spec, with defaults filled in (see scenario_from_spec).
+    """
+    run_kw = scenario_from_spec(spec)[2]
+    return {'rule': run_kw['rule'], 'betafun_type': run_kw['betafun_type'], 'year_ini': run_kw['year_ini'], 'n_iter': run_kw['n_iter']}
+
+
+def run_scenario_file(path, output, backend = 'serial', n_workers = None, batch_size = 256, chunk_size = 32, overwrite = False, verbose = True):
+    """
+    Runs all scenarios of a yaml/json file (see load_specs) with run_scenarios and writes them to a single netCDF file with a "scenario" dimension.
+
+    Scenarios are run in batches of batch_size, and the output file is updated after each batch. Within a batch, scenarios are run in chunks of chunk_size (see run_ensemble) and progress is printed after each chunk. The run settings of each scenario (rule, betafun_type, year_ini, n_iter, with defaults filled in) are stored as variables along "scenario", and the rules and betafun_types of the file in the attrs.
+
+    Scenarios already in output with the same spec and settings are skipped (unless overwrite, which reruns all scenarios of the file), so an interrupted or extended batch can be resumed. Other scenarios in output are always kept.
+
+    Returns a Dataset with the scenarios of the file.
+    """
+    import time
+
+    specs = load_specs(path)
+    settings = {spec['name']: _spec_settings(spec) for spec in specs}
+
+    done = None
+    todo = specs
+    if os.path.exists(output):
+        with xr.open_dataset(output) as ds_old:
+            done = ds_old.load()
+        # string lengths change with the new scenarios
+        for var in done.variables.values():
+            var.encoding = dict()
+        if not overwrite:
+            todo = [spec for spec in specs if not _scenario_done(done, spec, settings[spec['name']])]
+        done = done.sel(scenario = [name for name in done.scenario.values if name not in {spec['name'] for spec in todo}])
+
+    if verbose: print(f'{len(specs)} scenarios, {len(specs) - len(todo)} already in {output}')
+
+    t0 = time.perf_counter()
+    n_done = 0
+    def progress(n):
+        nonlocal n_done
+        n_done += n
+        if verbose:
+            elapsed = time.perf_counter() - t0
+            print(f'[{n_done}/{len(todo)}] {elapsed:.1f} s, {elapsed/n_done*(len(todo) - n_done):.1f} s left')
+
+    for i in range(0, len(todo), batch_size):
+        batch = todo[i:i+batch_size]
+        results = run_scenarios(batch, backend = backend, n_workers = n_workers, chunk_size = chunk_size, progress = progress)
+
+        new = xr.concat([res.drop_vars('member', errors = 'ignore') for res in results], dim = 'scenario', join = 'outer')
+        new = new.assign_coords(scenario = [spec['name'] for spec in batch])
+        new['spec'] = ('scenario', [_spec_key(spec) for spec in batch])
+        for ke in ['rule', 'betafun_type', 'year_ini', 'n_iter']:
+            new[ke] = ('scenario', [settings[spec['name']][ke] for spec in batch])
+        for var in [var for spec in batch for var in spec.get('vars', [])]:
+            if var not in new: raise ValueError(f'Unknown output variable {var}')
+
+        done = new if done is None else xr.concat([done, new], dim = 'scenario', join = 'outer')
+        done.attrs = {ke + 's': ' '.join(sorted({va for va in done[ke].values if isinstance(va, str)})) for ke in ['rule', 'betafun_type']}
+
+        # written to a temporary file first, so that an interruption does not corrupt the output
+        done.to_netcdf(output + '.tmp')
+        os.replace(output + '.tmp', output)
+
+    if done is not None:
+        done = done.sel(scenario = [spec['name'] for spec in specs])
+
+    return done
+
+
+def _scenario_done(done, spec, settings):
+    """
+    Whether spec is in done (an output of run_scenario_file) with the same spec and run settings.
+    """
+    name = spec['name']
+    if name not in done.scenario.values or str(done.spec.sel(scenario = name).values) != _spec_key(spec):
+        return False
+
+    return all(ke in done and done[ke].sel(scenario = name).values.item() == val for ke, val in settings.items())
+
+
+def main(argv = None):
+    """
+    Command line entry point:
+        python -m lib_ecofun run scenarios.yaml -o results.nc --backend process --n-workers 8
+        python -m lib_ecofun serve --port 8765
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog = 'python -m lib_ecofun', description = 'Runs the SPECTRE model.')
+    sub = parser.add_subparsers(dest = 'command', required = True)
+
+    prun = sub.add_parser('run', help = 'run scenarios from a yaml/json file to a netCDF file')
+    prun.add_argument('specs', help = 'yaml or json file with scenario specs')
+    prun.add_argument('-o', '--output', default = None, help = 'output netCDF file (default: specs file with .nc extension)')
+    prun.add_argument('--backend', default = 'serial', choices = backends)
+    prun.add_argument('--n-workers', type = int, default = None)
+    prun.add_argument('--batch-size', type = int, default = 256, help = 'scenarios run between two writes of the output')
+    prun.add_argument('--chunk-size', type = int, default = 32, help = 'scenarios run between two progress reports')
+    prun.add_argument('--overwrite', action = 'store_true', help = 'rerun the scenarios of the file already in the output (other scenarios in the output are kept)')
+    prun.add_argument('-q', '--quiet', action = 'store_true')
+
+    pserve = sub.add_parser('serve', help = 'start a scenario server (see ScenarioServer)')
+    pserve.add_argument('--host', default = '127.0.0.1')
+    pserve.add_argument('--port', type = int, default = 8765)
+    pserve.add_argument('--path', default = None, help = 'Unix socket path, instead of host and port')
+    pserve.add_argument('--window', type = float, default = 0.02)
+    pserve.add_argument('--backend', default = 'serial', choices = backends)
+    pserve.add_argument('--n-workers', type = int, default = None)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        output = args.output if args.output is not None else os.path.splitext(args.specs)[0] + '.nc'
+        run_scenario_file(args.specs, output, backend = args.backend, n_workers = args.n_workers, batch_size = args.batch_size, chunk_size = args.chunk_size, overwrite = args.overwrite, verbose = not args.quiet)
+    elif args.command == 'serve':
+        serve(host = args.host, port = args.port, path = args.path, window = args.window, backend = args.backend, n_workers = args.n_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,682 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import lib_ecofun as lef
+
+
+year_ini = 2015
+n_iter = 100
+
+
+def run_ref(params = lef.best_params, **kwargs):
+    return lef.run_model(inicond = lef.inicond_2015, params = params, n_iter = n_iter, year_ini = year_ini, verbose = False, **kwargs)
+
+
+################################################################################################################
+######################################## Ensembles
+
+def test_ensemble_member_0_is_run_model():
+    params = lef.best_params.copy()
+    params['growth'] = xr.DataArray([lef.best_params['growth'], 0.01, 0.03], dims = ['member'])
+    ens = lef.run_ensemble(inicond = lef.inicond_2015, params = params, n_iter = n_iter, year_ini = year_ini)
+    resu = run_ref()
+
+    n_ok = resu.data.shape[1]
+    for var in lef.resu_vars:
+        assert np.array_equal(ens[var].values[0, :n_ok], resu.get(var))
+    for var in ['year_zero', 'year_peak', 'year_halved']:
+        assert ens[var].values[0] == resu.attrs[var]
+
+
+def test_noise_reproducible():
+    kw = dict(inicond = lef.inicond_2015, params = lef.best_params, n_iter = n_iter, year_ini = year_ini, n_members = 6, noise = lef.default_noise, autocorr = 0.7)
+    ens = lef.run_ensemble(seed = 1, **kw)
+    assert np.array_equal(ens.Kg.values, lef.run_ensemble(seed = 1, **kw).Kg.values, equal_nan = True)
+    assert not np.array_equal(ens.Kg.values, lef.run_ensemble(seed = 2, **kw).Kg.values, equal_nan = True)
+
+    # member m only depends on (seed, m)
+    sub = lef.gen_noise(lef.default_noise, 50, [3, 4], seed = 1)
+    full = lef.gen_noise(lef.default_noise, 50, np.arange(6), seed = 1)
+    for var in sub:
+        assert np.array_equal(sub[var], full[var][:, 3:5])
+
+
+def test_noise_std_independent_of_autocorr():
+    for autocorr in [0., 0.9]:
+        noise = lef.gen_noise({'growth': 0.01}, 20, np.arange(5000), seed = 0, autocorr = autocorr)['growth']
+        assert abs(noise[-1].std() - 0.01) < 0.001
+
+
+################################################################################################################
+######################################## Execution backends
+
+def test_backends_bitwise_equal():
+    kw = dict(inicond = lef.inicond_2015, params = lef.best_params, n_iter = n_iter, year_ini = year_ini, n_members = 12, noise = lef.default_noise, autocorr = 0.5, seed = 42, chunk_size = 5)
+    ref = lef.run_ensemble(backend = 'serial', **kw)
+    for backend in ['thread', 'process']:
+        ens = lef.run_ensemble(backend = backend, n_workers = 2, **kw)
+        for var in ref.data_vars:
+            assert np.array_equal(ref[var].values, ens[var].values, equal_nan = True), (backend, var)
+
+
+def test_map_tasks_order():
+    tasks = [(i, 10 - i) for i in range(10)]
+    for backend in lef.backends:
+        assert lef.map_tasks(pow, tasks, backend = backend, n_workers = 3) == [pow(*task) for task in tasks]
+
+
+################################################################################################################
+######################################## Scenario server
+
+def test_server_bad_spec_fails_alone():
+    async def submit_all():
+        server = lef.ScenarioServer(window = 0.05)
+        good = [{'params': {'r_inv': 0.1 + 0.01*i}, 'n_iter': 30} for i in range(3)]
+        bad = [{'rule': 'nope'}, {'betafun_type': 'nope'}, {'params': {'nope': 1.}}]
+        out = await asyncio.gather(*[server.submit(spec) for spec in good + bad], return_exceptions = True)
+        return server, out
+
+    server, out = asyncio.run(submit_all())
+    assert all(isinstance(res, dict) for res in out[:3])
+    assert all(isinstance(res, ValueError) for res in out[3:])
+    assert len(server.latencies) == 6
+    assert server.stats()['latency_p50_ms'] is not None
+
+
+def test_server_batch_failure_isolated(monkeypatch):
+    run_scenarios = lef.run_scenarios
+    def failing(specs, *args):
+        if any(spec['n_iter'] == 13 for spec in specs): raise RuntimeError('failed')
+        return run_scenarios(specs, *args)
+    monkeypatch.setattr(lef, 'run_scenarios', failing)
+
+    async def submit_all():
+        server = lef.ScenarioServer(window = 0.05)
+        return await asyncio.gather(*[server.submit({'n_iter': n}) for n in [10, 13, 20]], return_exceptions = True)
+
+    out = asyncio.run(submit_all())
+    assert isinstance(out[0], dict) and isinstance(out[2], dict)
+    assert isinstance(out[1], RuntimeError)
+
+
+def test_server_batches_and_cache():
+    spec = {'params': {'r_inv': 0.12}, 'n_iter': 40, 'vars': ['Eg_ratio']}
+
+    async def submit_all():
+        server = lef.ScenarioServer(window = 0.05)
+        out = await asyncio.gather(*[server.submit(spec) for _ in range(4)], server.submit({'n_iter': 40}))
+        out.append(await server.submit(spec))
+        return server, out
+
+    server, out = asyncio.run(submit_all())
+    assert server.batch_sizes == [2]
+    assert server.stats()['cache_hits'] == 1
+    assert out[0] == out[-1] and list(out[0]) == ['year', 'Eg_ratio', 'year_zero', 'year_peak', 'year_halved', 'success']
+
+    inicond, params, run_kw = lef.scenario_from_spec(spec)
+    resu = lef.run_model(inicond = inicond, params = params, verbose = False, **run_kw)
+    assert np.allclose(out[0]['Eg_ratio'][:len(resu.year)], resu.get('Eg_ratio'))
+
+
+################################################################################################################
+######################################## Model result
+
+def test_model_result_lazy():
+    resu = run_ref()
+    resu.get('Ef')
+    resu['Eg_ratio']
+    assert resu._ds is None
+    assert np.shares_memory(resu.get('Kg'), resu.data)
+
+    assert float(resu.sel(year = 2030).Kg) == resu.get('Kg')[15]
+    assert resu._ds is not None
+
+
+def test_model_result_dataset():
+    resu = run_ref()
+    eager = lef.rebuild_resu(resu.data.T)
+    ds = resu.to_dataset()
+
+    assert list(ds.data_vars) == list(eager)
+    for var in eager:
+        assert np.array_equal(ds[var].values, eager[var], equal_nan = True)
+        assert np.array_equal(resu[var].values, eager[var], equal_nan = True)
+    assert np.array_equal(ds.year.values, np.arange(year_ini, year_ini + len(resu)))
+    assert ds.attrs == resu.attrs
+    assert resu.success and resu['year_zero'] == resu.attrs['year_zero']
+
+
+################################################################################################################
+######################################## Partition rules
+
+def test_run_rules_is_run_model():
+    ds = lef.run_rules(inicond = lef.inicond_2015, params = lef.best_params, n_iter = n_iter, year_ini = year_ini)
+    assert list(ds.rule.values) == list(lef.partition_rules)
+    for rule in lef.partition_rules:
+        resu = run_ref(rule = rule)
+        n_ok = len(resu)
+        for var in ['Kg', 'Kf', 'Ef']:
+            assert np.array_equal(ds[var].sel(rule = rule).values[:n_ok], resu.get(var)), (rule, var)
+
+
+def test_run_rules_paired_noise():
+    kw = dict(inicond = lef.inicond_2015, params = lef.best_params, n_iter = n_iter, year_ini = year_ini, n_members = 8, noise = lef.default_noise, seed = 3)
+    ds = lef.run_rules(rules = ['maxgreen', 'maxgreen'], **kw)
+    ens = lef.run_ensemble(**kw)
+
+    # same rule twice: the noise is the same along "rule"
+    for var in ['Kg', 'Kf', 'Y']:
+        assert np.array_equal(ds[var].isel(rule = 0).values, ds[var].isel(rule = 1).values, equal_nan = True)
+        assert np.array_equal(ds[var].isel(rule = 0).values, ens[var].values, equal_nan = True)
+
+
+################################################################################################################
+######################################## Technology-vector model
+
+@pytest.mark.parametrize('rule', ['maxgreen', 'proportional', 'fair', 'fossil_constraint'])
+def test_techs_from_params_is_run_model(rule):
+    resu = run_ref(rule = rule)
+    inicond = {'Y_ini': lef.inicond_2015['Y_ini'], 'K_ini': [lef.inicond_2015['Kg_ini'], lef.inicond_2015['Kf_ini']]}
+    ds = lef.run_model_tech(inicond, techs = lef.techs_from_params(lef.best_params), params = lef.best_params, n_iter = n_iter, rule = rule, year_ini = year_ini)
+
+    n_ok = len(resu)
+    assert np.allclose(ds.K.values[:n_ok, 0], resu.get('Kg'), rtol = 1e-12)
+    assert np.allclose(ds.K.values[:n_ok, 1], resu.get('Kf'), rtol = 1e-12)
+    assert np.allclose(ds.Ef.values[:n_ok], resu.get('Ef'), rtol = 1e-12, atol = 1e-14)
+    assert bool(ds.success) == resu.success
+
+
+def test_tech_rules():
+    inicond = {'Y_ini': 1., 'K_ini': [0.3, 0.3, 0.3, 0.05, 0.05, 0.02]}
+    for rule in lef.partition_rules:
+        ds = lef.run_model_tech(inicond, params = lef.best_params, n_iter = 20, rule = rule, year_ini = year_ini)
+        assert np.all(np.isfinite(ds.En.values))
+    with pytest.raises(ValueError):
+        lef.run_model_tech(inicond, params = lef.best_params, n_iter = 20, rule = 'nope', year_ini = year_ini)
+
+
+def test_beta_tech_two_techs():
+    pr = np.linspace(-0.5, 0.5, 11)
+    beta = lef.beta_tech(np.array([0.2, 0.]), np.stack([pr, -pr], axis = -1), delta_sig = 0.5)
+    assert np.allclose(beta[:, 0], lef.beta_fun(0.2, pr, delta_sig = 0.5))
+
+
+################################################################################################################
+######################################## Multi-region model
+
+def test_regions_aligned_by_label():
+    regions = ['A', 'B', 'C']
+    params = lef.best_params.copy()
+    params['r_inv'] = xr.DataArray([0.08, 0.12, 0.16], dims = ['region'], coords = {'region': regions})
+    inicond = lef.inicond_regions(xr.DataArray([0.05, 0.1, 0.2], dims = ['region'], coords = {'region': regions}))
+
+    ds = lef.run_model_regions(inicond, params, n_iter = 150, year_ini = year_ini)
+    ds_rev = lef.run_model_regions(inicond, params, regions = ['C', 'B', 'A'], n_iter = 150, year_ini = year_ini)
+    for var in ['Kg', 'Ef', 'year_zero']:
+        assert np.array_equal(ds[var].sel(region = ['C', 'B', 'A']).values, ds_rev[var].values, equal_nan = True)
+
+    for bad in [['A', 'B'], ['A', 'B', 'C', 'D']]:
+        with pytest.raises(ValueError):
+            lef.run_model_regions(inicond, params, regions = bad, n_iter = 10, year_ini = year_ini)
+
+
+def test_regions_scarcity_is_run_model():
+    regions = ['scarce', 'ok']
+    Kg_ini, Kf_ini = [0.1, lef.inicond_2015['Kg_ini']], [0.5, lef.inicond_2015['Kf_ini']]
+    inicond = {'Y_ini': lef.inicond_2015['Y_ini'], 'Kg_ini': xr.DataArray(Kg_ini, dims = ['region'], coords = {'region': regions}), 'Kf_ini': xr.DataArray(Kf_ini, dims = ['region'], coords = {'region': regions})}
+    ds = lef.run_model_regions(inicond, lef.best_params, n_iter = n_iter, year_ini = year_ini)
+
+    for ir, region in enumerate(regions):
+        resu = lef.run_model(inicond = {'Y_ini': lef.inicond_2015['Y_ini'], 'Kg_ini': Kg_ini[ir], 'Kf_ini': Kf_ini[ir]}, params = lef.best_params, n_iter = n_iter, year_ini = year_ini, verbose = False)
+        n_ok = len(resu)
+        for var in ['Kg', 'Kf', 'Ef']:
+            assert np.array_equal(ds[var].sel(region = region).values[:n_ok], resu.get(var))
+        assert bool(ds.success.sel(region = region)) == resu.success
+
+    assert len(ds.year) == n_iter and np.isfinite(ds.Kg.sel(region = 'scarce').values[0])
+    assert np.all(np.isnan(ds.Kg.sel(region = 'scarce').values[1:]))
+
+
+def test_regions_coupling_conserves():
+    regions = ['A', 'B', 'C']
+    mat = lef.coupling_matrix({('A', 'B'): 0.2, ('C', 'A'): 0.1}, regions)
+    X = np.array([1., 2., 3.])
+    assert np.isclose(lef.transfer(mat, X).sum(), X.sum())
+    assert np.allclose(lef.transfer(mat, X), [1. - 0.2 + 0.3, 2. + 0.2, 3. - 0.3])
+
+
+################################################################################################################
+######################################## Ensemble plots
+
+def test_ensemble_quantiles_and_density():
+    vals = np.arange(100.)[:, np.newaxis] + np.zeros(3)
+    vals[90:, 2] = np.nan
+    ens = xr.DataArray(vals, dims = ['member', 'year'], coords = {'year': [2015, 2016, 2017]})
+
+    qq = lef.ensemble_quantiles(ens, quantiles = [0.1, 0.5])
+    assert np.allclose(qq.sel(year = 2015).values, np.quantile(np.arange(100.), [0.1, 0.5]))
+    assert np.allclose(qq.sel(year = 2017).values, np.quantile(np.arange(90.), [0.1, 0.5]))
+
+    density, edges = lef.ensemble_density(ens, bins = 10)
+    assert density.shape == (3, 10) and len(edges) == 11
+    assert np.allclose(density.sum(axis = 1), 1.)
+
+
+def test_plot_ensemble():
+    import matplotlib
+    matplotlib.use('Agg')
+    ens = lef.run_ensemble(inicond = lef.inicond_2015, params = lef.best_params, n_iter = 50, year_ini = year_ini, n_members = 200, noise = lef.default_noise, seed = 0)
+    ax = lef.plot_ensemble(ens, var = 'Eg_ratio', n_lines = 20, density = True)
+    assert len(ax.collections) > 0
+    lef.plot_ensemble_events(ens)
+    lef.plt.close('all')
+
+
+################################################################################################################
+######################################## Profile likelihood
+
+fit_kw = dict(year_ini = year_ini, inicond = lef.inicond_2015, I_weight = 0.1)
+fit_pars = ['beta_0', 'gamma_g']
+fit_bounds = [(-1., 1.), (0.1, 1.)]
+
+
+@pytest.fixture(scope = 'module')
+def best_fit():
+    best, _ = lef.calibrate(fit_pars, [0., 0.5], fit_bounds, n_starts = 1, **fit_kw)
+    return best.x
+
+
+def test_profile_likelihood(best_fit):
+    prof = lef.profile_likelihood(fit_pars, best_fit, fit_bounds, n_grid = 7, n_chains = 1, **fit_kw)
+    assert np.all(prof.deviance.values > -1e-6)
+    assert np.all((prof.ci_low.values < best_fit) & (best_fit < prof.ci_high.values))
+    assert np.allclose(np.diag(prof.corr.values), 1.)
+
+    prof_thread = lef.profile_likelihood(fit_pars, best_fit, fit_bounds, n_grid = 7, n_chains = 2, backend = 'thread', **fit_kw)
+    assert np.allclose(prof_thread.ci_low.values, prof.ci_low.values, atol = 1e-3)
+
+
+def test_param_correlation_at_bound():
+    parnames = ['beta_0', 'growth']
+    best_x = [lef.best_params[par] for par in parnames]
+    bounds = [(-1., 1.), (0., lef.best_params['growth'])]
+    with pytest.warns(UserWarning, match = 'growth'):
+        cov, corr = lef.param_correlation(parnames, best_x, bounds = bounds, params = lef.best_params, year_ini = year_ini, inicond = lef.inicond_2015)
+
+    assert np.all(np.isnan(cov.sel(parameter = 'growth').values))
+    assert np.isfinite(cov.sel(parameter = 'beta_0', parameter2 = 'beta_0').values)
+
+
+def test_param_correlation_stencil_within_bounds(monkeypatch, best_fit):
+    rel_step = 1e-3
+    steps = rel_step * np.maximum(np.abs(best_fit), 1e-2)
+    # gamma_g 1.5 steps from its upper bound
+    bounds = [fit_bounds[0], (0.1, best_fit[1] + 1.5*steps[1])]
+
+    cost_kw = lef._cost_kw
+    evaluated = []
+    def recording(xx, *args):
+        evaluated.append(np.array(xx))
+        return cost_kw(xx, *args)
+    monkeypatch.setattr(lef, '_cost_kw', recording)
+
+    with pytest.warns(UserWarning, match = 'gamma_g'):
+        cov, corr = lef.param_correlation(fit_pars, best_fit, rel_step = rel_step, bounds = bounds, **fit_kw)
+    lo, hi = np.array(bounds).T
+    assert all(np.all((lo <= xx) & (xx <= hi)) for xx in evaluated)
+    assert np.all(np.isnan(cov.sel(parameter = 'gamma_g').values))
+    assert cov.sel(parameter = 'beta_0', parameter2 = 'beta_0').values > 0
+
+
+################################################################################################################
+######################################## Hindcast
+
+def test_hindcast():
+    start_years = np.arange(2000, 2006)
+    table, ds = lef.hindcast(fit_pars, [0., 0.5], fit_bounds, start_years = start_years, fit_years = 5, horizon = 5)
+    assert len(table) == len(start_years)
+    assert np.all(ds.n_heldout.values == 5)
+    assert np.allclose(ds.skill.values, 1 - ds.rmse_forecast.values/ds.rmse_persistence.values)
+
+    obs = lef.fit_obs()['Eg_ratio']
+    for start in start_years:
+        last = float(obs.sel(year = start + 4))
+        held = obs.sel(year = slice(start + 5, start + 9)).values
+        assert np.isclose(float(ds.rmse_persistence.sel(year_ini = start)), np.sqrt(np.mean((held - last)**2)))
+
+    # forecasts are run_model with the fitted parameters
+    params = lef.fit_params(ds.params.sel(year_ini = 2003).values, fit_pars, lef.default_params.copy(), year_ini = 2003, year_end = 2008)
+    resu = lef.run_model(inicond = lef.inicond_yr(2003), params = params, n_iter = 10, year_ini = 2003, verbose = False, extend_constant = True)
+    assert np.allclose(ds.Eg_ratio.sel(year_ini = 2003, year = slice(2003, 2012)).values, resu.get('Eg_ratio'))
+
+
+################################################################################################################
+######################################## Pareto front
+
+def test_pareto_front():
+    kw = dict(year_ini = year_ini, inicond = lef.inicond_2015)
+    front = lef.pareto_front(fit_pars, [0., 0.5], fit_bounds, n_weights = 5, n_eps = 3, **kw)
+    assert set(front.sweep.values) <= {'weighted', 'epsilon'}
+
+    for ip in range(front.sizes['point']):
+        comp = lef.cost_function(front.params.isel(point = ip).values, parnames = fit_pars, params = lef.default_params.copy(), components = True, **kw)
+        for obj in front.attrs['objectives']:
+            assert np.isclose(comp[obj], float(front[f'cost_{obj}'].isel(point = ip)))
+
+    costs = np.stack([front.cost_Ig_ratio.values, front.cost_Eg_ratio.values], axis = 1)
+    assert np.array_equal(front.pareto.values, lef.pareto_mask(costs))
+
+    pars, ipoint = lef.pareto_select(front, I_weight = 0.1)
+    assert list(pars) == fit_pars
+    assert bool(front.pareto.sel(point = ipoint))
+
+
+def test_pareto_mask():
+    costs = np.array([[0., 3.], [1., 1.], [2., 2.], [3., 0.], [1., 1.]])
+    assert list(lef.pareto_mask(costs)) == [True, True, False, True, True]
+
+
+def test_pareto_select_I_weight():
+    costs = {'cost_Ig_ratio': [0., 1., 2., 3., 4.], 'cost_Eg_ratio': [4., 2.5, 1.5, 1., 0.9]}
+    front = xr.Dataset(data_vars = {var: ('point', val) for var, val in costs.items()}, coords = {'point': np.arange(5), 'parameter': ['r_inv']}, attrs = {'objectives': ['Ig_ratio', 'Eg_ratio']})
+    front['pareto'] = ('point', np.ones(5, dtype = bool))
+    front['params'] = (['point', 'parameter'], np.zeros((5, 1)))
+
+    assert lef.pareto_select(front, I_weight = 1.)[1] == lef.pareto_select(front, weight = 0.5)[1] == 1
+    assert lef.pareto_select(front, I_weight = 0.1)[1] == lef.pareto_select(front, weight = 0.1)[1] == 3
+    with pytest.raises(ValueError):
+        lef.pareto_select(front)
+
+
+################################################################################################################
+######################################## Optimal policy
+
+def test_control_rollout_is_run_model():
+    years = np.arange(2015, 2051)
+    params = lef.best_params.copy()
+    u = np.full(len(years), params['beta_0']) + 0.1*np.sin(np.arange(len(years))/5)
+    params_u = dict(params, beta_0 = xr.DataArray(u, dims = ['year'], coords = {'year': years}))
+    resu = lef.run_model(inicond = lef.inicond_2015, params = params_u, n_iter = len(years), year_ini = year_ini, verbose = False)
+
+    tape = lef.control_rollout(u, lef.inicond_2015, params, years, control = 'beta_0')
+    n_ok = len(resu)
+    assert np.allclose(tape['Ef'][:n_ok], resu.get('Ef'), rtol = 1e-12)
+    # the tape holds the state at the start of each year, run_model at its end
+    assert np.allclose(tape['Kg'][1:n_ok], resu.get('Kg')[:n_ok-1], rtol = 1e-12)
+
+
+@pytest.mark.parametrize('control', ['beta_0', 'gamma_g'])
+def test_adjoint_gradient(control):
+    years = np.arange(2015, 2031)
+    n = len(years)
+    params = lef.best_params.copy()
+    u = np.full(n, params[control]) + 0.1*np.sin(np.arange(n)/5)
+    rng = np.random.default_rng(0)
+    w_Ef, w_sub = rng.random(n), rng.random(n)
+
+    def cost(uu):
+        tape = lef.control_rollout(uu, lef.inicond_2015, params, years, control = control, u_ref = params[control])
+        return np.sum(w_Ef*tape['Ef'] + w_sub*tape['sub'])
+
+    grad = lef.control_adjoint(lef.control_rollout(u, lef.inicond_2015, params, years, control = control, u_ref = params[control]), w_Ef, w_sub)
+    h = 1e-6
+    fd = np.array([(cost(u + h*ee) - cost(u - h*ee))/(2*h) for ee in np.eye(n)])
+
+    assert np.allclose(grad, fd, rtol = 1e-5, atol = 1e-8*np.max(np.abs(fd)))
+
+
+def test_optimal_policy_reaches_target():
+    ds, res = lef.optimal_policy(control = 'beta_0', target = 'halve', target_year = 2040)
+    assert res.success
+    assert np.all(ds.subsidy.values >= -1e-12)
+
+    params = dict(lef.best_params, beta_0 = ds.beta_0)
+    resu = lef.run_model(inicond = lef.inicond_2015, params = params, n_iter = len(ds.year), year_ini = year_ini, verbose = False)
+    Ef = resu['Ef']
+    assert float(Ef.sel(year = 2040)) <= 0.5*float(Ef.sel(year = 2015)) + 1e-6
+
+
+################################################################################################################
+######################################## GDP drivers
+
+def test_default_gdp_is_unchanged():
+    resu = run_ref()
+    assert np.array_equal(resu.data, run_ref(gdp = 'growth').data)
+    assert np.array_equal(resu.data, run_ref(gdp = {'type': 'growth'}).data)
+    Y = []
+    y = 1.
+    for _ in range(len(resu)):
+        y = y*(1 + lef.best_params['growth'])
+        Y.append(y)
+    assert np.array_equal(resu.get('Y'), np.array(Y))
+
+
+def test_default_gdp_ensemble_is_unchanged():
+    kw = dict(inicond = lef.inicond_2015, params = lef.best_params, n_iter = n_iter, year_ini = year_ini, n_members = 2)
+    ens = lef.run_ensemble(**kw)
+    assert np.array_equal(ens.Y.values, lef.run_ensemble(gdp = 'growth', **kw).Y.values, equal_nan = True)
+    Y = run_ref().get('Y')
+    assert np.array_equal(ens.Y.values[0, :len(Y)], Y)
+
+
+def test_linear_gdp_keyword():
+    assert np.array_equal(run_ref(linear_gdp = 0.02).data, run_ref(gdp = {'type': 'linear', 'slope': 0.02}).data)
+
+
+def test_observed_gdp_follows_series():
+    years = np.arange(2010, 2030)
+    series = xr.DataArray(5*1.02**np.arange(len(years)), dims = 'year', coords = {'year': years})
+    Y = run_ref(gdp = series).get('Y')
+    assert np.allclose(Y[:10], 1.02**np.arange(1, 11))
+
+
+def test_endogenous_gdp_runs():
+    resu = run_ref(gdp = 'endogenous')
+    assert len(resu) > 0 and np.all(np.isfinite(resu.get('Y')))
+
+
+################################################################################################################
+######################################## Ensemble filter
+
+def test_filter_reproducible():
+    obs = {'Eg_ratio': 0.1, 'Ig_ratio': 0.3}
+    filts = [lef.EnsembleFilter(n_members = 20, seed = 3) for _ in range(2)]
+    for filt in filts:
+        for _ in range(3): filt.step(obs)
+    assert filts[0].to_dataset().equals(filts[1].to_dataset())
+
+
+def test_filter_step_without_obs_is_forecast():
+    filt = lef.EnsembleFilter(n_members = 20, seed = 0)
+    theta = filt.theta.copy()
+    state, _ = filt.forecast()
+    filt.step()
+    filt.step({'Eg_ratio': np.nan})
+    assert filt.n_updates == 0 and np.array_equal(filt.theta, theta)
+    assert filt.to_dataset().sizes['year'] == 2
+    assert np.allclose(filt.to_dataset().Y.isel(year = 1), state[0])
+
+
+def test_filter_recovers_parameter():
+    params = dict(lef.best_params, gamma_g = 1.3*lef.best_params['gamma_g'])
+    params['gamma_f'] = params['gamma_g']
+    truth = lef.run_model(inicond = lef.inicond_2015, params = params, n_iter = 15, year_ini = year_ini, verbose = False)
+    filt = lef.EnsembleFilter(n_members = 200, fit_pars = ['gamma_g'], seed = 0)
+    for year in range(year_ini, year_ini + 12):
+        filt.step({var: float(truth[var].sel(year = year)) for var in ['Eg_ratio', 'Ig_ratio']})
+
+    gamma_g = filt.to_dataset().gamma_g
+    assert filt.n_updates == 12
+    assert gamma_g.isel(year = -1).std() < 0.2*gamma_g.isel(year = 0).std()
+    assert abs(gamma_g.isel(year = -1).mean() - params['gamma_g']) < abs(gamma_g.isel(year = 0).mean() - params['gamma_g'])
+
+
+################################################################################################################
+######################################## Command line
+
+def write_specs(path, specs):
+    with open(path, 'w') as fil:
+        json.dump(specs, fil)
+    return str(path)
+
+
+def test_scenario_file_overwrite_keeps_others(tmp_path):
+    output = str(tmp_path / 'out.nc')
+    file_a = write_specs(tmp_path / 'a.json', [{'name': 's1', 'n_iter': 30}, {'name': 's2', 'n_iter': 30}])
+    file_b = write_specs(tmp_path / 'b.json', [{'name': 's3', 'n_iter': 30}])
+
+    lef.run_scenario_file(file_a, output, verbose = False)
+    lef.run_scenario_file(file_b, output, overwrite = True, verbose = False)
+    with xr.open_dataset(output) as ds:
+        assert sorted(ds.scenario.values) == ['s1', 's2', 's3']
+
+
+def test_scenario_file_settings_and_resume(tmp_path, monkeypatch):
+    output = str(tmp_path / 'out.nc')
+    specs = [{'name': 's1', 'n_iter': 30}, {'name': 's2', 'n_iter': 30, 'rule': 'fair'}]
+    path = write_specs(tmp_path / 'a.json', specs)
+    ds = lef.run_scenario_file(path, output, verbose = False)
+    assert list(ds.rule.values) == ['maxgreen', 'fair'] and ds.attrs['rules'] == 'fair maxgreen'
+
+    # unchanged scenarios are skipped, changed ones are rerun
+    path = write_specs(tmp_path / 'a.json', [specs[0], dict(specs[1], rule = 'proportional')])
+    ran = []
+    run_scenarios = lef.run_scenarios
+    monkeypatch.setattr(lef, 'run_scenarios', lambda batch, **kw: ran.extend(spec['name'] for spec in batch) or run_scenarios(batch, **kw))
+    ds = lef.run_scenario_file(path, output, verbose = False)
+    assert ran == ['s2'] and list(ds.rule.values) == ['maxgreen', 'proportional']
+
+    # a stored setting that does not match the spec gives a rerun
+    with xr.open_dataset(output) as ds_old:
+        ds_old = ds_old.load()
+    ds_old['rule'] = ('scenario', ['fair', 'proportional'])
+    ds_old.to_netcdf(output)
+    ran.clear()
+    lef.run_scenario_file(path, output, verbose = False)
+    assert ran == ['s1']
+
+
+def test_scenario_file_progress_per_chunk(tmp_path, capsys):
+    path = write_specs(tmp_path / 'a.json', [{'name': f's{i}', 'n_iter': 10} for i in range(5)])
+    lef.run_scenario_file(path, str(tmp_path / 'out.nc'), chunk_size = 2)
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in lines[1:]] == ['[2/5]', '[4/5]', '[5/5]']
+
+
+################################################################################################################
+######################################## Bootstrap
+
+def test_residual_bootstrap_keeps_blocks():
+    idx = lef._block_indices(10, np.random.default_rng(0), block = 3)
+    assert len(idx) == 10
+    for st in range(0, 10, 3):
+        assert np.all(np.diff(idx[st:st+3]) == 1)
+
+    # a single block of all years gives back the residuals in order
+    parnames = ['beta_0', 'growth']
+    best_x = [lef.best_params[par] for par in parnames]
+    kw = dict(params = lef.best_params, year_ini = year_ini, inicond = lef.inicond_2015)
+    obs = lef.bootstrap_samples(parnames, best_x, n_boot = 1, method = 'residuals', block = 100, seed = 1, **kw)[0]['obs']
+    for var, val in obs.items():
+        ref = lef.fit_obs()[var].sel(year = val.year)
+        assert np.allclose(val.values, ref.values)
+
+
+def test_bootstrap_weights():
+    kw = dict(params = lef.best_params, year_ini = year_ini, inicond = lef.inicond_2015)
+    best_x = [lef.best_params[par] for par in fit_pars]
+    for sample in lef.bootstrap_samples(fit_pars, best_x, n_boot = 5, method = 'years', block = 2, seed = 0, **kw):
+        for weights in sample['year_weights'].values():
+            assert weights.sum() == len(weights)
+
+    samples = lef.bootstrap_samples(fit_pars, best_x, method = 'jackknife', **kw)
+    years = np.unique(np.concatenate([weights.year.values for weights in samples[0]['year_weights'].values()]))
+    assert len(samples) == len(years)
+    for year, sample in zip(years, samples):
+        for weights in sample['year_weights'].values():
+            assert np.all((weights == 0) == (weights.year == year))
+
+    with pytest.raises(ValueError):
+        lef.bootstrap_samples(fit_pars, best_x, method = 'wrong', **kw)
+
+
+def test_bootstrap(best_fit):
+    boot = lef.bootstrap(fit_pars, best_fit, fit_bounds, n_boot = 4, seed = 0, **fit_kw)
+    assert boot.params.shape == (4, len(fit_pars))
+    assert np.all(boot.ci_low <= boot.ci_high) and np.all(boot['std'] > 0)
+    for (lo, hi), vals in zip(fit_bounds, boot.params.values.T):
+        assert np.all((vals >= lo) & (vals <= hi))
+
+
+################################################################################################################
+######################################## Time step
+
+def test_run_model_dt_unit_step():
+    resu = run_ref()
+    resu_dt = lef.run_model_dt(inicond = lef.inicond_2015, params = lef.best_params, n_iter = n_iter, year_ini = year_ini, dt = 1.)
+
+    assert np.array_equal(resu.data, resu_dt.data)
+    for var in ['success', 'year_zero', 'year_peak', 'year_halved']:
+        assert resu_dt.attrs[var] == resu.attrs[var]
+
+
+def test_run_model_dt_adaptive():
+    kw = dict(inicond = lef.inicond_2015, params = lef.best_params, n_iter = 150, year_ini = year_ini)
+    events = ['year_peak', 'year_zero', 'year_halved']
+    uniform = {dt: np.array([lef.run_model_dt(dt = dt, **kw).attrs[ev] for ev in events], dtype = float) for dt in [1/64, 1/128]}
+    limit = 2*uniform[1/128] - uniform[1/64]
+
+    resu = lef.run_model_dt(adaptive = True, **kw)
+    assert np.allclose([resu.attrs[ev] for ev in events], limit, atol = 0.03)
+    assert resu.attrs['n_evals'] < 64 * (resu.attrs['year_zero'] - year_ini)/4
+
+
+@pytest.mark.parametrize('adaptive, dt', [(True, 1.), (False, 1.), (False, 0.25)])
+def test_run_model_dt_t_out(adaptive, dt):
+    kw = dict(inicond = lef.inicond_2015, params = lef.best_params, n_iter = 150, year_ini = year_ini, adaptive = adaptive, dt = dt)
+    t_out = np.arange(year_ini + 1, year_ini + 151)
+    resu, dense = lef.run_model_dt(t_out = t_out, **kw)
+    n_out = len(resu)
+    for var in ['Y', 'Kg', 'Kf']:
+        assert np.allclose(dense[var].values[:n_out], resu.get(var), rtol = 1e-12)
+    assert np.all(np.isnan(dense.Kg.values[n_out:]))
+
+
+def test_run_model_dt_t_out_within_year():
+    kw = dict(inicond = lef.inicond_2015, params = lef.best_params, n_iter = 30, year_ini = year_ini, t_out = [2020.25, 2030.5])
+    _, dense = lef.run_model_dt(adaptive = True, **kw)
+    _, dense_fine = lef.run_model_dt(dt = 1/256, **kw)
+    for var in ['Y', 'Kg', 'Kf']:
+        assert np.allclose(dense[var], dense_fine[var], rtol = 1e-3)
+
+
+################################################################################################################
+######################################## Stepper
+
+def test_stepper_snapshot_restore():
+    resu = run_ref()
+    stepper = lef.ModelStepper(inicond = lef.inicond_2015, params = lef.best_params, year_ini = year_ini)
+    stepper.step(10)
+    snap = stepper.snapshot()
+    stepper.step(n_iter - 10, overrides = {'growth': 0.})
+
+    stepper.restore(snap)
+    stepper.step(n_iter - 10)
+    assert np.array_equal(stepper.to_dataset(stop = True).data, resu.data)
+
+
+def test_stepper_ensemble_is_run_ensemble():
+    params = lef.best_params.copy()
+    params['growth'] = xr.DataArray(np.linspace(0., 0.03, 5), dims = ['member'])
+    params['beta_0'] = xr.DataArray(np.linspace(-0.28, 0.3, 30), dims = ['year'], coords = {'year': np.arange(year_ini, year_ini + 30)})
+    ens = lef.run_ensemble(inicond = lef.inicond_2015, params = params, n_iter = n_iter, year_ini = year_ini)
+
+    stepper = lef.ModelStepper(inicond = lef.inicond_2015, params = params, year_ini = year_ini)
+    for _ in stepper.steps(n_iter): pass
+    ens_step = stepper.to_dataset(stop = True)
+    for var in ens.data_vars:
+        assert np.array_equal(ens[var].values, ens_step[var].values, equal_nan = True), var